@@ -0,0 +1,239 @@
+"""
+Runs the node step of the algorithm end to end on synthetic OMOP CDM data.
+
+For every scale (number of persons), the benchmark generates a synthetic CDM
+with ``synthetic_cdm.py`` and runs ``cohort_diagnostics`` on it with the cohort
+definitions in the ``cohort_definitions`` folder. Each scale runs in a fresh
+interpreter, so every run starts its own R session and JVM and its peak memory
+is not influenced by earlier runs.
+
+The node function is called without its vantage6 decorators, which would read
+the connection and the metadata from the node environment: the benchmark
+connects to the SQLite database itself. It needs the same R and OHDSI
+environment as the algorithm image.
+
+The report is a JSON file with, per scale, the size of the data, the time to
+generate it, the start-up time of R and the OHDSI packages, and the wall time,
+CPU time and peak memory of every phase of the node run. Reports of different
+releases can be compared phase by phase.
+
+Usage:
+
+    python benchmarks/cdm_benchmark.py --persons 10000 100000 1000000 \\
+        --work-dir benchmark-data --output report.json
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from synthetic_cdm import COHORT_DEFINITIONS, generate
+
+ROOT = Path(__file__).resolve().parent.parent
+PKG_NAME = "v6-omop-cohort-diagnostics"
+
+# Increase when the layout of the report changes
+REPORT_VERSION = 1
+
+# The covariates and diagnostics of client.py, without the time series
+TEMPORAL_COVARIATE_SETTINGS = {
+    "use_demographics_gender": True,
+    "use_demographics_age": True,
+    "use_demographics_age_group": True,
+    "use_demographics_race": True,
+    "use_demographics_ethnicity": True,
+    "use_demographics_index_year": True,
+    "use_demographics_index_month": True,
+    "use_demographics_prior_observation_time": True,
+    "use_demographics_post_observation_time": True,
+    "use_demographics_time_in_cohort": True,
+    "use_condition_occurrence": True,
+    "use_procedure_occurrence": True,
+    "use_drug_era_start": True,
+    "use_measurement": True,
+    "use_condition_era_start": True,
+    "use_condition_era_overlap": True,
+    "use_condition_era_group_overlap": True,
+    "use_drug_era_group_overlap": True,
+    "use_observation": True,
+    "use_visit_concept_count": True,
+    "use_visit_count": True,
+    "use_device_exposure": True,
+    "use_charlson_index": True,
+    "temporal_start_days": [-9999, -365, -180, -30, -365, -30, 0, 1, 31, -9999],
+    "temporal_end_days": [0, 0, 0, 0, -31, -1, 0, 30, 365, 9999],
+}
+DIAGNOSTICS_SETTINGS = {
+    "run_inclusion_statistics": True,
+    "run_included_source_concepts": True,
+    "run_orphan_concepts": True,
+    "run_time_series": False,
+    "run_visit_context": True,
+    "run_breakdown_index_events": False,
+    "run_incidence_rate": True,
+    "run_cohort_relationship": True,
+    "run_temporal_cohort_characterization": True,
+}
+
+# Runs in a fresh interpreter, prints the result of the run as JSON
+CHILD = """
+import importlib
+import json
+import resource
+import sys
+import time
+from pathlib import Path
+
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+node = importlib.import_module({pkg!r} + ".node")
+from ohdsi.database_connector import connect
+from vantage6.algorithm.tools.decorators import OHDSIMetaData, RunMetaData
+startup = time.perf_counter() - start
+
+work_dir = Path({work_dir!r})
+connection = connect(dbms="sqlite", server={database!r})
+meta_omop = OHDSIMetaData(
+    database="synthetic",
+    cdm_schema="main",
+    results_schema="main",
+    incremental_folder=work_dir / "incremental",
+    cohort_statistics_folder=work_dir / "cohort_statistics",
+    export_folder=work_dir / "export",
+    dbms="sqlite",
+)
+meta_run = RunMetaData(
+    task_id=1,
+    node_id=1,
+    collaboration_id=1,
+    organization_id=1,
+    temporary_directory=work_dir,
+    output_file=None,
+    input_file=None,
+    token_file=None,
+)
+
+# the function below the @metadata and @database_connection decorators
+cohort_diagnostics = node.cohort_diagnostics.__wrapped__.__wrapped__
+start = time.perf_counter()
+result = cohort_diagnostics(
+    connection,
+    meta_omop,
+    meta_run,
+    **json.loads(sys.stdin.read()),
+)
+total = time.perf_counter() - start
+
+print(json.dumps({{
+    "startup_seconds": round(startup, 3),
+    "total_seconds": round(total, 3),
+    "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    "result_bytes": sum(len(chunk) for chunk in result["zip_chunks"]),
+    "cohorts": result["cohorts"],
+    "metrics": result["metrics"],
+}}))
+"""
+
+
+def run_node(database: Path, work_dir: Path, cohort_definitions: list, cohort_names: list) -> dict:
+    """Runs the node step on a database in a fresh interpreter."""
+    work_dir.mkdir(parents=True, exist_ok=True)
+    code = CHILD.format(
+        root=str(ROOT), pkg=PKG_NAME, work_dir=str(work_dir), database=str(database)
+    )
+    kwargs = {
+        "meta_cohorts": [{"task_id": 1}],
+        "cohort_definitions": cohort_definitions,
+        "cohort_names": cohort_names,
+        "temporal_covariate_settings": TEMPORAL_COVARIATE_SETTINGS,
+        "diagnostics_settings": DIAGNOSTICS_SETTINGS,
+    }
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        input=json.dumps(kwargs),
+        capture_output=True,
+        text=True,
+    )
+    if output.returncode != 0:
+        sys.stderr.write(output.stderr)
+        raise RuntimeError(f"The node run on {database} failed")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--persons", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", type=Path, default=Path("benchmark-data"))
+    parser.add_argument("--output", type=Path, default=Path("benchmark-report.json"))
+    parser.add_argument(
+        "--regenerate",
+        action="store_true",
+        help="Generate the databases even if they exist in the work directory",
+    )
+    args = parser.parse_args()
+
+    files = sorted(COHORT_DEFINITIONS.glob("*.json"))
+    cohort_definitions = [file_.read_text() for file_ in files]
+    cohort_names = [file_.stem for file_ in files]
+
+    report = {
+        "report_version": REPORT_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "cohorts": cohort_names,
+        "temporal_covariate_settings": TEMPORAL_COVARIATE_SETTINGS,
+        "diagnostics_settings": DIAGNOSTICS_SETTINGS,
+        "runs": [],
+    }
+    for persons in args.persons:
+        database = args.work_dir / f"cdm_{persons}_{args.seed}.sqlite"
+        args.work_dir.mkdir(parents=True, exist_ok=True)
+        run = {"persons": persons}
+        if args.regenerate or not database.exists():
+            start = time.perf_counter()
+            run["rows"] = generate(database, persons, seed=args.seed)
+            run["generate_seconds"] = round(time.perf_counter() - start, 3)
+            print(f"Generated {persons} persons in {run['generate_seconds']:.1f}s")
+        run["database_bytes"] = database.stat().st_size
+
+        run.update(
+            run_node(database, args.work_dir / f"run_{persons}", cohort_definitions, cohort_names)
+        )
+        print(
+            f"{persons} persons: {run['total_seconds']:.1f}s, "
+            f"peak {run['peak_rss_mb']:.0f} MB"
+        )
+        for phase in run["metrics"]["phases"]:
+            print(
+                f"  {phase['phase']:<32} {phase['wall_seconds']:>9.1f}s "
+                f"{phase['peak_rss_mb']:>9.0f} MB"
+            )
+        report["runs"].append(run)
+
+        # written after every scale, so a failing larger scale keeps the
+        # results of the smaller ones
+        args.output.write_text(json.dumps(report, indent=2))
+    print(f"Wrote {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
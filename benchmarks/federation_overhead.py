@@ -0,0 +1,176 @@
+"""
+Measures the overhead of moving the results through the central step and client.
+
+The benchmark runs ``cohort_diagnostics_central`` with the vantage6
+``MockAlgorithmClient`` and the stubbed node functions of ``mock_node.py``, so
+it needs neither R nor a database. For every number of organizations and zip
+size it measures:
+
+- the base64 encoding of the results zips on the nodes,
+- the JSON serialization of the node results and of the central result, and
+  their parsing, as done by the mock client in place of the node, the server
+  and the central container,
+- the wall time and the peak Python memory of the central step,
+- the wall time and the peak Python memory of ``client.py`` saving the results
+  zips of the central result, on top of the central result itself.
+
+The mock client runs the nodes inside the central step and keeps all results
+in memory, like the server would. The central figures include that. Memory is
+measured with ``tracemalloc``, which tracks the allocations of Python objects.
+
+Usage:
+
+    python benchmarks/federation_overhead.py --organizations 2 10 50 100 \\
+        --zip-mb 1 [--output overhead.json]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import pandas as pd
+from vantage6.algorithm.tools import mock_client
+
+import mock_node
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from client import iter_node_results, save_result  # noqa: E402
+
+
+class TimedJson:
+    """Stand-in for the ``json`` module of the mock client that times it."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.dumps_seconds = 0.0
+        self.dumps_bytes = 0
+        self.loads_seconds = 0.0
+        self.loads_bytes = 0
+
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        text = json.dumps(obj, **kwargs)
+        self.dumps_seconds += time.perf_counter() - start
+        self.dumps_bytes += len(text)
+        return text
+
+    def loads(self, text, **kwargs):
+        start = time.perf_counter()
+        obj = json.loads(text, **kwargs)
+        self.loads_seconds += time.perf_counter() - start
+        self.loads_bytes += len(text)
+        return obj
+
+
+def run_scenario(organizations: int, zip_bytes: int, timed_json: TimedJson) -> dict:
+    """Runs the central step and the client for one scenario."""
+    mock_node.ZIP_BYTES = zip_bytes
+    client = mock_node.MockClient(
+        datasets=[[{"database": pd.DataFrame()}]] * organizations,
+        module="mock_node",
+    )
+    files = sorted((ROOT / "cohort_definitions").glob("*.json"))
+    timed_json.reset()
+
+    # the central step, with the nodes inside it
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        client.task.create(
+            input_={
+                "method": "cohort_diagnostics_central",
+                "kwargs": {
+                    "cohort_definitions": [file_.read_text() for file_ in files],
+                    "cohort_names": [file_.stem for file_ in files],
+                    "meta_cohorts": [{"task_id": 1}],
+                    "temporal_covariate_settings": {},
+                    "diagnostics_settings": {},
+                    "poll_interval": 0,
+                },
+            },
+            organizations=[client.organization_id],
+        )
+    central_seconds = time.perf_counter() - start
+    _, central_peak = tracemalloc.get_traced_memory()
+
+    # the central result as the client receives it from the server
+    result_data = client.results[-1]["result"]
+    node_results = [json.loads(result["result"]) for result in client.results[:-1]]
+    encode_seconds = sum(
+        phase["wall_seconds"]
+        for result in node_results
+        for phase in result["metrics"]["phases"]
+    )
+    del node_results
+
+    # the client, saving the results zips of the central result that it
+    # already holds
+    tracemalloc.reset_peak()
+    in_use, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as folder, open(
+        os.devnull, "w"
+    ) as devnull, contextlib.redirect_stdout(devnull):
+        for parsed_result in iter_node_results(result_data):
+            save_result(result_data, parsed_result, folder)
+    client_seconds = time.perf_counter() - start
+    _, client_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "organizations": organizations,
+        "zip_bytes": zip_bytes,
+        "central_result_bytes": len(result_data),
+        "node_encode_seconds": round(encode_seconds, 3),
+        "json_dumps_seconds": round(timed_json.dumps_seconds, 3),
+        "json_dumps_bytes": timed_json.dumps_bytes,
+        "json_loads_seconds": round(timed_json.loads_seconds, 3),
+        "json_loads_bytes": timed_json.loads_bytes,
+        "central_seconds": round(central_seconds, 3),
+        "central_peak_mb": round(central_peak / 2**20, 1),
+        "client_seconds": round(client_seconds, 3),
+        "client_peak_mb": round((client_peak - in_use) / 2**20, 1),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--organizations", type=int, nargs="+", default=[2, 10, 50, 100])
+    parser.add_argument("--zip-mb", type=float, nargs="+", default=[1.0])
+    parser.add_argument("--output", type=Path, default=None, help="JSON file for the results")
+    args = parser.parse_args()
+
+    # the mock client serializes the results with its own json module
+    timed_json = TimedJson()
+    mock_client.json = timed_json
+
+    rows = []
+    for zip_mb in args.zip_mb:
+        for organizations in args.organizations:
+            rows.append(run_scenario(organizations, int(zip_mb * 2**20), timed_json))
+            print(
+                f"{organizations:>4} organizations, {zip_mb:g} MB zips: "
+                f"central {rows[-1]['central_seconds']:.2f}s "
+                f"{rows[-1]['central_peak_mb']:.0f} MB, "
+                f"client {rows[-1]['client_seconds']:.2f}s "
+                f"{rows[-1]['client_peak_mb']:.0f} MB"
+            )
+
+    print(pd.DataFrame(rows).to_string(index=False))
+    if args.output:
+        args.output.write_text(json.dumps(rows, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+Measures how fast the central step of the algorithm reaches ``task.create``.
+
+The central step runs in a fresh container, so every second spent on imports is
+paid for every task. The benchmark starts a new interpreter that imports the
+algorithm like the vantage6 wrapper does and runs ``cohort_diagnostics_central``
+with a fake client. The fake client records the time at which ``task.create``
+is called and stops the run.
+
+Both paths of the central step are measured: the default path, which leaves
+the compilation of the cohort definitions to the nodes, and the ``precompile``
+path, which compiles them in the central step with R, the JVM and Circe. The
+benchmark fails when the default path needs more than ``--max-seconds``, or
+when it imports R, the OHDSI packages or the vantage6 decorators module (which
+imports the OHDSI packages itself). The ``precompile`` path is expected to
+import them, its timings show the cost of that option.
+
+Usage:
+
+    python benchmarks/import_time.py [--repeat 5] [--max-seconds 1.0]
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+PKG_NAME = "v6-omop-cohort-diagnostics"
+COHORT_DEFINITION = ROOT / "cohort_definitions" / "IncidentBreastCancer.json"
+
+# Modules that must not be imported by the central step
+HEAVY_MODULES = ("rpy2", "ohdsi", "vantage6.algorithm.tools.decorators")
+
+# Runs in a fresh interpreter, the timer starts before any algorithm import
+CHILD = """
+import time
+start = time.perf_counter()
+
+import importlib
+import json
+import sys
+
+sys.path.insert(0, {root!r})
+
+
+class TaskCreated(Exception):
+    pass
+
+
+class FakeClient:
+    class organization:
+        @staticmethod
+        def list():
+            return [{{"id": 1}}, {{"id": 2}}]
+
+    class task:
+        @staticmethod
+        def create(input_, organizations):
+            raise TaskCreated(time.perf_counter())
+
+
+module = importlib.import_module({pkg!r})
+imported = time.perf_counter()
+try:
+    result = module.cohort_diagnostics_central(
+        cohort_definitions=[json.loads({definition!r})],
+        cohort_names=["benchmark"],
+        meta_cohorts=[{{}}],
+        temporal_covariate_settings={{}},
+        diagnostics_settings={{}},
+        precompile={precompile!r},
+        mock_client=FakeClient,
+    )
+    raise SystemExit(f"task.create was not called: {{result}}")
+except TaskCreated as e:
+    task_created = e.args[0]
+
+print(json.dumps({{
+    "import_seconds": imported - start,
+    "task_create_seconds": task_created - start,
+    "heavy_modules": sorted(
+        name for name in sys.modules
+        if name.split(".")[0] in {heavy_roots!r} or name in {heavy!r}
+    ),
+}}))
+"""
+
+
+def run_once(precompile: bool) -> dict:
+    """Runs the central step once in a fresh interpreter."""
+    code = CHILD.format(
+        root=str(ROOT),
+        pkg=PKG_NAME,
+        definition=COHORT_DEFINITION.read_text(),
+        precompile=precompile,
+        heavy=HEAVY_MODULES,
+        heavy_roots=tuple(name for name in HEAVY_MODULES if "." not in name),
+    )
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_seconds"] = time.perf_counter() - start
+    return result
+
+
+def report(name: str, runs: list[dict]) -> None:
+    """Prints the median and maximum of every timing."""
+    print(name)
+    for key in ("import_seconds", "task_create_seconds", "process_seconds"):
+        values = [run[key] for run in runs]
+        print(
+            f"  {key:<20} median {statistics.median(values):.3f}s "
+            f"max {max(values):.3f}s"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    runs = [run_once(precompile=False) for _ in range(args.repeat)]
+    report("default", runs)
+    try:
+        report(
+            "precompile",
+            [run_once(precompile=True) for _ in range(args.repeat)],
+        )
+    except subprocess.CalledProcessError as e:
+        # needs the R and OHDSI environment of the algorithm image
+        error = e.stderr.strip().splitlines()[-1:] or ["unknown error"]
+        print(f"precompile\n  not measured: {error[0]}")
+
+    heavy = sorted({name for run in runs for name in run["heavy_modules"]})
+    if heavy:
+        print(f"FAIL: the central step imported {', '.join(heavy)}")
+        return 1
+    slowest = max(run["task_create_seconds"] for run in runs)
+    if slowest > args.max_seconds:
+        print(f"FAIL: task.create reached after {slowest:.3f}s")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+The algorithm with stubbed node functions, for the vantage6 mock client.
+
+The central functions are those of the algorithm. The node functions do not
+start R or connect to a database: they return a result with the same structure
+as the real node functions, with a results zip of ``ZIP_BYTES`` random bytes
+that is encoded like the real one. This makes it possible to run the central
+step with the mock client of vantage6 and many organizations.
+
+Usage:
+
+    client = MockClient(datasets=..., module="mock_node")
+"""
+
+import copy
+import importlib
+import random
+import sys
+import tempfile
+import zipfile
+from pathlib import Path
+
+from vantage6.algorithm.tools.mock_client import MockAlgorithmClient
+
+ROOT = Path(__file__).resolve().parent.parent
+PKG_NAME = "v6-omop-cohort-diagnostics"
+
+sys.path.insert(0, str(ROOT))
+_algorithm = importlib.import_module(PKG_NAME)
+_decorators = importlib.import_module(f"{PKG_NAME}.decorators")
+_metrics = importlib.import_module(f"{PKG_NAME}.metrics")
+_results = importlib.import_module(f"{PKG_NAME}.results")
+_globals = importlib.import_module(f"{PKG_NAME}.globals")
+
+cohort_diagnostics_central = _algorithm.cohort_diagnostics_central
+cohort_diagnostics_batch_central = _algorithm.cohort_diagnostics_batch_central
+
+# Size of the results zip of every node, in bytes
+ZIP_BYTES = 1_000_000
+# Number of bytes per encoded chunk, like CD_RESULT_CHUNK_SIZE on a node
+CHUNK_SIZE = int(_globals.DEFAULT_CD_RESULT_CHUNK_SIZE)
+
+
+class MockClient(MockAlgorithmClient):
+    """
+    Mock client whose copies share the tasks, runs and results.
+
+    The mock client deep copies itself for every run it creates, including all
+    results stored so far. With many organizations that copying would dominate
+    the measurements, while a real server stores every result once.
+    """
+
+    # some versions of the mock client create a node subclient that they do
+    # not define
+    Node = getattr(MockAlgorithmClient, "Node", MockAlgorithmClient.SubClient)
+
+    def __deepcopy__(self, memo):
+        return copy.copy(self)
+
+
+_zips = {}
+_folder = tempfile.TemporaryDirectory(prefix="mock_node_")
+
+
+def _results_zip(size: int) -> Path:
+    """Returns a results zip of ``size`` bytes, created once per size."""
+    if size not in _zips:
+        path = Path(_folder.name) / f"results_{size}.zip"
+        # random bytes do not compress, like the already compressed export
+        data = random.Random(size).randbytes(size)
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as zip_:
+            zip_.writestr("cohort_count.csv", data)
+        _zips[size] = path
+    return _zips[size]
+
+
+def _node_result(client, cohort_names: list[str], result_format: str) -> dict:
+    metrics = _metrics.Metrics()
+    with metrics.phase("encode_results"):
+        chunks = list(_results.encode_chunks(_results_zip(ZIP_BYTES), CHUNK_SIZE))
+    return {
+        "organization_id": client.organization_id,
+        "zip_chunks": chunks,
+        "format": result_format,
+        "cohorts": [
+            {"cohort_id": str(i), "cohort_name": name, "generation": "generated"}
+            for i, name in enumerate(cohort_names)
+        ],
+        "metrics": metrics.to_dict(),
+    }
+
+
+@_decorators.algorithm_client
+def cohort_diagnostics(
+    client,
+    meta_cohorts: list[dict],
+    cohort_definitions: list,
+    cohort_names: list[str],
+    temporal_covariate_settings: dict,
+    diagnostics_settings: dict,
+    cohort_sql_bundle: list[dict] | None = None,
+    incremental: bool = False,
+    result_format: str = "csv",
+    dry_run: bool = False,
+    budget_policy: str = "none",
+    characterization_sample_size: int | None = None,
+    covariate_budget: int | None = None,
+) -> dict:
+    """Returns a node result with a results zip of ``ZIP_BYTES`` bytes."""
+    return _node_result(client, cohort_names, result_format)
+
+
+@_decorators.algorithm_client
+def cohort_diagnostics_batch(
+    client,
+    meta_cohorts: list[dict],
+    studies: list[dict],
+    incremental: bool = False,
+    result_format: str = "csv",
+    dry_run: bool = False,
+    budget_policy: str = "none",
+    characterization_sample_size: int | None = None,
+    covariate_budget: int | None = None,
+) -> dict:
+    """Returns a node result with a results zip per study."""
+    results = []
+    for i, study in enumerate(studies):
+        result = _node_result(client, study["cohort_names"], result_format)
+        del result["organization_id"]
+        results.append({"name": study.get("name", f"study_{i}"), **result})
+    return {
+        "organization_id": client.organization_id,
+        "studies": results,
+        "metrics": _metrics.Metrics().to_dict(),
+    }
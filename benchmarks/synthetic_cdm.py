@@ -0,0 +1,794 @@
+"""
+Generates a synthetic OMOP CDM (v5.4) database for the benchmarks.
+
+The database is a SQLite file, which DatabaseConnector can open without a
+database server (like the Eunomia test database of OHDSI). Dates are stored as
+seconds since 1970-01-01, which is how SqlRender translates date arithmetic for
+SQLite.
+
+The vocabulary contains the concepts of the concept sets of the cohort
+definitions, so the cohorts are not empty, and a configurable number of
+synthetic background concepts per domain. Synthetic concepts have ids above
+2,000,000,000, the range that OMOP reserves for local concepts. The data is
+generated from a seed, so the same arguments always produce the same database.
+
+Usage:
+
+    python benchmarks/synthetic_cdm.py cdm_100k.sqlite --persons 100000
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import random
+import sqlite3
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+COHORT_DEFINITIONS = ROOT / "cohort_definitions"
+
+# Columns of the CDM tables, in the order of the v5.4 DDL
+TABLES = {
+    "person": (
+        "person_id gender_concept_id year_of_birth month_of_birth day_of_birth "
+        "birth_datetime race_concept_id ethnicity_concept_id location_id "
+        "provider_id care_site_id person_source_value gender_source_value "
+        "gender_source_concept_id race_source_value race_source_concept_id "
+        "ethnicity_source_value ethnicity_source_concept_id"
+    ),
+    "observation_period": (
+        "observation_period_id person_id observation_period_start_date "
+        "observation_period_end_date period_type_concept_id"
+    ),
+    "visit_occurrence": (
+        "visit_occurrence_id person_id visit_concept_id visit_start_date "
+        "visit_start_datetime visit_end_date visit_end_datetime "
+        "visit_type_concept_id provider_id care_site_id visit_source_value "
+        "visit_source_concept_id admitted_from_concept_id "
+        "admitted_from_source_value discharged_to_concept_id "
+        "discharged_to_source_value preceding_visit_occurrence_id"
+    ),
+    "visit_detail": (
+        "visit_detail_id person_id visit_detail_concept_id "
+        "visit_detail_start_date visit_detail_start_datetime "
+        "visit_detail_end_date visit_detail_end_datetime "
+        "visit_detail_type_concept_id provider_id care_site_id "
+        "visit_detail_source_value visit_detail_source_concept_id "
+        "admitted_from_concept_id admitted_from_source_value "
+        "discharged_to_source_value discharged_to_concept_id "
+        "preceding_visit_detail_id parent_visit_detail_id visit_occurrence_id"
+    ),
+    "condition_occurrence": (
+        "condition_occurrence_id person_id condition_concept_id "
+        "condition_start_date condition_start_datetime condition_end_date "
+        "condition_end_datetime condition_type_concept_id "
+        "condition_status_concept_id stop_reason provider_id "
+        "visit_occurrence_id visit_detail_id condition_source_value "
+        "condition_source_concept_id condition_status_source_value"
+    ),
+    "drug_exposure": (
+        "drug_exposure_id person_id drug_concept_id drug_exposure_start_date "
+        "drug_exposure_start_datetime drug_exposure_end_date "
+        "drug_exposure_end_datetime verbatim_end_date drug_type_concept_id "
+        "stop_reason refills quantity days_supply sig route_concept_id "
+        "lot_number provider_id visit_occurrence_id visit_detail_id "
+        "drug_source_value drug_source_concept_id route_source_value "
+        "dose_unit_source_value"
+    ),
+    "procedure_occurrence": (
+        "procedure_occurrence_id person_id procedure_concept_id procedure_date "
+        "procedure_datetime procedure_end_date procedure_end_datetime "
+        "procedure_type_concept_id modifier_concept_id quantity provider_id "
+        "visit_occurrence_id visit_detail_id procedure_source_value "
+        "procedure_source_concept_id modifier_source_value"
+    ),
+    "device_exposure": (
+        "device_exposure_id person_id device_concept_id "
+        "device_exposure_start_date device_exposure_start_datetime "
+        "device_exposure_end_date device_exposure_end_datetime "
+        "device_type_concept_id unique_device_id production_id quantity "
+        "provider_id visit_occurrence_id visit_detail_id device_source_value "
+        "device_source_concept_id unit_concept_id unit_source_value "
+        "unit_source_concept_id"
+    ),
+    "measurement": (
+        "measurement_id person_id measurement_concept_id measurement_date "
+        "measurement_datetime measurement_time measurement_type_concept_id "
+        "operator_concept_id value_as_number value_as_concept_id "
+        "unit_concept_id range_low range_high provider_id visit_occurrence_id "
+        "visit_detail_id measurement_source_value measurement_source_concept_id "
+        "unit_source_value unit_source_concept_id value_source_value "
+        "measurement_event_id meas_event_field_concept_id"
+    ),
+    "observation": (
+        "observation_id person_id observation_concept_id observation_date "
+        "observation_datetime observation_type_concept_id value_as_number "
+        "value_as_string value_as_concept_id qualifier_concept_id "
+        "unit_concept_id provider_id visit_occurrence_id visit_detail_id "
+        "observation_source_value observation_source_concept_id "
+        "unit_source_value qualifier_source_value value_source_value "
+        "observation_event_id obs_event_field_concept_id"
+    ),
+    "death": (
+        "person_id death_date death_datetime death_type_concept_id "
+        "cause_concept_id cause_source_value cause_source_concept_id"
+    ),
+    "specimen": (
+        "specimen_id person_id specimen_concept_id specimen_type_concept_id "
+        "specimen_date specimen_datetime quantity unit_concept_id "
+        "anatomic_site_concept_id disease_status_concept_id specimen_source_id "
+        "specimen_source_value unit_source_value anatomic_site_source_value "
+        "disease_status_source_value"
+    ),
+    "location": (
+        "location_id address_1 address_2 city state zip county "
+        "location_source_value country_concept_id country_source_value "
+        "latitude longitude"
+    ),
+    "care_site": (
+        "care_site_id care_site_name place_of_service_concept_id location_id "
+        "care_site_source_value place_of_service_source_value"
+    ),
+    "provider": (
+        "provider_id provider_name npi dea specialty_concept_id care_site_id "
+        "year_of_birth gender_concept_id provider_source_value "
+        "specialty_source_value specialty_source_concept_id "
+        "gender_source_value gender_source_concept_id"
+    ),
+    "payer_plan_period": (
+        "payer_plan_period_id person_id payer_plan_period_start_date "
+        "payer_plan_period_end_date payer_concept_id payer_source_value "
+        "payer_source_concept_id plan_concept_id plan_source_value "
+        "plan_source_concept_id sponsor_concept_id sponsor_source_value "
+        "sponsor_source_concept_id family_source_value stop_reason_concept_id "
+        "stop_reason_source_value stop_reason_source_concept_id"
+    ),
+    "drug_era": (
+        "drug_era_id person_id drug_concept_id drug_era_start_date "
+        "drug_era_end_date drug_exposure_count gap_days"
+    ),
+    "dose_era": (
+        "dose_era_id person_id drug_concept_id unit_concept_id dose_value "
+        "dose_era_start_date dose_era_end_date"
+    ),
+    "condition_era": (
+        "condition_era_id person_id condition_concept_id "
+        "condition_era_start_date condition_era_end_date "
+        "condition_occurrence_count"
+    ),
+    "cdm_source": (
+        "cdm_source_name cdm_source_abbreviation cdm_holder source_description "
+        "source_documentation_reference cdm_etl_reference source_release_date "
+        "cdm_release_date cdm_version cdm_version_concept_id vocabulary_version"
+    ),
+    "metadata": (
+        "metadata_id metadata_concept_id metadata_type_concept_id name "
+        "value_as_string value_as_concept_id value_as_number metadata_date "
+        "metadata_datetime"
+    ),
+    "concept": (
+        "concept_id concept_name domain_id vocabulary_id concept_class_id "
+        "standard_concept concept_code valid_start_date valid_end_date "
+        "invalid_reason"
+    ),
+    "vocabulary": (
+        "vocabulary_id vocabulary_name vocabulary_reference vocabulary_version "
+        "vocabulary_concept_id"
+    ),
+    "domain": "domain_id domain_name domain_concept_id",
+    "concept_class": "concept_class_id concept_class_name concept_class_concept_id",
+    "concept_relationship": (
+        "concept_id_1 concept_id_2 relationship_id valid_start_date "
+        "valid_end_date invalid_reason"
+    ),
+    "relationship": (
+        "relationship_id relationship_name is_hierarchical defines_ancestry "
+        "reverse_relationship_id relationship_concept_id"
+    ),
+    "concept_synonym": "concept_id concept_synonym_name language_concept_id",
+    "concept_ancestor": (
+        "ancestor_concept_id descendant_concept_id min_levels_of_separation "
+        "max_levels_of_separation"
+    ),
+    "source_to_concept_map": (
+        "source_code source_concept_id source_vocabulary_id "
+        "source_code_description target_concept_id target_vocabulary_id "
+        "valid_start_date valid_end_date invalid_reason"
+    ),
+    "drug_strength": (
+        "drug_concept_id ingredient_concept_id amount_value "
+        "amount_unit_concept_id numerator_value numerator_unit_concept_id "
+        "denominator_value denominator_unit_concept_id box_size "
+        "valid_start_date valid_end_date invalid_reason"
+    ),
+}
+
+# Columns on which the OHDSI DDL creates indexes
+INDEXES = {
+    "person": ("person_id",),
+    "observation_period": ("person_id",),
+    "visit_occurrence": ("person_id", "visit_concept_id"),
+    "condition_occurrence": ("person_id", "condition_concept_id"),
+    "drug_exposure": ("person_id", "drug_concept_id"),
+    "procedure_occurrence": ("person_id", "procedure_concept_id"),
+    "device_exposure": ("person_id", "device_concept_id"),
+    "measurement": ("person_id", "measurement_concept_id"),
+    "observation": ("person_id", "observation_concept_id"),
+    "death": ("person_id",),
+    "drug_era": ("person_id", "drug_concept_id"),
+    "condition_era": ("person_id", "condition_concept_id"),
+    "concept": ("concept_id", "concept_code"),
+    "concept_relationship": ("concept_id_1", "concept_id_2"),
+    "concept_synonym": ("concept_id",),
+    "concept_ancestor": ("ancestor_concept_id", "descendant_concept_id"),
+}
+
+# Columns that are named as ids, but contain codes
+TEXT_COLUMNS = {
+    "vocabulary_id", "domain_id", "concept_class_id", "relationship_id",
+    "reverse_relationship_id", "source_vocabulary_id", "target_vocabulary_id",
+    "unique_device_id", "production_id", "specimen_source_id",
+}
+REAL_COLUMNS = {
+    "quantity", "value_as_number", "range_low", "range_high", "latitude",
+    "longitude", "dose_value", "amount_value", "numerator_value",
+    "denominator_value",
+}
+
+EPOCH = datetime.date(1970, 1, 1)
+FIRST_DAY = (datetime.date(2000, 1, 1) - EPOCH).days
+LAST_DAY = (datetime.date(2023, 12, 31) - EPOCH).days
+
+# Concepts that every CDM needs, with their real concept ids
+EHR = 32817
+MALE, FEMALE = 8507, 8532
+RACES = (8527, 8516, 8515)
+ETHNICITIES = (38003563, 38003564)
+INPATIENT, OUTPATIENT, EMERGENCY = 9201, 9202, 9203
+MG_PER_DL = 8840
+ENGLISH = 4180186
+FIXED_CONCEPTS = [
+    (EHR, "EHR", "Type Concept", "Type Concept", "Type Concept"),
+    (MALE, "MALE", "Gender", "Gender", "Gender"),
+    (FEMALE, "FEMALE", "Gender", "Gender", "Gender"),
+    (8527, "White", "Race", "Race", "Race"),
+    (8516, "Black or African American", "Race", "Race", "Race"),
+    (8515, "Asian", "Race", "Race", "Race"),
+    (38003563, "Hispanic or Latino", "Ethnicity", "Ethnicity", "Ethnicity"),
+    (38003564, "Not Hispanic or Latino", "Ethnicity", "Ethnicity", "Ethnicity"),
+    (INPATIENT, "Inpatient Visit", "Visit", "Visit", "Visit"),
+    (OUTPATIENT, "Outpatient Visit", "Visit", "Visit", "Visit"),
+    (EMERGENCY, "Emergency Room Visit", "Visit", "Visit", "Visit"),
+    (MG_PER_DL, "milligram per deciliter", "Unit", "UCUM", "Unit"),
+]
+
+# Background concepts: domain, vocabulary, concept class and how many
+# concepts of the domain are generated per --concepts
+BACKGROUND = (
+    ("Condition", "SNOMED", "Clinical Finding", 0.35),
+    ("Drug", "RxNorm", "Clinical Drug", 0.25),
+    ("Procedure", "SNOMED", "Procedure", 0.15),
+    ("Measurement", "LOINC", "Lab Test", 0.1),
+    ("Observation", "SNOMED", "Observable Entity", 0.1),
+    ("Device", "SNOMED", "Physical Object", 0.05),
+)
+# Number of concepts under a synthetic parent concept
+GROUP_SIZE = 50
+# Allowed gap between two occurrences of an era, like the OHDSI era scripts
+ERA_PAD = 30
+LOCAL_CONCEPT_ID = 2_000_000_000
+
+# Number of persons that are generated before their rows are written
+BATCH_PERSONS = 5000
+
+
+def _epoch(day):
+    # SqlRender stores SQLite dates as seconds since 1970-01-01
+    return day * 86400.0
+
+
+def _cohort_concepts(cohort_definitions):
+    """Returns the concepts of the concept sets of the cohort definitions."""
+    concepts = {}
+    for definition in cohort_definitions:
+        for concept_set in definition.get("ConceptSets") or []:
+            for item in concept_set["expression"].get("items", []):
+                concept = item["concept"]
+                concepts[concept["CONCEPT_ID"]] = concept
+    return list(concepts.values())
+
+
+class Vocabulary:
+    """The concepts of the synthetic CDM and their relations."""
+
+    def __init__(self, cohort_concepts, concepts, rng):
+        self.concepts = []
+        self.relationships = []
+        self.ancestors = []
+        self.next_id = itertools.count(LOCAL_CONCEPT_ID + 1)
+
+        for concept in FIXED_CONCEPTS:
+            self._add(*concept, standard="S")
+
+        # the background concepts, per domain
+        self.domains = {}
+        self.parents = {}
+        self.ingredients = {}
+        for domain, vocabulary, concept_class, share in BACKGROUND:
+            count = max(int(concepts * share), 1)
+            ids = []
+            for group in range(0, count, GROUP_SIZE):
+                parent = self._add(
+                    next(self.next_id),
+                    f"Synthetic {domain.lower()} group {group // GROUP_SIZE}",
+                    domain,
+                    vocabulary,
+                    "Ingredient" if domain == "Drug" else concept_class,
+                    standard="C" if domain != "Drug" else "S",
+                )
+                self.parents.setdefault(domain, parent)
+                for _ in range(min(GROUP_SIZE, count - group)):
+                    concept_id = self._add(
+                        next(self.next_id),
+                        f"Synthetic {domain.lower()} {len(ids)}",
+                        domain,
+                        vocabulary,
+                        concept_class,
+                        standard="S",
+                        parent=parent,
+                    )
+                    ids.append(concept_id)
+                    if domain == "Drug":
+                        self.ingredients[concept_id] = parent
+            # frequencies follow Zipf's law, like in real data
+            rng.shuffle(ids)
+            weights = list(itertools.accumulate(1 / rank for rank in range(1, len(ids) + 1)))
+            self.domains[domain] = (ids, weights)
+
+        # the concepts of the cohort definitions hang under a synthetic parent,
+        # next to background concepts, so orphan concept analysis finds them
+        self.cohort_concepts = []
+        for concept in cohort_concepts:
+            domain = concept.get("DOMAIN_ID", "Condition")
+            concept_id = self._add(
+                concept["CONCEPT_ID"],
+                concept.get("CONCEPT_NAME", str(concept["CONCEPT_ID"])),
+                domain,
+                concept.get("VOCABULARY_ID", "SNOMED"),
+                concept.get("CONCEPT_CLASS_ID", "Clinical Finding"),
+                standard=concept.get("STANDARD_CONCEPT") or None,
+                code=concept.get("CONCEPT_CODE"),
+                parent=self.parents.get(domain, self.parents["Condition"]),
+            )
+            self.cohort_concepts.append((concept_id, domain))
+
+        # source concepts that map to the standard concepts, for the included
+        # source concepts diagnostic
+        self.source_concepts = {}
+        for concept_id, name, domain, vocabulary, _, standard, _ in list(self.concepts):
+            if standard != "S" or domain not in self.domains:
+                continue
+            source_id = self._add(
+                next(self.next_id),
+                f"{name} (source)",
+                domain,
+                "Synthetic source",
+                "Source code",
+            )
+            self.source_concepts[concept_id] = source_id
+            self.relationships.append((source_id, concept_id, "Maps to"))
+            self.relationships.append((concept_id, source_id, "Mapped from"))
+
+    def _add(
+        self,
+        concept_id,
+        name,
+        domain,
+        vocabulary,
+        concept_class,
+        standard=None,
+        code=None,
+        parent=None,
+    ):
+        self.concepts.append(
+            (concept_id, name, domain, vocabulary, concept_class, standard, code or str(concept_id))
+        )
+        if standard in ("S", "C"):
+            self.ancestors.append((concept_id, concept_id, 0, 0))
+        if parent is not None:
+            self.ancestors.append((parent, concept_id, 1, 1))
+            self.relationships.append((concept_id, parent, "Is a"))
+            self.relationships.append((parent, concept_id, "Subsumes"))
+        return concept_id
+
+    def rows(self):
+        """Returns the rows of the vocabulary tables."""
+        start, end = _epoch(0), _epoch((datetime.date(2099, 12, 31) - EPOCH).days)
+        concepts = [(*concept, start, end, None) for concept in self.concepts]
+        vocabularies = sorted({concept[3] for concept in self.concepts})
+        domains = sorted({concept[2] for concept in self.concepts})
+        classes = sorted({concept[4] for concept in self.concepts})
+        return {
+            "concept": concepts,
+            "concept_synonym": [(concept[0], concept[1], ENGLISH) for concept in self.concepts],
+            "concept_ancestor": self.ancestors,
+            "concept_relationship": [
+                (concept_id_1, concept_id_2, relationship, start, end, None)
+                for concept_id_1, concept_id_2, relationship in self.relationships
+            ],
+            "vocabulary": [(v, v, "synthetic", "synthetic", 0) for v in vocabularies],
+            "domain": [(d, d, 0) for d in domains],
+            "concept_class": [(c, c, 0) for c in classes],
+            "relationship": [
+                ("Maps to", "Non-standard to Standard map", "0", "0", "Mapped from", 44818977),
+                ("Mapped from", "Standard to Non-standard map", "0", "0", "Maps to", 44818976),
+                ("Is a", "Is a", "1", "1", "Subsumes", 44818821),
+                ("Subsumes", "Subsumes", "1", "1", "Is a", 44818723),
+            ],
+        }
+
+    def pick(self, rng, domain):
+        """Picks a background concept of a domain."""
+        ids, weights = self.domains[domain]
+        return rng.choices(ids, cum_weights=weights)[0]
+
+
+class Generator:
+    """Generates the clinical data of the persons of the synthetic CDM."""
+
+    def __init__(self, vocabulary, rng, visits_per_year, prevalence):
+        self.vocabulary = vocabulary
+        self.rng = rng
+        self.visits_per_year = visits_per_year
+        self.prevalence = prevalence
+        self.ids = {table: itertools.count(1) for table in TABLES}
+
+    def person(self, person_id, rows):
+        """Adds the rows of one person to ``rows``."""
+        rng = self.rng
+        gender = rng.choice((MALE, FEMALE))
+        year_of_birth = rng.randint(1930, 2005)
+        birth_day = (datetime.date(year_of_birth, rng.randint(1, 12), 1) - EPOCH).days
+        rows["person"].append((
+            person_id, gender, year_of_birth, rng.choice(RACES), rng.choice(ETHNICITIES),
+            str(person_id), "M" if gender == MALE else "F",
+        ))
+
+        start = max(rng.randint(FIRST_DAY, LAST_DAY - 365), birth_day)
+        end = min(start + rng.randint(365, 15 * 365), LAST_DAY)
+        rows["observation_period"].append(
+            (next(self.ids["observation_period"]), person_id, _epoch(start), _epoch(end), EHR)
+        )
+
+        years = (end - start) / 365
+        visit_count = max(1, round(rng.expovariate(1 / (self.visits_per_year * years))))
+        visit_days = sorted(rng.randint(start, end) for _ in range(visit_count))
+        visits = []
+        for day in visit_days:
+            visit_id = next(self.ids["visit_occurrence"])
+            visit_concept = rng.choices((OUTPATIENT, INPATIENT, EMERGENCY), (80, 15, 5))[0]
+            visit_end = min(day + (rng.randint(1, 10) if visit_concept == INPATIENT else 0), end)
+            rows["visit_occurrence"].append((
+                visit_id, person_id, visit_concept, _epoch(day), _epoch(day),
+                _epoch(visit_end), _epoch(visit_end), EHR,
+            ))
+            visits.append((visit_id, day))
+
+        conditions = []
+        drugs = []
+        for visit_id, day in visits:
+            for _ in range(rng.choices((0, 1, 2, 3), (20, 45, 25, 10))[0]):
+                conditions.append((self.vocabulary.pick(rng, "Condition"), day, visit_id))
+            for _ in range(rng.choices((0, 1, 2), (50, 35, 15))[0]):
+                drugs.append((self.vocabulary.pick(rng, "Drug"), day, visit_id, rng.choice((7, 30, 30, 90))))
+            for _ in range(rng.choices((0, 1), (70, 30))[0]):
+                self._procedure(person_id, self.vocabulary.pick(rng, "Procedure"), day, visit_id, rows)
+            for _ in range(rng.choices((0, 1, 2), (50, 30, 20))[0]):
+                self._measurement(person_id, self.vocabulary.pick(rng, "Measurement"), day, visit_id, rows)
+            if rng.random() < 0.2:
+                self._observation(person_id, self.vocabulary.pick(rng, "Observation"), day, visit_id, rows)
+            if rng.random() < 0.03:
+                self._device(person_id, self.vocabulary.pick(rng, "Device"), day, visit_id, rows)
+
+        # the concepts of the cohorts, first recorded at a random visit and
+        # often recorded again at later visits
+        if self.vocabulary.cohort_concepts and rng.random() < self.prevalence:
+            concept_id, domain = rng.choice(self.vocabulary.cohort_concepts)
+            first = rng.randrange(len(visits))
+            repeats = [first] + sorted(
+                rng.randrange(first, len(visits)) for _ in range(rng.randint(0, 5))
+            )
+            for index in repeats:
+                visit_id, day = visits[index]
+                if domain == "Observation":
+                    self._observation(person_id, concept_id, day, visit_id, rows)
+                else:
+                    conditions.append((concept_id, day, visit_id))
+
+        for concept_id, day, visit_id in conditions:
+            rows["condition_occurrence"].append((
+                next(self.ids["condition_occurrence"]), person_id, concept_id,
+                _epoch(day), _epoch(day), EHR, visit_id,
+                self.vocabulary.source_concepts.get(concept_id, 0),
+            ))
+        for concept_id, day, visit_id, days_supply in drugs:
+            rows["drug_exposure"].append((
+                next(self.ids["drug_exposure"]), person_id, concept_id,
+                _epoch(day), _epoch(day), _epoch(day + days_supply - 1),
+                _epoch(day + days_supply - 1), EHR, days_supply, float(days_supply),
+                visit_id, self.vocabulary.source_concepts.get(concept_id, 0),
+            ))
+
+        self._eras(person_id, conditions, drugs, rows)
+        if rng.random() < 0.015:
+            rows["death"].append((person_id, _epoch(end), _epoch(end), EHR))
+
+    def _procedure(self, person_id, concept_id, day, visit_id, rows):
+        rows["procedure_occurrence"].append((
+            next(self.ids["procedure_occurrence"]), person_id, concept_id,
+            _epoch(day), _epoch(day), EHR, visit_id,
+            self.vocabulary.source_concepts.get(concept_id, 0),
+        ))
+
+    def _measurement(self, person_id, concept_id, day, visit_id, rows):
+        rows["measurement"].append((
+            next(self.ids["measurement"]), person_id, concept_id,
+            _epoch(day), _epoch(day), EHR, round(self.rng.gauss(100, 20), 1),
+            MG_PER_DL, 70.0, 130.0, visit_id,
+            self.vocabulary.source_concepts.get(concept_id, 0),
+        ))
+
+    def _observation(self, person_id, concept_id, day, visit_id, rows):
+        rows["observation"].append((
+            next(self.ids["observation"]), person_id, concept_id,
+            _epoch(day), _epoch(day), EHR, visit_id,
+            self.vocabulary.source_concepts.get(concept_id, 0),
+        ))
+
+    def _device(self, person_id, concept_id, day, visit_id, rows):
+        rows["device_exposure"].append((
+            next(self.ids["device_exposure"]), person_id, concept_id,
+            _epoch(day), _epoch(day), EHR, visit_id,
+            self.vocabulary.source_concepts.get(concept_id, 0),
+        ))
+
+    def _eras(self, person_id, conditions, drugs, rows):
+        # condition eras per condition concept
+        starts = {}
+        for concept_id, day, _ in conditions:
+            starts.setdefault(concept_id, []).append((day, day))
+        for concept_id, era in _merge(starts):
+            rows["condition_era"].append((
+                next(self.ids["condition_era"]), person_id, concept_id,
+                _epoch(era[0]), _epoch(era[1]), era[2],
+            ))
+
+        # drug eras per ingredient
+        exposures = {}
+        for concept_id, day, _, days_supply in drugs:
+            ingredient = self.vocabulary.ingredients[concept_id]
+            exposures.setdefault(ingredient, []).append((day, day + days_supply - 1))
+        for concept_id, era in _merge(exposures):
+            rows["drug_era"].append((
+                next(self.ids["drug_era"]), person_id, concept_id,
+                _epoch(era[0]), _epoch(era[1]), era[2], era[3],
+            ))
+
+
+def _merge(periods):
+    """Merges the periods per concept into eras.
+
+    Yields the concept id and the start, end, number of periods and the number
+    of days between the periods of each era.
+    """
+    for concept_id, spans in periods.items():
+        spans.sort()
+        start, end = spans[0]
+        count, gap = 1, 0
+        for span_start, span_end in spans[1:]:
+            if span_start <= end + ERA_PAD:
+                gap += max(span_start - end - 1, 0)
+                end = max(end, span_end)
+                count += 1
+                continue
+            yield concept_id, (start, end, count, gap)
+            start, end = span_start, span_end
+            count, gap = 1, 0
+        yield concept_id, (start, end, count, gap)
+
+
+# The columns that the generator fills, the other columns are NULL
+GENERATED_COLUMNS = {
+    "person": (
+        "person_id gender_concept_id year_of_birth race_concept_id "
+        "ethnicity_concept_id person_source_value gender_source_value"
+    ),
+    "observation_period": TABLES["observation_period"],
+    "visit_occurrence": (
+        "visit_occurrence_id person_id visit_concept_id visit_start_date "
+        "visit_start_datetime visit_end_date visit_end_datetime "
+        "visit_type_concept_id"
+    ),
+    "condition_occurrence": (
+        "condition_occurrence_id person_id condition_concept_id "
+        "condition_start_date condition_start_datetime "
+        "condition_type_concept_id visit_occurrence_id "
+        "condition_source_concept_id"
+    ),
+    "drug_exposure": (
+        "drug_exposure_id person_id drug_concept_id drug_exposure_start_date "
+        "drug_exposure_start_datetime drug_exposure_end_date "
+        "drug_exposure_end_datetime drug_type_concept_id days_supply quantity "
+        "visit_occurrence_id drug_source_concept_id"
+    ),
+    "procedure_occurrence": (
+        "procedure_occurrence_id person_id procedure_concept_id procedure_date "
+        "procedure_datetime procedure_type_concept_id visit_occurrence_id "
+        "procedure_source_concept_id"
+    ),
+    "measurement": (
+        "measurement_id person_id measurement_concept_id measurement_date "
+        "measurement_datetime measurement_type_concept_id value_as_number "
+        "unit_concept_id range_low range_high visit_occurrence_id "
+        "measurement_source_concept_id"
+    ),
+    "observation": (
+        "observation_id person_id observation_concept_id observation_date "
+        "observation_datetime observation_type_concept_id visit_occurrence_id "
+        "observation_source_concept_id"
+    ),
+    "device_exposure": (
+        "device_exposure_id person_id device_concept_id "
+        "device_exposure_start_date device_exposure_start_datetime "
+        "device_type_concept_id visit_occurrence_id device_source_concept_id"
+    ),
+    "death": "person_id death_date death_datetime death_type_concept_id",
+    "condition_era": TABLES["condition_era"],
+    "drug_era": TABLES["drug_era"],
+}
+
+
+def _column_type(column):
+    if column in TEXT_COLUMNS:
+        return "TEXT"
+    if column in REAL_COLUMNS or column.endswith(("_date", "_datetime")):
+        return "REAL"
+    if column.endswith(("_id", "_id_1", "_id_2", "_count")) or column in (
+        "year_of_birth", "month_of_birth", "day_of_birth", "refills",
+        "days_supply", "gap_days", "box_size",
+    ):
+        return "INTEGER"
+    return "TEXT"
+
+
+def _insert(connection, table, rows, columns=None):
+    columns = (columns or TABLES[table]).split()
+    connection.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' * len(columns))})",
+        rows,
+    )
+
+
+def generate(
+    path,
+    persons,
+    seed=0,
+    concepts=2000,
+    visits_per_year=1.0,
+    prevalence=0.05,
+    cohort_definitions=None,
+):
+    """Generates a synthetic OMOP CDM database.
+
+    Parameters
+    ----------
+    path : Path
+        The SQLite database to create. An existing database is replaced.
+    persons : int
+        Number of persons.
+    seed : int, optional
+        Seed of the random generator.
+    concepts : int, optional
+        Number of synthetic background concepts.
+    visits_per_year : float, optional
+        Mean number of visits per person per year of observation.
+    prevalence : float, optional
+        Fraction of the persons that have a concept of the cohort definitions.
+    cohort_definitions : list[dict], optional
+        The cohort definitions whose concepts are used. By default, those in
+        the ``cohort_definitions`` folder of the repository.
+
+    Returns
+    -------
+    dict
+        The number of rows per table.
+    """
+    if cohort_definitions is None:
+        cohort_definitions = [
+            json.loads(file_.read_text()) for file_ in sorted(COHORT_DEFINITIONS.glob("*.json"))
+        ]
+    rng = random.Random(seed)
+    vocabulary = Vocabulary(_cohort_concepts(cohort_definitions), concepts, rng)
+    generator = Generator(vocabulary, rng, visits_per_year, prevalence)
+
+    path = Path(path)
+    if path.exists():
+        path.unlink()
+    connection = sqlite3.connect(path)
+    counts = dict.fromkeys(TABLES, 0)
+    try:
+        # the database is created from scratch, so there is nothing to recover
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        for table, columns in TABLES.items():
+            definition = ", ".join(f"{column} {_column_type(column)}" for column in columns.split())
+            connection.execute(f"CREATE TABLE {table} ({definition})")
+
+        for table, rows in vocabulary.rows().items():
+            _insert(connection, table, rows)
+            counts[table] = len(rows)
+        today = _epoch((datetime.date.today() - EPOCH).days)
+        _insert(connection, "cdm_source", [(
+            "Synthetic CDM", "SYNTHETIC", "v6-omop-cohort-diagnostics",
+            f"{persons} synthetic persons, seed {seed}", None, None, today, today,
+            "v5.4", 756265, "synthetic",
+        )])
+        counts["cdm_source"] = 1
+
+        rows = {table: [] for table in GENERATED_COLUMNS}
+        for person_id in range(1, persons + 1):
+            generator.person(person_id, rows)
+            if person_id % BATCH_PERSONS == 0 or person_id == persons:
+                for table, table_rows in rows.items():
+                    _insert(connection, table, table_rows, GENERATED_COLUMNS[table])
+                    counts[table] += len(table_rows)
+                    table_rows.clear()
+                connection.commit()
+
+        # indexes are created after loading, which is much faster than
+        # maintaining them during the inserts
+        for table, columns in INDEXES.items():
+            for column in columns:
+                connection.execute(f"CREATE INDEX idx_{table}_{column} ON {table} ({column})")
+        connection.execute("ANALYZE")
+        connection.commit()
+    finally:
+        connection.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("database", type=Path, help="SQLite database to create")
+    parser.add_argument("--persons", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concepts", type=int, default=2000, help="Number of background concepts")
+    parser.add_argument("--visits-per-year", type=float, default=1.0)
+    parser.add_argument(
+        "--prevalence",
+        type=float,
+        default=0.05,
+        help="Fraction of the persons with a concept of the cohort definitions",
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = generate(
+        args.database,
+        args.persons,
+        seed=args.seed,
+        concepts=args.concepts,
+        visits_per_year=args.visits_per_year,
+        prevalence=args.prevalence,
+    )
+    print(
+        f"Generated {sum(counts.values())} rows for {args.persons} persons in "
+        f"{time.perf_counter() - start:.1f}s into {args.database}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,20 @@
 import os
+import re
 import sys
 import json
+import csv
 import base64
+import zipfile
 import argparse
 import subprocess
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 
+from merge_results import MERGED_FILE_NAME, merge_results
+
+_WHITESPACE = re.compile(r'\s*')
+
 
 def parse_arguments():
     """Parse command line arguments."""
@@ -17,6 +25,66 @@ def parse_arguments():
         default='./results',
         help='Path where results will be saved (default: ./results)'
     )
+    parser.add_argument(
+        '--result-format',
+        choices=['csv', 'parquet'],
+        default='csv',
+        help='Format in which the nodes send their results. Parquet results are smaller and are '
+             'converted back to CSV after download (default: csv)'
+    )
+    parser.add_argument(
+        '--deadline-seconds',
+        type=float,
+        default=None,
+        help='Stop waiting for the nodes after this many seconds and save the results that are in '
+             '(default: wait for all nodes)'
+    )
+    parser.add_argument(
+        '--two-phase',
+        action='store_true',
+        help='First run a summary task with the cohort counts and inclusion statistics, and save its '
+             'results to the summary folder. Then run a second task with the other diagnostics. The '
+             'tasks run one after the other'
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only estimate the cost of the diagnostics on every node, and save the estimates to '
+             'preflight.json without running the diagnostics'
+    )
+    parser.add_argument(
+        '--budget-policy',
+        choices=['none', 'enforce'],
+        default='none',
+        help="With 'enforce', every node reduces the diagnostics to fit within its time budget "
+             "(default: none)"
+    )
+    parser.add_argument(
+        '--covariate-budget',
+        type=int,
+        default=None,
+        help='Keep at most this many of the most prevalent concepts per covariate domain. This also '
+             'enables the drug exposure covariates, which have too many concepts without a budget '
+             '(default: keep all concepts)'
+    )
+    parser.add_argument(
+        '--precompile',
+        action='store_true',
+        help='Compile the cohort definitions once in the central step, which reports invalid '
+             'definitions before the nodes start but starts R and the JVM in the central container '
+             '(default: every node compiles them)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Number of organizations whose results are saved in parallel (default: 4)'
+    )
+    parser.add_argument(
+        '--merge',
+        action='store_true',
+        help=f'Merge the results of all organizations into {MERGED_FILE_NAME}, without R.'
+    )
     parser.add_argument(
         '--prepare-r',
         action='store_true',  # This makes it a flag, e.g., --prepare-r
@@ -190,27 +258,35 @@ def main():
         names = [file_.stem for file_ in files]
         print(f"Loaded {len(files)} cohort definitions: {names}")
 
+        if args.two_phase and not args.dry_run:
+            # The summary is small and fast, and is saved before the
+            # characterization starts
+            print("Phase 1: cohort counts and inclusion statistics")
+            result_json = execute_cohort_diagnostics(algorithm_image, client, collaboration_id, names, omop_jsons,
+                                                     organisations_to_include, main_process_organisation_id,
+                                                     args.result_format, args.deadline_seconds,
+                                                     budget_policy=args.budget_policy, phase='summary',
+                                                     covariate_budget=args.covariate_budget,
+                                                     precompile=args.precompile)
+            save_results(result_json, output_path / 'summary', args)
+            # the inclusion statistics are in the summary, so the second task
+            # only runs the other diagnostics
+            print("Phase 2: other diagnostics")
+
+        phase = 'detail' if args.two_phase and not args.dry_run else 'full'
         result_json = execute_cohort_diagnostics(algorithm_image, client, collaboration_id, names, omop_jsons,
-                                                 organisations_to_include, main_process_organisation_id)
-
-        if result_json and 'data' in result_json and len(result_json['data']) > 0 and 'result' in result_json['data'][0]:
-            print("Extracting zip data from results...")
-            result_data = result_json['data'][0]['result']
-            parsed_results = json.loads(result_data)
-
-            for parsed_result in parsed_results:
-                if isinstance(parsed_result, dict) and len(parsed_result) > 0 and 'organization_id' in parsed_result and 'zip' in parsed_result:
-                    zip_data_encoded = parsed_result['zip']
-                    zip_data = base64.b64decode(zip_data_encoded)
-                    output_file = Path(output_data_path, 'org_' + str(parsed_result['organization_id']) + '.zip')
-                    print(f"Saving results to: {output_file}")
-                    with open(output_file, 'wb') as f:
-                        f.write(zip_data)
-                    print(f"Results saved to: {output_file}")
-                else:
-                    raise ValueError("No zip data found in parsed results")
-        else:
-            raise ValueError("No data found in results or invalid result structure")
+                                                 organisations_to_include, main_process_organisation_id,
+                                                 args.result_format, args.deadline_seconds, args.dry_run,
+                                                 args.budget_policy, phase=phase,
+                                                 covariate_budget=args.covariate_budget,
+                                                 precompile=args.precompile)
+        save_results(result_json, output_path, args)
+
+        if args.merge:
+            merged_file = output_data_path / MERGED_FILE_NAME
+            print(f"Merging results into: {merged_file}")
+            counts = merge_results(output_data_path.glob('org_*.zip'), merged_file)
+            print(f"Merged {sum(counts.values())} rows in {len(counts)} tables")
 
         # Prepare R environment (renv) for Shiny app
         if args.prepare_r:
@@ -221,7 +297,258 @@ def main():
         sys.exit(1)
 
 
-def execute_cohort_diagnostics(algorithm_image, client, collaboration_id, names, omop_jsons, organisations_to_include, main_process_organisation_id):
+def save_results(result_json, output_path, args):
+    """Saves the results zips, metrics and pre-flight estimates of all organizations."""
+    output_data_path = output_path / "data"
+    output_data_path.mkdir(parents=True, exist_ok=True)
+    if result_json and 'data' in result_json and len(result_json['data']) > 0 and 'result' in result_json['data'][0]:
+        print("Extracting zip data from results...")
+        result_data = result_json['data'][0]['result']
+
+        # The whole encoded result is already in memory, as the vantage6 client
+        # returns it as one string. Only the decoding is incremental: the
+        # organizations are parsed one at a time and their zips are decoded
+        # straight to disk, in parallel, one chunk at a time
+        parsed_results = []
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            futures = []
+            for parsed_result in iter_node_results(result_data):
+                if isinstance(parsed_result, dict) and parsed_result.get('status') == 'timed_out':
+                    print(f"Organization {parsed_result['organization_id']} did not finish before the "
+                          f"deadline, no results saved")
+                    continue
+                if isinstance(parsed_result, dict) and parsed_result.get('status') == 'failed':
+                    print(f"Organization {parsed_result['organization_id']} failed with status "
+                          f"'{parsed_result['run_status']}', no results saved. Log:\n{parsed_result['log']}")
+                    continue
+                if isinstance(parsed_result, dict) and 'studies' in parsed_result:
+                    # a batch result has a results zip per study, which are
+                    # saved in a folder per study
+                    for i, study in enumerate(parsed_result['studies']):
+                        study = {**study, 'organization_id': parsed_result['organization_id']}
+                        if 'preflight' in study:
+                            print_preflight(study)
+                        if 'zip_spans' in study:
+                            study_data_path = output_path / f"study_{i}" / "data"
+                            study_data_path.mkdir(parents=True, exist_ok=True)
+                            futures.append(pool.submit(save_result, result_data, study, study_data_path))
+                    parsed_results.append(parsed_result)
+                    continue
+                if isinstance(parsed_result, dict) and 'preflight' in parsed_result:
+                    print_preflight(parsed_result)
+                    if args.dry_run:
+                        parsed_results.append(parsed_result)
+                        continue
+                if isinstance(parsed_result, dict) and 'organization_id' in parsed_result and 'zip_spans' in parsed_result:
+                    futures.append(pool.submit(save_result, result_data, parsed_result, output_data_path))
+                    parsed_results.append(parsed_result)
+                else:
+                    raise ValueError("No zip data found in parsed results")
+            for future in as_completed(futures):
+                future.result()
+
+        save_metrics(parsed_results, output_path / 'metrics.csv')
+        save_preflight(parsed_results, output_path / 'preflight.json')
+    else:
+        raise ValueError("No data found in results or invalid result structure")
+
+
+def iter_node_results(result_data):
+    """Parses the result of the central task one organization at a time.
+
+    The base64-encoded zip chunks are neither decoded nor copied. Instead, their
+    positions in ``result_data`` are returned in 'zip_spans', so that they can
+    be decoded one by one by ``save_zip``. Nodes send the zip as a list of chunks
+    ('zip_chunks'), results of older versions of the algorithm contain a single
+    encoded string ('zip'). The results of a batch task have the zip of every
+    study in their 'studies' list, which is parsed the same way.
+    """
+    decoder = json.JSONDecoder()
+    index = _expect(result_data, 0, '[')
+    if result_data[_skip(result_data, index)] == ']':
+        return
+    while True:
+        parsed_result, index = _parse_node_result(result_data, _skip(result_data, index), decoder)
+        yield parsed_result
+        index = _skip(result_data, index)
+        if result_data[index] == ']':
+            return
+        index = _expect(result_data, index, ',')
+
+
+def _skip(text, index):
+    return _WHITESPACE.match(text, index).end()
+
+
+def _expect(text, index, character):
+    index = _skip(text, index)
+    if text[index:index + 1] != character:
+        raise ValueError(f"Invalid result, expected '{character}' at position {index}")
+    return index + 1
+
+
+def _parse_node_result(text, index, decoder):
+    if text[index] != '{':
+        return decoder.raw_decode(text, index)
+    parsed_result = {}
+    index = _skip(text, index + 1)
+    if text[index] == '}':
+        return parsed_result, index + 1
+    while True:
+        key, index = decoder.raw_decode(text, _skip(text, index))
+        index = _skip(text, _expect(text, index, ':'))
+        if key in ('zip', 'zip_chunks'):
+            parsed_result['zip_spans'], index = _string_spans(text, index, key == 'zip_chunks')
+        elif key == 'studies':
+            parsed_result[key], index = _parse_list(text, index, decoder)
+        else:
+            parsed_result[key], index = decoder.raw_decode(text, index)
+        index = _skip(text, index)
+        if text[index] == '}':
+            return parsed_result, index + 1
+        index = _expect(text, index, ',')
+
+
+def _parse_list(text, index, decoder):
+    items = []
+    index = _skip(text, _expect(text, index, '['))
+    if text[index] == ']':
+        return items, index + 1
+    while True:
+        item, index = _parse_node_result(text, _skip(text, index), decoder)
+        items.append(item)
+        index = _skip(text, index)
+        if text[index] == ']':
+            return items, index + 1
+        index = _expect(text, index, ',')
+
+
+def _string_spans(text, index, is_list):
+    # base64 contains neither quotes nor escapes, so a string ends at the next
+    # quote. save_zip validates the content.
+    spans = []
+    if is_list:
+        index = _skip(text, _expect(text, index, '['))
+        if text[index] == ']':
+            return spans, index + 1
+    while True:
+        start = _expect(text, index, '"')
+        end = text.index('"', start)
+        spans.append((start, end))
+        if not is_list:
+            return spans, end + 1
+        index = _skip(text, end + 1)
+        if text[index] == ']':
+            return spans, index + 1
+        index = _expect(text, index, ',')
+
+
+def save_result(result_data, parsed_result, output_data_path):
+    """Saves the results zip of one organization, as CSV files."""
+    output_file = Path(output_data_path, 'org_' + str(parsed_result['organization_id']) + '.zip')
+    print(f"Saving results to: {output_file}")
+    if parsed_result.get('format') == 'parquet':
+        parquet_file = output_file.with_suffix('.parquet.zip')
+        save_zip(result_data, parsed_result['zip_spans'], parquet_file)
+        parquet_zip_to_csv(parquet_file, output_file)
+        # only CSV zips may be in the data folder for the R merge
+        os.remove(parquet_file)
+    else:
+        save_zip(result_data, parsed_result['zip_spans'], output_file)
+    print(f"Results saved to: {output_file}")
+
+
+def save_zip(result_data, spans, output_file):
+    """Decodes the results zip of one organization and writes it to disk.
+
+    The zip consists of the base64-encoded chunks at ``spans`` in
+    ``result_data``, which are decoded and written one by one.
+    """
+    with open(output_file, 'wb') as f:
+        for start, end in spans:
+            f.write(base64.b64decode(result_data[start:end], validate=True))
+
+
+def save_metrics(parsed_results, output_file):
+    """Writes the per-phase timing and memory usage of all nodes to a CSV file."""
+    rows = [
+        {'organization_id': parsed_result['organization_id'], **phase}
+        for parsed_result in parsed_results
+        if 'metrics' in parsed_result
+        for phase in parsed_result['metrics']['phases']
+    ]
+    if not rows:
+        return
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Node metrics saved to: {output_file}")
+
+
+def print_preflight(parsed_result):
+    """Prints the estimated cost of the diagnostics of one organization."""
+    preflight = parsed_result['preflight']
+    estimate = preflight['estimate']
+    print(f"Organization {parsed_result['organization_id']}: diagnostics estimated at "
+          f"{estimate['total_seconds']:.0f}s")
+    for flag, seconds in sorted(estimate['diagnostics'].items(), key=lambda item: -item[1]):
+        print(f"  {flag}: {seconds:.0f}s")
+    plan = preflight.get('plan')
+    if plan:
+        print(f"  reduced to {plan['planned_seconds']:.0f}s to fit the budget of "
+              f"{preflight['budget_seconds']:.0f}s, dropped covariates: "
+              f"{', '.join(plan['dropped_covariates']) or '-'}, skipped diagnostics: "
+              f"{', '.join(plan['skipped_diagnostics']) or '-'}")
+
+
+def save_preflight(parsed_results, output_file):
+    """Writes the pre-flight reports of all nodes to a JSON file."""
+    reports = {}
+    for parsed_result in parsed_results:
+        if 'preflight' in parsed_result:
+            reports[str(parsed_result['organization_id'])] = parsed_result['preflight']
+        elif 'studies' in parsed_result:
+            studies = {
+                study['name']: study['preflight'] for study in parsed_result['studies'] if 'preflight' in study
+            }
+            if studies:
+                reports[str(parsed_result['organization_id'])] = studies
+    if not reports:
+        return
+    with open(output_file, 'w') as f:
+        json.dump(reports, f, indent=2)
+    print(f"Pre-flight estimates saved to: {output_file}")
+
+
+def parquet_zip_to_csv(source, target):
+    """Converts the Parquet files in a results zip back to CSV files.
+
+    The nodes store all columns as strings, so the CSV files are equivalent to
+    the ones exported by CohortDiagnostics.
+    """
+    try:
+        import pyarrow.csv as pa_csv
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("Error: pyarrow module not found. Please install it with: pip install pyarrow")
+        sys.exit(1)
+
+    with zipfile.ZipFile(source) as zip_in, zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as zip_out:
+        for item in zip_in.infolist():
+            if not item.filename.endswith('.parquet'):
+                zip_out.writestr(item, zip_in.read(item))
+                continue
+            with zip_in.open(item) as f:
+                table = pq.read_table(f)
+            with zip_out.open(item.filename[:-len('.parquet')] + '.csv', 'w') as f:
+                pa_csv.write_csv(table, f)
+
+
+def execute_cohort_diagnostics(algorithm_image, client, collaboration_id, names, omop_jsons, organisations_to_include,
+                               main_process_organisation_id, result_format='csv', deadline_seconds=None,
+                               dry_run=False, budget_policy='none', phase='full', covariate_budget=None,
+                               precompile=False):
     # Create covariate settings
     # To see all the available options please refer to the documentation of the
     # OHDSI package: https://ohdsi.github.io/FeatureExtraction/reference/createTemporalCovariateSettings.html.
@@ -247,7 +574,8 @@ def execute_cohort_diagnostics(algorithm_image, client, collaboration_id, names,
         "use_condition_era_group_start": False,
         # do not use because https://github.com/ohdsi/feature_extraction/issues/144
         "use_condition_era_group_overlap": True,
-        "use_drug_exposure": False,  # leads to too many concept id
+        # leads to too many concept ids, unless the concepts are capped
+        "use_drug_exposure": covariate_budget is not None,
         "use_drug_era_overlap": False,
         "use_drug_era_group_start": False,  # do not use because https://github.com/ohdsi/feature_extraction/issues/144
         "use_drug_era_group_overlap": True,
@@ -318,7 +646,14 @@ def execute_cohort_diagnostics(algorithm_image, client, collaboration_id, names,
                 "temporal_covariate_settings": temporal_covariate_settings,
                 "diagnostics_settings": diagnostics_settings,
                 "meta_cohorts": [{"task_id": 13}],
-                "organizations_to_include": organisations_to_include
+                "organizations_to_include": organisations_to_include,
+                "precompile": precompile,
+                "result_format": result_format,
+                "deadline_seconds": deadline_seconds,
+                "dry_run": dry_run,
+                "budget_policy": budget_policy,
+                "phase": phase,
+                "covariate_budget": covariate_budget,
             },
         },
         databases=[{"label": "omop"}],
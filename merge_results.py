@@ -0,0 +1,203 @@
+"""
+Merges the results zips of the organizations into a single SQLite database.
+
+This is a Python replacement for ``CohortDiagnostics::createMergedResultsFile``,
+which needs an R environment with the OHDSI packages. The database has the same
+file name, the same tables and the same primary keys, so it can be opened by
+the Diagnostics Explorer.
+
+The tables are defined by the results data model specification that
+CohortDiagnostics exports in each results zip
+(``resultsDataModelSpecification.csv``). Rows are streamed from the zips into
+the database in batches, so memory use does not grow with the size of the
+results. Rows with the same primary key, such as the concepts that every
+organization exports, are stored once.
+
+Usage:
+
+    python merge_results.py results/data
+"""
+
+import io
+import csv
+import sqlite3
+import zipfile
+import argparse
+from pathlib import Path
+
+MERGED_FILE_NAME = "MergedCohortDiagnosticsData.sqlite"
+SPECIFICATION_FILE_NAME = "resultsDataModelSpecification.csv"
+
+# Number of rows per insert statement
+BATCH_SIZE = 10000
+
+# The Diagnostics Explorer selects on these columns
+INDEXED_COLUMNS = ("database_id", "cohort_id", "concept_id", "covariate_id")
+
+
+def _sqlite_type(data_type):
+    data_type = data_type.lower()
+    if data_type.startswith(("int", "bigint", "smallint")):
+        return "INTEGER"
+    if data_type.startswith(("float", "real", "double", "numeric", "decimal")):
+        return "REAL"
+    return "TEXT"
+
+
+def read_specification(file_):
+    """Reads a results data model specification.
+
+    Returns a dictionary with, per table, the columns with their SQLite type,
+    the primary key columns and the columns in which an empty value is kept
+    as an empty string instead of NULL.
+    """
+    tables = {}
+    reader = csv.DictReader(io.TextIOWrapper(file_, encoding='utf-8-sig', newline=''))
+    for row in reader:
+        row = {key.lower(): (value or '').strip() for key, value in row.items()}
+        table = tables.setdefault(row['table_name'].lower(), {'columns': {}, 'primary_key': [], 'keep_empty': set()})
+        column = row['column_name'].lower()
+        table['columns'][column] = _sqlite_type(row['data_type'])
+        if row.get('primary_key', '').lower() == 'yes':
+            table['primary_key'].append(column)
+        if row.get('empty_is_na', '').lower() == 'no':
+            table['keep_empty'].add(column)
+    return tables
+
+
+def _find_specification(zip_files):
+    for zip_file in zip_files:
+        with zipfile.ZipFile(zip_file) as zip_:
+            for name in zip_.namelist():
+                if Path(name).name == SPECIFICATION_FILE_NAME:
+                    with zip_.open(name) as f:
+                        return read_specification(f)
+    return None
+
+
+def _create_table(connection, name, table):
+    columns = [f'"{column}" {type_}' for column, type_ in table['columns'].items()]
+    if table['primary_key']:
+        columns.append(f"PRIMARY KEY ({', '.join(table['primary_key'])})")
+    connection.execute(f'CREATE TABLE "{name}" ({", ".join(columns)})')
+
+
+def _insert_csv(connection, name, table, file_):
+    reader = csv.reader(io.TextIOWrapper(file_, encoding='utf-8-sig', newline=''))
+    header = [column.lower() for column in next(reader, [])]
+    positions = [i for i, column in enumerate(header) if column in table['columns']]
+    if not positions:
+        return 0
+    columns = [header[i] for i in positions]
+    keep_empty = [column in table['keep_empty'] for column in columns]
+    # later rows replace earlier rows with the same primary key, like the
+    # upload of CohortDiagnostics does
+    conflict = 'OR REPLACE' if table['primary_key'] else ''
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    sql = f'INSERT {conflict} INTO "{name}" ({column_list}) VALUES ({", ".join("?" * len(columns))})'
+
+    count = 0
+    batch = []
+    for row in reader:
+        batch.append([
+            row[i] if row[i] != '' or keep else None
+            for i, keep in zip(positions, keep_empty)
+        ])
+        if len(batch) == BATCH_SIZE:
+            connection.executemany(sql, batch)
+            count += len(batch)
+            batch = []
+    connection.executemany(sql, batch)
+    return count + len(batch)
+
+
+def merge_results(zip_files, target, specification=None):
+    """Merges results zips of CohortDiagnostics into a SQLite database.
+
+    Parameters
+    ----------
+    zip_files : list[Path]
+        The results zips, one per organization.
+    target : Path
+        The database to create. An existing database is replaced.
+    specification : Path, optional
+        The results data model specification. By default, the specification
+        in the results zips is used.
+
+    Returns
+    -------
+    dict
+        The number of rows read per table.
+    """
+    zip_files = sorted(zip_files)
+    if specification:
+        with open(specification, 'rb') as f:
+            tables = read_specification(f)
+    else:
+        tables = _find_specification(zip_files)
+    if tables is None:
+        raise ValueError(
+            f"No {SPECIFICATION_FILE_NAME} found in the results, pass the one of the "
+            f"CohortDiagnostics R package to define the tables"
+        )
+
+    target = Path(target)
+    if target.exists():
+        target.unlink()
+    connection = sqlite3.connect(target)
+    try:
+        # the database is created from scratch, so there is nothing to recover
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        for name, table in tables.items():
+            _create_table(connection, name, table)
+
+        counts = dict.fromkeys(tables, 0)
+        for zip_file in zip_files:
+            with zipfile.ZipFile(zip_file) as zip_:
+                for item in zip_.infolist():
+                    path = Path(item.filename)
+                    name = path.stem.lower()
+                    if path.suffix != '.csv' or name not in tables:
+                        continue
+                    with zip_.open(item) as f:
+                        counts[name] += _insert_csv(connection, name, tables[name], f)
+            connection.commit()
+
+        # indexes are created after loading, which is much faster than
+        # maintaining them during the inserts
+        for name, table in tables.items():
+            for column in INDEXED_COLUMNS:
+                if column in table['columns'] and table['primary_key'][:1] != [column]:
+                    connection.execute(f'CREATE INDEX "idx_{name}_{column}" ON "{name}" ("{column}")')
+        connection.execute('ANALYZE')
+        connection.commit()
+    finally:
+        connection.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge CohortDiagnostics results zips into a SQLite database')
+    parser.add_argument('data_folder', type=Path, help='Folder with the results zips')
+    parser.add_argument(
+        '--output',
+        type=Path,
+        default=None,
+        help=f'Database to create (default: {MERGED_FILE_NAME} in the data folder)'
+    )
+    parser.add_argument(
+        '--specification',
+        type=Path,
+        default=None,
+        help=f'The {SPECIFICATION_FILE_NAME} to use (default: the one in the results zips)'
+    )
+    args = parser.parse_args()
+
+    output = args.output or args.data_folder / MERGED_FILE_NAME
+    counts = merge_results(args.data_folder.glob('*.zip'), output, args.specification)
+    print(f"Merged {sum(counts.values())} rows in {len(counts)} tables into {output}")
+
+
+if __name__ == '__main__':
+    main()
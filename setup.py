@@ -28,5 +28,6 @@ setup(
         "ohdsi-cohort-generator",
         "ohdsi-cohort-diagnostics",
         "ohdsi-common",
+        "pyarrow",
     ],
 )
@@ -5,30 +5,57 @@ like any other method.
 
 The results in a return statement are sent to the central vantage6 server after
 encryption (if that is enabled for the collaboration).
+
+The OHDSI packages start R and the JVM when they are imported. They are only
+imported by the code paths that need them, so the central step starts fast.
 """
 
-import base64
-import pandas as pd
-
-from vantage6.algorithm.tools.util import info, get_env_var
-from vantage6.algorithm.tools.decorators import (
-    algorithm_client,
-    AlgorithmClient,
-    database_connection,
-    metadata,
-    RunMetaData,
-    OHDSIMetaData,
-)
+from functools import lru_cache
+
+from vantage6.algorithm.tools.util import info, warn
+from vantage6.algorithm.client import AlgorithmClient
+
+from .cache import SqlCache, content_hash, normalize_json
+from .collect import FAILED, TIMED_OUT, iter_results, kill_task
+from .decorators import algorithm_client
+from .metrics import metrics_table
 
-from ohdsi import circe
-from ohdsi import cohort_generator
-from ohdsi import common as ohdsi_common
-from ohdsi import feature_extraction
-from ohdsi import cohort_diagnostics as ohdsi_cohort_diagnostics
-from ohdsi import cohort_generator as ohdsi_cohort_generator
+RESULT_FORMATS = ("csv", "parquet")
+BUDGET_POLICIES = ("none", "enforce")
+PHASES = ("full", "summary", "detail")
 
-from rpy2.robjects import RS4
-from .globals import DEFAULT_CD_MIN_RECORDS
+# Diagnostics of the summary phase. CohortDiagnostics always exports the cohort
+# counts, the inclusion statistics add the inclusion rules and the attrition.
+SUMMARY_DIAGNOSTICS = {
+    "run_inclusion_statistics": True,
+    "run_included_source_concepts": False,
+    "run_orphan_concepts": False,
+    "run_time_series": False,
+    "run_visit_context": False,
+    "run_breakdown_index_events": False,
+    "run_incidence_rate": False,
+    "run_cohort_relationship": False,
+    "run_temporal_cohort_characterization": False,
+}
+
+# Diagnostics of the detail phase, which follows a summary phase and leaves out
+# the inclusion statistics that the summary phase already computed
+DETAIL_DIAGNOSTICS = {"run_inclusion_statistics": False}
+
+# Diagnostics that each phase overrides in the diagnostics settings
+PHASE_DIAGNOSTICS = {
+    "full": {},
+    "summary": SUMMARY_DIAGNOSTICS,
+    "detail": DETAIL_DIAGNOSTICS,
+}
+
+# Keys that every study of a batch must have
+STUDY_KEYS = (
+    "cohort_definitions",
+    "cohort_names",
+    "temporal_covariate_settings",
+    "diagnostics_settings",
+)
 
 
 @algorithm_client
@@ -40,7 +67,18 @@ def cohort_diagnostics_central(
     temporal_covariate_settings: dict,
     diagnostics_settings: dict,
     organizations_to_include="ALL",
-) -> list[pd.DataFrame]:
+    precompile: bool = False,
+    incremental: bool = False,
+    result_format: str = "csv",
+    dry_run: bool = False,
+    budget_policy: str = "none",
+    phase: str = "full",
+    characterization_sample_size: int | None = None,
+    covariate_budget: int | None = None,
+    poll_interval: float = 10,
+    deadline_seconds: float | None = None,
+    kill_on_deadline: bool = False,
+) -> list[dict]:
     """
     Executes the central algorithm on the specified client and returns the results.
 
@@ -58,11 +96,266 @@ def cohort_diagnostics_central(
         A dictionary containing the diagnostics settings.
     organizations_to_include : str, optional
         The organizations to include. Defaults to 'ALL'.
+    precompile : bool, optional
+        Compile the cohort definitions once in the central step and send the
+        resulting SQL to the nodes, instead of compiling them on every node.
+        Invalid cohort definitions are then reported before any node starts.
+        Defaults to False.
+    incremental : bool, optional
+        Reuse diagnostics that the nodes computed in earlier tasks for the same
+        cohort definitions and settings. Defaults to False.
+    result_format : str, optional
+        Format of the files in the results zip, either 'csv' (as exported by
+        CohortDiagnostics) or 'parquet'. Defaults to 'csv'.
+    dry_run : bool, optional
+        Only generate the cohorts and estimate the cost of the diagnostics on
+        every node, without running them. The nodes return the cohort counts
+        and the estimate. Defaults to False.
+    budget_policy : str, optional
+        Either 'none', or 'enforce' to let every node skip the most expensive
+        covariates and diagnostics until its estimate fits within the time
+        budget that the node admin configured. Defaults to 'none'.
+    phase : str, optional
+        Either 'full' to run the diagnostics as set in
+        ``diagnostics_settings``, or 'summary' to only compute the cohort
+        counts and the inclusion rule statistics, which is fast and gives a
+        small result. After a summary task, run a 'detail' task for the other
+        diagnostics in ``diagnostics_settings``, without computing the
+        inclusion rule statistics again. Defaults to 'full'.
+    characterization_sample_size : int, optional
+        Run the temporal characterization on a random sample of at most this
+        many subjects per cohort. The sample is the same on every run. The
+        other diagnostics, including the cohort counts, use all subjects. The
+        results zip lists the sampled cohorts in
+        ``characterization_sample.csv``. Characterizes all subjects by default.
+    covariate_budget : int, optional
+        The maximum number of concepts per covariate domain (such as drug
+        exposures or condition era groups) in the temporal characterization.
+        Every node counts the subjects per concept within the cohorts and
+        keeps the most prevalent concepts above its minimum cell count. Keeps
+        all concepts by default.
+    poll_interval : float, optional
+        Number of seconds between two checks for finished nodes. Defaults to
+        10.
+    deadline_seconds : float, optional
+        Number of seconds to wait for the nodes. After the deadline, the
+        results that are in are returned, together with a result with status
+        'timed_out' for every organization that has not finished. Waits for
+        all nodes by default.
+    kill_on_deadline : bool, optional
+        Kill the runs of the organizations that missed the deadline. Defaults
+        to False.
+
+    Returns
+    -------
+    list[dict]
+        The results of the nodes. For a node whose run failed, the result has
+        the status 'failed', with the status and the log of the run.
+    """
+    ids = _organization_ids(client, organizations_to_include)
+    if ids is None:
+        return {
+            "msg": "You specified an organization that is not part of the "
+            "collaboration"
+        }
+
+    msg = _validate_options(
+        result_format,
+        budget_policy,
+        phase,
+        characterization_sample_size,
+        covariate_budget,
+    )
+    if msg:
+        return {"msg": msg}
+
+    diagnostics_settings = {**diagnostics_settings, **PHASE_DIAGNOSTICS[phase]}
+
+    kwargs = {
+        "meta_cohorts": meta_cohorts,
+        "cohort_definitions": cohort_definitions,
+        "cohort_names": cohort_names,
+        "temporal_covariate_settings": temporal_covariate_settings,
+        "diagnostics_settings": diagnostics_settings,
+        "incremental": incremental,
+        "result_format": result_format,
+        "dry_run": dry_run,
+        "budget_policy": budget_policy,
+        "characterization_sample_size": characterization_sample_size,
+        "covariate_budget": covariate_budget,
+    }
+
+    if precompile:
+        try:
+            kwargs["cohort_sql_bundle"] = _compile_cohorts(
+                cohort_definitions, cohort_names
+            )
+        except ValueError as e:
+            return {"msg": str(e)}
+
+    return _run_partial(
+        client,
+        "cohort_diagnostics",
+        kwargs,
+        ids,
+        poll_interval,
+        deadline_seconds,
+        kill_on_deadline,
+    )
+
+
+@algorithm_client
+def cohort_diagnostics_batch_central(
+    client: AlgorithmClient,
+    studies: list[dict],
+    meta_cohorts: list[dict],
+    organizations_to_include="ALL",
+    precompile: bool = False,
+    incremental: bool = False,
+    result_format: str = "csv",
+    dry_run: bool = False,
+    budget_policy: str = "none",
+    phase: str = "full",
+    characterization_sample_size: int | None = None,
+    covariate_budget: int | None = None,
+    poll_interval: float = 10,
+    deadline_seconds: float | None = None,
+    kill_on_deadline: bool = False,
+) -> list[dict]:
+    """
+    Executes several studies in a single task on the nodes.
+
+    Every node runs all studies in one session, and generates cohorts that
+    studies share only once. This saves the start-up of a container, R and the
+    JVM per study, for example when running a sensitivity analysis over
+    covariate windows.
+
+    Parameters
+    ----------
+    client : AlgorithmClient
+        Interface to the central server. This is supplied by the wrapper.
+    studies : list[dict]
+        The studies. Each study is a dictionary with the ``cohort_definitions``,
+        ``cohort_names``, ``temporal_covariate_settings`` and
+        ``diagnostics_settings`` of that study, as for
+        ``cohort_diagnostics_central``, and optionally a ``name``.
+    organizations_to_include : str, optional
+        The organizations to include. Defaults to 'ALL'.
+    precompile : bool, optional
+        Compile the cohort definitions once in the central step. Defaults to
+        False.
+    incremental : bool, optional
+        Reuse diagnostics that the nodes computed in earlier tasks. Defaults to
+        False.
+    result_format : str, optional
+        Format of the files in the results zips, either 'csv' or 'parquet'.
+        Defaults to 'csv'.
+    dry_run : bool, optional
+        Only estimate the cost of the diagnostics of every study. Defaults to
+        False.
+    budget_policy : str, optional
+        Either 'none' or 'enforce', see ``cohort_diagnostics_central``.
+        Defaults to 'none'.
+    phase : str, optional
+        Either 'full', 'summary' or 'detail', see
+        ``cohort_diagnostics_central``.
+        Defaults to 'full'.
+    characterization_sample_size : int, optional
+        The maximum number of subjects per cohort in the temporal
+        characterization, see ``cohort_diagnostics_central``. Characterizes all
+        subjects by default.
+    covariate_budget : int, optional
+        The maximum number of concepts per covariate domain, see
+        ``cohort_diagnostics_central``. Keeps all concepts by default.
+    poll_interval : float, optional
+        Number of seconds between two checks for finished nodes. Defaults to
+        10.
+    deadline_seconds : float, optional
+        Number of seconds to wait for the nodes. Waits for all nodes by
+        default.
+    kill_on_deadline : bool, optional
+        Kill the runs of the organizations that missed the deadline. Defaults
+        to False.
 
     Returns
     -------
-    list[pd.DataFrame]
-        A list of pandas DataFrames containing the results.
+    list[dict]
+        The results of the nodes. The result of a node contains a ``studies``
+        list, with a result per study in the same form as the result of
+        ``cohort_diagnostics_central``.
+    """
+    ids = _organization_ids(client, organizations_to_include)
+    if ids is None:
+        return {
+            "msg": "You specified an organization that is not part of the "
+            "collaboration"
+        }
+
+    msg = _validate_options(
+        result_format,
+        budget_policy,
+        phase,
+        characterization_sample_size,
+        covariate_budget,
+    )
+    if msg:
+        return {"msg": msg}
+
+    for i, study in enumerate(studies):
+        missing = [key for key in STUDY_KEYS if key not in study]
+        if missing:
+            return {"msg": f"Study {i} is missing {', '.join(missing)}"}
+        if len(study["cohort_definitions"]) != len(study["cohort_names"]):
+            return {"msg": f"Study {i} has a different number of names and cohorts"}
+
+    studies = [
+        {
+            **study,
+            "diagnostics_settings": {
+                **study["diagnostics_settings"],
+                **PHASE_DIAGNOSTICS[phase],
+            },
+        }
+        for study in studies
+    ]
+
+    if precompile:
+        studies = [dict(study) for study in studies]
+        try:
+            for study in studies:
+                study["cohort_sql_bundle"] = _compile_cohorts(
+                    study["cohort_definitions"], study["cohort_names"]
+                )
+        except ValueError as e:
+            return {"msg": str(e)}
+
+    return _run_partial(
+        client,
+        "cohort_diagnostics_batch",
+        {
+            "meta_cohorts": meta_cohorts,
+            "studies": studies,
+            "incremental": incremental,
+            "result_format": result_format,
+            "dry_run": dry_run,
+            "budget_policy": budget_policy,
+            "characterization_sample_size": characterization_sample_size,
+            "covariate_budget": covariate_budget,
+        },
+        ids,
+        poll_interval,
+        deadline_seconds,
+        kill_on_deadline,
+    )
+
+
+def _organization_ids(
+    client: AlgorithmClient, organizations_to_include: str | list[int]
+) -> list[int] | None:
+    """
+    Returns the organizations to run the partial tasks at.
+
+    Returns None when an organization is not part of the collaboration.
     """
     info("Collecting participating organizations")
     # obtain organizations for which to run the algorithm
@@ -73,146 +366,164 @@ def cohort_diagnostics_central(
         # a nice error message. The server can also return an error, but this is
         # more user friendly.
         if not set(organizations_to_include).issubset(set(ids)):
-            return {
-                "msg": "You specified an organization that is not part of the "
-                "collaboration"
-            }
+            return None
         ids = organizations_to_include
+    return ids
+
+
+def _validate_options(
+    result_format: str,
+    budget_policy: str,
+    phase: str,
+    characterization_sample_size: int | None,
+    covariate_budget: int | None,
+) -> str | None:
+    """
+    Checks the options that the central functions share.
+
+    Returns
+    -------
+    str | None
+        The message for the user if an option is invalid, ``None`` otherwise.
+    """
+    if result_format not in RESULT_FORMATS:
+        return (
+            f"Unknown result format '{result_format}', use one of "
+            f"{', '.join(RESULT_FORMATS)}"
+        )
+    if budget_policy not in BUDGET_POLICIES:
+        return (
+            f"Unknown budget policy '{budget_policy}', use one of "
+            f"{', '.join(BUDGET_POLICIES)}"
+        )
+    if phase not in PHASES:
+        return f"Unknown phase '{phase}', use one of {', '.join(PHASES)}"
+    if characterization_sample_size is not None and characterization_sample_size < 1:
+        return "The characterization sample size must be at least 1"
+    if covariate_budget is not None and covariate_budget < 1:
+        return "The covariate budget must be at least 1"
+    return None
+
+
+def _compile_cohorts(cohort_definitions: list, cohort_names: list[str]) -> list[dict]:
+    """
+    Compiles cohort definitions into a bundle for the nodes.
+
+    Raises
+    ------
+    ValueError
+        If a cohort definition cannot be compiled.
+    """
+    info("Compiling cohort definitions")
+    cohort_sql_bundle = []
+    for name, cohort_definition in zip(cohort_names, cohort_definitions):
+        try:
+            sql = _create_cohort_query(cohort_definition)
+        except Exception as e:
+            raise ValueError(
+                f"Cohort definition '{name}' could not be compiled: {e}"
+            ) from e
+        cohort_sql_bundle.append(
+            {"sql": sql, "hash": _bundle_hash(cohort_definition, sql)}
+        )
+    info(f"Compiled {len(cohort_sql_bundle)} cohort definitions")
+    return cohort_sql_bundle
 
+
+def _run_partial(
+    client: AlgorithmClient,
+    method: str,
+    kwargs: dict,
+    ids: list[int],
+    poll_interval: float,
+    deadline_seconds: float | None,
+    kill_on_deadline: bool,
+) -> list[dict]:
+    """Runs a partial task on the nodes and collects the results."""
     # This requests the cohort diagnostics to be computed on all nodes
     info("Requesting partial computation")
     task = client.task.create(
         input_={
-            "method": "cohort_diagnostics",
-            "kwargs": {
-                "meta_cohorts": meta_cohorts,
-                "cohort_definitions": cohort_definitions,
-                "cohort_names": cohort_names,
-                "temporal_covariate_settings": temporal_covariate_settings,
-                "diagnostics_settings": diagnostics_settings,
-            },
+            "method": method,
+            "kwargs": kwargs,
         },
         organizations=ids,
     )
     info(f'Task assigned, id: {task.get("id")}')
 
-    # This function is blocking until the results from all nodes are in
+    # Results are processed as soon as a node has finished, so the progress
+    # and the timings of each node can be followed in the log. The central
+    # step returns all results at once, so it still ends when the last node
+    # has finished (or at the deadline).
     info("Waiting for results")
-    all_results = client.wait_for_results(task_id=task["id"])
+    all_results = []
+    timed_out = []
+    failed = []
+    for organization_id, result in iter_results(
+        client, task["id"], poll_interval, deadline_seconds
+    ):
+        all_results.append(result)
+        if isinstance(result, dict) and result.get("status") == TIMED_OUT:
+            timed_out.append(organization_id)
+            continue
+        if isinstance(result, dict) and result.get("status") == FAILED:
+            failed.append(organization_id)
+            continue
+        node_table = metrics_table([result])
+        if not node_table.empty:
+            info(
+                f"Organization {organization_id} wall time (s) per phase: "
+                + ", ".join(
+                    f"{row.phase} {row.wall_seconds:.1f}"
+                    for row in node_table.itertuples()
+                )
+            )
+
+    if failed:
+        warn(f"Returning partial results, organizations {failed} failed")
+    if timed_out:
+        warn(f"Returning partial results, organizations {timed_out} timed out")
+        if kill_on_deadline:
+            kill_task(client, task["id"])
+
+    table = metrics_table(all_results)
+    if not table.empty:
+        info(
+            "Wall time (s) per organization and phase:\n"
+            + table.pivot_table(
+                index="organization_id",
+                columns="phase",
+                values="wall_seconds",
+                sort=False,
+            ).to_string()
+        )
 
     info("Results received, sending them back to server")
     return all_results
 
 
-@metadata
-@database_connection(types=["OMOP"], include_metadata=True)
-def cohort_diagnostics(
-    connection: RS4,
-    meta_omop: OHDSIMetaData,
-    meta_run: RunMetaData,
-    meta_cohorts: list[dict],
-    cohort_definitions: dict,
-    cohort_names: list[str],
-    temporal_covariate_settings: dict,
-    diagnostics_settings: dict,
-) -> pd.DataFrame:
-    """Computes the OHDSI cohort diagnostics."""
-
-    # Generate unique cohort ids, based on the task id and the number of files.
-    # The first six digits are the task id, the last three digits are the index
-    # of the file.
-    n = len(cohort_definitions)
-    shared_ids = []
-    cohort_ids = []
-    for i in range(0, n):
-        # These are the IDs to be shared with the user and should be identical for all
-        # nodes that participate
-        task_id = meta_cohorts[0]["task_id"]
-        temp_id = f"{task_id:04d}{i:03d}"
-        shared_ids.append(temp_id)
-        # The node id is appended at runtim by the node itself
-        cohort_ids.append(float(f"{meta_run.node_id}{temp_id}"))
-
-    info(f"Full local cohort ids: {cohort_ids}")
-    info(f"Shared cohort ids: {shared_ids}")
-
-    cohort_definition_set = pd.DataFrame(
-        {
-            "cohortId": cohort_ids,
-            "cohortName": cohort_names,
-            "json": cohort_definitions,
-            "sql": [_create_cohort_query(cohort) for cohort in cohort_definitions],
-            "logicDescription": [None] * n,
-            "generateStats": [True] * n,
-        }
-    )
-    cohort_definition_set = ohdsi_common.convert_to_r(cohort_definition_set)
-    info(f"Generated {n} cohort definitions")
-
-    # Generate the table names for the cohort tables
-    cohort_table = f"cohort_{task_id}_{meta_run.node_id}"
-    cohort_table_names = cohort_generator.get_cohort_table_names(cohort_table)
-    info(f"Cohort table name: {cohort_table}")
-    info(f"Tables: {cohort_table_names}")
-
-    info("(re-)creating cohort tables")
-    ohdsi_cohort_generator.create_cohort_tables(
-        cohort_database_schema=meta_omop.results_schema,
-        connection=connection,
-        cohort_table_names=cohort_table_names)
-
-    info("generating cohort set")
-    ohdsi_cohort_generator.generate_cohort_set(
-        cdm_database_schema="omopcdm_synthetic",
-        cohort_definition_set=cohort_definition_set,
-        connection=connection,
-        cohort_database_schema="results_synthetic",
-        cohort_table_names=cohort_table_names)
-
-    temporal_covariate_settings = feature_extraction.create_temporal_covariate_settings(
-        **temporal_covariate_settings
-    )
-    info("Created temporal covariate settings")
+def cohort_diagnostics(*args, **kwargs) -> dict:
+    """
+    Computes the OHDSI cohort diagnostics.
 
-    # Privacy guards
-    min_cell_count = get_env_var(
-        "CD_MIN_RECORDS", DEFAULT_CD_MIN_RECORDS, as_type="int"
-    )
+    The implementation lives in the ``node`` module, which is imported here
+    so that only the nodes pay for starting R and the JVM.
+    """
+    from .node import cohort_diagnostics as node_cohort_diagnostics
+
+    return node_cohort_diagnostics(*args, **kwargs)
 
-    database_id = f"{meta_run.task_id:06d}__{meta_run.organization_id}_{meta_run.node_id}"
-    database_name = f"Node_{meta_run.organization_id}"
-    ohdsi_cohort_diagnostics.execute_diagnostics(
-        cohort_definition_set=cohort_definition_set,
-        export_folder=str(meta_omop.export_folder / "exports"),
-        database_id=database_id,
-        database_name=database_name,
-        database_description="Results generated by federated infrastructure.",
-        cohort_database_schema=meta_omop.results_schema,
-        connection=connection,
-        cdm_database_schema=meta_omop.cdm_schema,
-        cohort_table=cohort_table,
-        cohort_table_names=cohort_table_names,
-        vocabulary_database_schema=meta_omop.cdm_schema,
-        cohort_ids=None,
-        cdm_version=5,
-        temporal_covariate_settings=temporal_covariate_settings,
-        **diagnostics_settings,
-        min_cell_count=min_cell_count,
-        # incremental=False, #default was True
-        # incremental_folder=my_params['incremental_folder']
-    )
-    info("Executed diagnostics")
 
-    # Read back the zip file with results
-    file_ = meta_omop.export_folder / "exports" / f"Results_{database_id}.zip"
-    with open(file_, "rb") as f:
-        contents = f.read()
-    contents = base64.b64encode(contents).decode("UTF-8")
+def cohort_diagnostics_batch(*args, **kwargs) -> dict:
+    """Computes the OHDSI cohort diagnostics for several studies."""
+    from .node import cohort_diagnostics_batch as node_cohort_diagnostics_batch
 
-    return {"organization_id": meta_run.organization_id, "zip": contents}
+    return node_cohort_diagnostics_batch(*args, **kwargs)
 
 
-def _create_cohort_query(cohort_definition: dict) -> str:
+def _create_cohort_query(
+    cohort_definition: dict, cache: SqlCache | None = None
+) -> str:
     """
     Creates a cohort query from a cohort definition in JSON format.
 
@@ -220,12 +531,84 @@ def _create_cohort_query(cohort_definition: dict) -> str:
     ----------
     cohort_definition: dict
         The cohort definition in JSON format, for example created from ATLAS.
+    cache: SqlCache, optional
+        Cache of previously compiled queries. When supplied, the query is only
+        compiled by Circe if it is not in the cache yet.
 
     Returns
     -------
     str
         The cohort query.
     """
+    generate_options = {"generate_stats": True}
+    if cache:
+        key = content_hash(
+            normalize_json(cohort_definition),
+            _circe_version(),
+            normalize_json(generate_options),
+        )
+        sql = cache.get(key)
+        if sql is not None:
+            return sql
+
+    from ohdsi import circe
+
     cohort_expression = circe.cohort_expression_from_json(cohort_definition)
-    options = circe.create_generate_options(generate_stats=True)
-    return circe.build_cohort_query(cohort_expression, options)[0]
+    options = circe.create_generate_options(**generate_options)
+    sql = circe.build_cohort_query(cohort_expression, options)[0]
+
+    if cache:
+        cache.put(key, sql)
+    return sql
+
+
+def _bundle_hash(cohort_definition: dict, sql: str) -> str:
+    """Hash that ties a precompiled query to the definition it was compiled from."""
+    return content_hash(normalize_json(cohort_definition), sql)
+
+
+def _read_cohort_sql_bundle(
+    cohort_sql_bundle: list[dict], cohort_definitions: list
+) -> list[str]:
+    """
+    Validates the cohort SQL that was compiled in the central step.
+
+    Parameters
+    ----------
+    cohort_sql_bundle : list[dict]
+        For every cohort definition, a dictionary with the compiled ``sql`` and
+        its ``hash``.
+    cohort_definitions : list
+        The cohort definitions the bundle should have been compiled from.
+
+    Returns
+    -------
+    list[str]
+        The cohort queries, in the same order as the cohort definitions.
+
+    Raises
+    ------
+    ValueError
+        If the bundle does not match the cohort definitions.
+    """
+    if len(cohort_sql_bundle) != len(cohort_definitions):
+        raise ValueError(
+            f"Received {len(cohort_sql_bundle)} precompiled queries for "
+            f"{len(cohort_definitions)} cohort definitions"
+        )
+    for i, (entry, cohort_definition) in enumerate(
+        zip(cohort_sql_bundle, cohort_definitions)
+    ):
+        if entry["hash"] != _bundle_hash(cohort_definition, entry["sql"]):
+            raise ValueError(
+                f"Precompiled query {i} does not match its cohort definition"
+            )
+    return [entry["sql"] for entry in cohort_sql_bundle]
+
+
+@lru_cache(maxsize=None)
+def _circe_version() -> str:
+    """Returns the version of the CirceR package that compiles the queries."""
+    from rpy2 import robjects
+
+    return robjects.r('as.character(utils::packageVersion("CirceR"))')[0]
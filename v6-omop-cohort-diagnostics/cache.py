@@ -0,0 +1,156 @@
+"""
+On-node, content-addressed cache for compiled Circe cohort SQL.
+
+Compiling a cohort definition requires a round-trip to R and Java. The result
+only depends on the cohort definition, the Circe version and the generate
+options, so it can safely be reused across tasks. Entries are stored as plain
+files in a cache directory; the file modification time is used as the access
+time for least-recently-used eviction.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+from pathlib import Path
+
+from vantage6.algorithm.tools.util import info, warn
+
+
+def normalize_json(definition: str | dict) -> str:
+    """
+    Returns a canonical JSON representation of a (cohort) definition.
+
+    Parameters
+    ----------
+    definition : str | dict
+        The definition, either as JSON string or as already parsed object.
+
+    Returns
+    -------
+    str
+        The definition with sorted keys and without insignificant whitespace.
+    """
+    if isinstance(definition, str):
+        definition = json.loads(definition)
+    return json.dumps(definition, sort_keys=True, separators=(",", ":"))
+
+
+def content_hash(*parts: str) -> str:
+    """
+    Computes a SHA-256 hash over one or more strings.
+
+    Parameters
+    ----------
+    *parts : str
+        The strings to hash, in order.
+
+    Returns
+    -------
+    str
+        The hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("UTF-8"))
+        # separator, so that ("ab", "c") and ("a", "bc") hash differently
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class SqlCache:
+    """
+    Size-bounded LRU cache of SQL statements stored on disk.
+
+    Parameters
+    ----------
+    folder : Path
+        Directory in which the cache entries are stored. Created if missing.
+    max_bytes : int
+        Maximum total size of all entries. The least recently used entries
+        are evicted when this size is exceeded.
+    """
+
+    SUFFIX = ".sql"
+
+    def __init__(self, folder: Path, max_bytes: int):
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.folder / f"{key}{self.SUFFIX}"
+
+    def get(self, key: str) -> str | None:
+        """Returns the cached SQL for ``key``, or ``None`` on a miss."""
+        path = self._path(key)
+        try:
+            sql = path.read_text(encoding="UTF-8")
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # mark as recently used
+        os.utime(path)
+        self.hits += 1
+        return sql
+
+    def put(self, key: str, sql: str) -> None:
+        """Stores ``sql`` under ``key`` and evicts old entries if needed."""
+        # write to a temporary file first, so that concurrent tasks never read
+        # a partially written entry
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="UTF-8") as f:
+            f.write(sql)
+        os.replace(tmp, self._path(key))
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = []
+        for path in self.folder.glob(f"*{self.SUFFIX}"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # removed by a concurrent task
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def log_stats(self) -> None:
+        """Writes the hit and miss counts to the node log."""
+        info(f"Cohort SQL cache: {self.hits} hit(s), {self.misses} miss(es)")
+
+
+def open_cache(folder: Path | None, max_mb: int) -> SqlCache | None:
+    """
+    Opens the cohort SQL cache, or returns ``None`` when it is disabled.
+
+    Parameters
+    ----------
+    folder : Path | None
+        The cache directory. ``None`` disables the cache.
+    max_mb : int
+        The maximum cache size in megabytes. Zero disables the cache.
+
+    Returns
+    -------
+    SqlCache | None
+        The cache, or ``None`` if caching is disabled or not possible.
+    """
+    if folder is None or max_mb <= 0:
+        return None
+    try:
+        return SqlCache(folder, max_mb * 1024 * 1024)
+    except OSError as e:
+        warn(f"Cohort SQL cache disabled, cannot use {folder}: {e}")
+        return None
@@ -0,0 +1,182 @@
+"""
+Shared expansion of the concept sets of the cohorts of a task.
+
+Every cohort query that Circe compiles starts by expanding its concept sets
+through the vocabulary into a ``#Codesets`` temp table. Cohort definitions of a
+study often share most of their concept sets, which are then expanded again for
+every cohort. Instead, every distinct concept set of the task is expanded once
+into a shared table, and the cohort queries are rewritten to fill
+``#Codesets`` from that table.
+
+Only the queries that generate the cohorts are rewritten. The cohort store and
+the SQL cache keep using the queries as compiled by Circe, so their keys do not
+depend on the task. With a concept set cache, the shared table is filled from
+the cache, so concept sets that earlier tasks resolved are not expanded again.
+"""
+
+import re
+import json
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from rpy2.robjects import RS4
+from vantage6.algorithm.tools.util import info, warn
+from ohdsi import circe
+
+from . import database
+from .cache import normalize_json
+from .vocabulary_cache import ConceptSetCache
+
+# The statement with which a cohort query of Circe fills its concept sets. The
+# concept set queries do not contain semicolons.
+CODESETS_INSERT = re.compile(
+    r"INSERT INTO #Codesets \(codeset_id, concept_id\)\s+SELECT\b[^;]*;",
+    re.IGNORECASE,
+)
+
+
+def concept_set_key(expression: dict) -> str:
+    """
+    Identifies a concept set expression by the concepts it resolves to.
+
+    Only the concept ids and the flags of the items are used, so the same
+    concept set with different concept metadata or item order has the same
+    key.
+
+    Parameters
+    ----------
+    expression : dict
+        The concept set expression, as in the ``ConceptSets`` of a cohort
+        definition.
+
+    Returns
+    -------
+    str
+        The key of the expression.
+    """
+    items = sorted(
+        (
+            item["concept"]["CONCEPT_ID"],
+            bool(item.get("isExcluded")),
+            bool(item.get("includeDescendants")),
+            bool(item.get("includeMapped")),
+        )
+        for item in expression.get("items", [])
+    )
+    return normalize_json(items)
+
+
+def _concept_sets(cohort_definition: str | dict) -> list[dict]:
+    if isinstance(cohort_definition, str):
+        cohort_definition = json.loads(cohort_definition)
+    return cohort_definition.get("ConceptSets") or []
+
+
+@contextmanager
+def shared_codesets(
+    connection: RS4,
+    schema: str,
+    vocabulary_schema: str,
+    table: str,
+    cohort_definitions: list,
+    cohort_sql: list[str],
+    cache: ConceptSetCache | None = None,
+) -> Iterator[list[str]]:
+    """
+    Expands the distinct concept sets of cohorts once, for their generation.
+
+    The shared table exists while the context is active and is dropped
+    afterwards. When the cohorts do not share any concept set and there is no
+    cache, no table is created and the queries are returned unchanged.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    schema : str
+        Schema in which to create the shared table.
+    vocabulary_schema : str
+        Schema that contains the vocabulary tables.
+    table : str
+        Name of the shared table.
+    cohort_definitions : list
+        The cohort definitions in JSON format.
+    cohort_sql : list[str]
+        The queries that Circe compiled from the cohort definitions.
+    cache : ConceptSetCache, optional
+        The (open) cache of resolved concept sets to read them from.
+
+    Yields
+    ------
+    list[str]
+        The queries to generate the cohorts with.
+    """
+    concept_sets = [_concept_sets(definition) for definition in cohort_definitions]
+    expressions = {}
+    for concept_set in (cs for sets in concept_sets for cs in sets):
+        expressions.setdefault(
+            concept_set_key(concept_set["expression"]), concept_set["expression"]
+        )
+    if not expressions or (
+        cache is None and sum(len(sets) for sets in concept_sets) == len(expressions)
+    ):
+        yield cohort_sql
+        return
+
+    start = time.perf_counter()
+    cached = cache.resolve(expressions) if cache else {}
+    codeset_ids = {key: i for i, key in enumerate(expressions)}
+    statements = [
+        f"IF OBJECT_ID('{schema}.{table}', 'U') IS NOT NULL "
+        f"DROP TABLE {schema}.{table};",
+        f"CREATE TABLE {schema}.{table} "
+        f"(codeset_id INT NOT NULL, concept_id BIGINT NOT NULL);",
+    ]
+    for key, expression in expressions.items():
+        query = cached.get(key) or circe.build_concept_set_query(
+            json.dumps(expression)
+        )[0]
+        statements.append(
+            f"INSERT INTO {schema}.{table} (codeset_id, concept_id) "
+            f"SELECT {codeset_ids[key]} AS codeset_id, concept_id "
+            f"FROM ({query}) codeset;"
+        )
+    database.execute(
+        connection,
+        "\n".join(statements).replace("@vocabulary_database_schema", vocabulary_schema),
+    )
+    info(
+        f"Expanded {len(expressions)} distinct concept sets for "
+        f"{sum(len(sets) for sets in concept_sets)} concept sets in "
+        f"{time.perf_counter() - start:.1f}s"
+    )
+
+    try:
+        yield [
+            _rewrite(sql, sets, codeset_ids, f"{schema}.{table}")
+            for sql, sets in zip(cohort_sql, concept_sets)
+        ]
+    finally:
+        database.execute(connection, f"DROP TABLE {schema}.{table};")
+
+
+def _rewrite(
+    sql: str, concept_sets: list[dict], codeset_ids: dict[str, int], table: str
+) -> str:
+    if not concept_sets:
+        return sql
+    if len(CODESETS_INSERT.findall(sql)) != 1:
+        warn("Could not find the concept sets in a cohort query, expanding them")
+        return sql
+    selects = [
+        f"SELECT {concept_set['id']} AS codeset_id, concept_id FROM {table} "
+        f"WHERE codeset_id = {codeset_ids[concept_set_key(concept_set['expression'])]}"
+        for concept_set in concept_sets
+    ]
+    insert = (
+        "INSERT INTO #Codesets (codeset_id, concept_id)\n"
+        + "\nUNION ALL\n".join(selects)
+        + ";"
+    )
+    return CODESETS_INSERT.sub(lambda _: insert, sql, count=1)
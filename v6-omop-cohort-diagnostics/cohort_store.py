@@ -0,0 +1,234 @@
+"""
+Persistent store of generated cohorts in the results schema.
+
+Generating cohorts is often the most expensive step of a run, while the same
+cohort definitions are submitted over and over again. Generated cohorts are
+therefore kept in a set of store tables, next to a checksum table that records
+which cohorts have been generated completely. A cohort is identified by a hash
+of its definition, its SQL, the CDM schema and the CDM data version, so a new
+data release or a changed definition always results in a fresh generation. The
+definition is part of the key because CohortGenerator takes the names of the
+inclusion rules from it. Cohorts older than a
+maximum age are evicted, which bounds the size of the store and regenerates
+cohorts also when the data version is not updated after a refresh.
+
+Tasks copy the rows of their cohorts from the store into their own cohort
+tables, so the rest of the pipeline is unaware of the store.
+"""
+
+import pandas as pd
+
+from rpy2.robjects import RS4
+from ohdsi import common as ohdsi_common
+from ohdsi import cohort_generator as ohdsi_cohort_generator
+
+from . import database
+from .cache import content_hash, normalize_json
+
+# Tables created by CohortGenerator, by suffix of the cohort table name, with
+# their columns. The first column is always the cohort id.
+COHORT_TABLE_COLUMNS = {
+    "": ["cohort_definition_id", "subject_id", "cohort_start_date", "cohort_end_date"],
+    "_inclusion": ["cohort_definition_id", "rule_sequence", "name", "description"],
+    "_inclusion_result": [
+        "cohort_definition_id",
+        "inclusion_rule_mask",
+        "person_count",
+        "mode_id",
+    ],
+    "_inclusion_stats": [
+        "cohort_definition_id",
+        "rule_sequence",
+        "person_count",
+        "gain_count",
+        "person_total",
+        "mode_id",
+    ],
+    "_summary_stats": ["cohort_definition_id", "base_count", "final_count", "mode_id"],
+    "_censor_stats": ["cohort_definition_id", "lost_count"],
+}
+
+
+class CohortStore:
+    """
+    Checksum-tracked store of generated cohorts.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    results_schema : str
+        Schema in which the store tables are kept.
+    cdm_schema : str
+        Schema that contains the CDM tables the cohorts are generated from.
+    table : str, optional
+        Base name of the store tables.
+    """
+
+    def __init__(
+        self,
+        connection: RS4,
+        results_schema: str,
+        cdm_schema: str,
+        table: str = "cd_cohort_store",
+    ):
+        self.connection = connection
+        self.results_schema = results_schema
+        self.cdm_schema = cdm_schema
+        self.table = table
+        self.checksum_table = f"{table}_checksum"
+        self.data_version = database.cdm_data_version(connection, cdm_schema)
+
+    def key(self, cohort_definition: str | dict, sql: str) -> str:
+        """Returns the store key of the cohort generated by ``sql``."""
+        return content_hash(
+            normalize_json(cohort_definition), sql, self.cdm_schema, self.data_version
+        )
+
+    @staticmethod
+    def cohort_id(key: str) -> int:
+        """Returns the cohort id under which a cohort is kept in the store."""
+        # 48 bits, so the id is exactly representable as an R double
+        return int(key[:12], 16)
+
+    def create_tables(self) -> None:
+        """Creates the store tables, if they do not exist yet."""
+        ohdsi_cohort_generator.create_cohort_tables(
+            connection=self.connection,
+            cohort_database_schema=self.results_schema,
+            cohort_table_names=ohdsi_cohort_generator.get_cohort_table_names(
+                self.table
+            ),
+            incremental=True,
+        )
+        database.execute(
+            self.connection,
+            f"IF OBJECT_ID('{self.results_schema}.{self.checksum_table}', 'U') "
+            f"IS NULL CREATE TABLE {self.results_schema}.{self.checksum_table} "
+            f"(cohort_hash VARCHAR(64) NOT NULL, cohort_definition_id BIGINT NOT NULL, "
+            f"generated_date DATE NOT NULL);",
+        )
+
+    def evict(self, max_age_days: int) -> None:
+        """
+        Removes the cohorts that were generated more than ``max_age_days`` ago.
+
+        Parameters
+        ----------
+        max_age_days : int
+            The maximum age of a stored cohort in days, 0 keeps all cohorts.
+        """
+        if max_age_days <= 0:
+            return
+        expired = (
+            f"SELECT cohort_definition_id "
+            f"FROM {self.results_schema}.{self.checksum_table} "
+            f"WHERE generated_date < DATEADD(day, -{max_age_days}, GETDATE())"
+        )
+        statements = [
+            f"DELETE FROM {self.results_schema}.{self.table}{suffix} "
+            f"WHERE cohort_definition_id IN ({expired});"
+            for suffix in COHORT_TABLE_COLUMNS
+        ]
+        statements.append(
+            f"DELETE FROM {self.results_schema}.{self.checksum_table} "
+            f"WHERE generated_date < DATEADD(day, -{max_age_days}, GETDATE());"
+        )
+        database.execute(self.connection, "\n".join(statements))
+
+    def available(self, keys: list[str]) -> set[str]:
+        """Returns the subset of ``keys`` that has been generated before."""
+        if not keys:
+            return set()
+        in_list = ", ".join(f"'{key}'" for key in keys)
+        result = database.query(
+            self.connection,
+            f"SELECT cohort_hash FROM {self.results_schema}.{self.checksum_table} "
+            f"WHERE cohort_hash IN ({in_list});",
+        )
+        return set(result["cohort_hash"])
+
+    def generate(
+        self,
+        keys: list[str],
+        cohort_names: list[str],
+        cohort_definitions: list,
+        cohort_sql: list[str],
+    ) -> None:
+        """
+        Generates cohorts into the store and records them as available.
+
+        Parameters
+        ----------
+        keys : list[str]
+            The store keys of the cohorts.
+        cohort_names : list[str]
+            The names of the cohorts.
+        cohort_definitions : list
+            The cohort definitions in JSON format, from which CohortGenerator
+            takes the names of the inclusion rules.
+        cohort_sql : list[str]
+            The queries that generate the cohorts.
+        """
+        if not keys:
+            return
+        n = len(keys)
+        cohort_definition_set = ohdsi_common.convert_to_r(
+            pd.DataFrame(
+                {
+                    "cohortId": [float(self.cohort_id(key)) for key in keys],
+                    "cohortName": cohort_names,
+                    "sql": cohort_sql,
+                    "json": cohort_definitions,
+                    "logicDescription": [None] * n,
+                    "generateStats": [True] * n,
+                }
+            )
+        )
+        ohdsi_cohort_generator.generate_cohort_set(
+            connection=self.connection,
+            cdm_database_schema=self.cdm_schema,
+            cohort_database_schema=self.results_schema,
+            cohort_table_names=ohdsi_cohort_generator.get_cohort_table_names(
+                self.table
+            ),
+            cohort_definition_set=cohort_definition_set,
+        )
+
+        in_list = ", ".join(f"'{key}'" for key in keys)
+        values = " UNION ALL ".join(
+            f"SELECT '{key}' AS cohort_hash, {self.cohort_id(key)} "
+            f"AS cohort_definition_id, GETDATE() AS generated_date"
+            for key in keys
+        )
+        database.execute(
+            self.connection,
+            f"DELETE FROM {self.results_schema}.{self.checksum_table} "
+            f"WHERE cohort_hash IN ({in_list});\n"
+            f"INSERT INTO {self.results_schema}.{self.checksum_table} "
+            f"(cohort_hash, cohort_definition_id, generated_date) {values};",
+        )
+
+    def copy_to(self, cohort_table: str, cohorts: list[tuple[str, int]]) -> None:
+        """
+        Copies cohorts from the store into the cohort tables of a task.
+
+        Parameters
+        ----------
+        cohort_table : str
+            Base name of the (already created) cohort tables of the task.
+        cohorts : list[tuple[str, int]]
+            Pairs of store key and the cohort id the cohort has in the task.
+        """
+        statements = []
+        for suffix, columns in COHORT_TABLE_COLUMNS.items():
+            for key, cohort_id in cohorts:
+                statements.append(
+                    f"INSERT INTO {self.results_schema}.{cohort_table}{suffix} "
+                    f"({', '.join(columns)}) "
+                    f"SELECT {cohort_id} AS cohort_definition_id, "
+                    f"{', '.join(columns[1:])} "
+                    f"FROM {self.results_schema}.{self.table}{suffix} "
+                    f"WHERE cohort_definition_id = {self.cohort_id(key)};"
+                )
+        database.execute(self.connection, "\n".join(statements))
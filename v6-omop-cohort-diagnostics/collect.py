@@ -0,0 +1,126 @@
+"""
+Collection of the node results in the central step.
+
+``AlgorithmClient.wait_for_results`` only returns once every node has finished,
+so a single slow node delays all results. The functions below poll the runs of
+the subtask instead, and fetch the result of each run as soon as it has
+finished.
+"""
+
+import time
+from typing import Any, Iterator
+
+from vantage6.algorithm.client import AlgorithmClient
+from vantage6.algorithm.tools.util import info, warn
+from vantage6.common.task_status import has_task_failed, has_task_finished
+
+# Status of the result of an organization that missed the deadline
+TIMED_OUT = "timed_out"
+# Status of the result of an organization whose run failed
+FAILED = "failed"
+
+
+def iter_results(
+    client: AlgorithmClient,
+    task_id: int,
+    poll_interval: float = 10,
+    deadline_seconds: float | None = None,
+) -> Iterator[tuple[int, Any]]:
+    """
+    Yields the results of a task in the order in which the runs finish.
+
+    The progress, the organizations that have finished and those that are
+    still pending, is logged after every poll. Runs that failed are reported
+    as failed, with their log. When the deadline passes, every organization
+    that is still pending is reported as timed out.
+
+    Parameters
+    ----------
+    client : AlgorithmClient
+        Interface to the central server.
+    task_id : int
+        The task of which to collect the results.
+    poll_interval : float, optional
+        Number of seconds between two polls of the run statuses.
+    deadline_seconds : float, optional
+        Number of seconds after which to stop waiting. Waits until all runs
+        have finished if not set.
+
+    Yields
+    ------
+    tuple[int, Any]
+        The organization id and the result of a finished run. For runs that
+        failed, the result is a dictionary with the ``organization_id``, the
+        status ``failed``, the ``run_status`` and the ``log`` of the run. For
+        runs that did not finish before the deadline, it is a dictionary with
+        the ``organization_id`` and the status ``timed_out``.
+    """
+    start = time.monotonic()
+    finished = {}
+    while True:
+        runs = client.run.from_task(task_id)
+        elapsed = time.monotonic() - start
+        for run in runs:
+            if run["id"] in finished or not has_task_finished(run["status"]):
+                continue
+            organization_id = run["organization"]["id"]
+            finished[run["id"]] = organization_id
+            if has_task_failed(run["status"]):
+                warn(
+                    f"Organization {organization_id} finished with status "
+                    f"'{run['status']}' after {elapsed:.0f}s"
+                )
+                yield organization_id, {
+                    "organization_id": organization_id,
+                    "status": FAILED,
+                    "run_status": run["status"],
+                    "log": run.get("log"),
+                }
+                continue
+            info(f"Organization {organization_id} completed after {elapsed:.0f}s")
+            yield organization_id, client.result.get(run["id"])
+
+        pending = [
+            run["organization"]["id"] for run in runs if run["id"] not in finished
+        ]
+        info(
+            f"{len(finished)}/{len(runs)} organizations finished after "
+            f"{elapsed:.0f}s, pending: {pending or 'none'}"
+        )
+        if runs and not pending:
+            return
+        if deadline_seconds is not None:
+            remaining = deadline_seconds - (time.monotonic() - start)
+            if remaining <= 0:
+                warn(f"Deadline of {deadline_seconds}s passed, timed out: {pending}")
+                for organization_id in pending:
+                    yield organization_id, {
+                        "organization_id": organization_id,
+                        "status": TIMED_OUT,
+                    }
+                return
+            time.sleep(min(poll_interval, remaining))
+        else:
+            time.sleep(poll_interval)
+
+
+def kill_task(client: AlgorithmClient, task_id: int) -> None:
+    """
+    Asks the server to kill the runs of a task that are still running.
+
+    Whether an algorithm container may kill its subtasks depends on the
+    server, so a failure is only logged.
+
+    Parameters
+    ----------
+    client : AlgorithmClient
+        Interface to the central server.
+    task_id : int
+        The task to kill.
+    """
+    try:
+        response = client.request("kill/task", method="post", json={"id": task_id})
+    except Exception as e:
+        warn(f"Could not kill task {task_id}: {e}")
+        return
+    info(f"Requested to kill task {task_id}: {response}")
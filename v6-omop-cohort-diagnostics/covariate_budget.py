@@ -0,0 +1,256 @@
+"""
+Caps the number of covariates per domain of the temporal characterization.
+
+Domains such as drug exposures or the era groups can have tens of thousands of
+concepts in a large cohort, most of which only a handful of subjects have.
+Before the characterization runs, the node profiles the concepts of every
+enabled covariate domain within the cohorts and the covariate windows, and
+counts the subjects per concept. When a domain has more concepts above the
+minimum cell count than the budget, only the most prevalent concepts are kept.
+
+FeatureExtraction has a single list of included concepts for all analyses
+(``included_covariate_concept_ids``). When any domain is capped, that list
+contains the kept concepts of every profiled domain and the gender, race and
+ethnicity concepts of the demographics. Concepts below the minimum cell count
+are left out as well, as the diagnostics censor them anyway.
+"""
+
+from typing import TYPE_CHECKING
+
+import pandas as pd
+from rpy2.robjects import RS4
+from vantage6.algorithm.tools.util import info
+
+from . import database
+
+if TYPE_CHECKING:
+    from .node import TaskCohorts
+
+# FeatureExtraction's default window is the year before index
+DEFAULT_START_DAY = -365
+DEFAULT_END_DAY = -1
+
+# Concept, start date and end date column of the tables of the domains
+DOMAIN_TABLES = {
+    "condition_occurrence": (
+        "condition_concept_id",
+        "condition_start_date",
+        "condition_end_date",
+    ),
+    "condition_era": (
+        "condition_concept_id",
+        "condition_era_start_date",
+        "condition_era_end_date",
+    ),
+    "drug_exposure": (
+        "drug_concept_id",
+        "drug_exposure_start_date",
+        "drug_exposure_end_date",
+    ),
+    "drug_era": ("drug_concept_id", "drug_era_start_date", "drug_era_end_date"),
+    "procedure_occurrence": (
+        "procedure_concept_id",
+        "procedure_date",
+        "procedure_date",
+    ),
+    "device_exposure": (
+        "device_concept_id",
+        "device_exposure_start_date",
+        "device_exposure_end_date",
+    ),
+    "measurement": ("measurement_concept_id", "measurement_date", "measurement_date"),
+    "observation": ("observation_concept_id", "observation_date", "observation_date"),
+    "visit_occurrence": ("visit_concept_id", "visit_start_date", "visit_end_date"),
+}
+
+# Table of a covariate flag, by prefix of the flag, and whether the covariates
+# are concept groups (ancestors of the recorded concepts). The first matching
+# prefix is used.
+COVARIATE_DOMAINS = (
+    ("use_condition_occurrence", "condition_occurrence", False),
+    ("use_condition_era_group", "condition_era", True),
+    ("use_condition_era", "condition_era", False),
+    ("use_drug_exposure", "drug_exposure", False),
+    ("use_drug_era_group", "drug_era", True),
+    ("use_drug_era", "drug_era", False),
+    ("use_procedure_occurrence", "procedure_occurrence", False),
+    ("use_device_exposure", "device_exposure", False),
+    ("use_measurement", "measurement", False),
+    ("use_observation", "observation", False),
+    ("use_visit_concept_count", "visit_occurrence", False),
+)
+
+
+def _domains(temporal_covariate_settings: dict) -> dict[str, tuple[str, bool]]:
+    """Returns the table and grouping of the enabled covariate flags, by name."""
+    domains = {}
+    for flag, enabled in temporal_covariate_settings.items():
+        if not flag.startswith("use_") or enabled is not True:
+            continue
+        for prefix, table, group in COVARIATE_DOMAINS:
+            if flag.startswith(prefix):
+                domains[f"{table}_group" if group else table] = (table, group)
+                break
+    return domains
+
+
+def profile_domain(
+    connection: RS4,
+    cdm_schema: str,
+    results_schema: str,
+    cohorts: "TaskCohorts",
+    table: str,
+    group: bool,
+    start_day: int,
+    end_day: int,
+    min_cell_count: int,
+) -> pd.DataFrame:
+    """
+    Counts the subjects per concept of a domain within the cohorts.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    cdm_schema : str
+        Schema that contains the CDM tables.
+    results_schema : str
+        Schema that contains the cohort table.
+    cohorts : TaskCohorts
+        The generated cohorts.
+    table : str
+        The CDM table of the domain.
+    group : bool
+        Whether to count the ancestors of the concepts, for the concept group
+        covariates.
+    start_day : int
+        The first day of the covariate windows, relative to the cohort start.
+    end_day : int
+        The last day of the covariate windows, relative to the cohort start.
+    min_cell_count : int
+        Concepts with fewer subjects are left out.
+
+    Returns
+    -------
+    pd.DataFrame
+        The ``concept_id`` and number of ``subjects`` of every concept, by
+        decreasing number of subjects.
+    """
+    concept, start, end = DOMAIN_TABLES[table]
+    ids = ", ".join(
+        str(int(cohort_id)) for cohort_id in cohorts.definition_set["cohortId"]
+    )
+    if group:
+        concept_id = "ca.ancestor_concept_id"
+        join = (
+            f"INNER JOIN {cdm_schema}.concept_ancestor ca "
+            f"ON ca.descendant_concept_id = d.{concept} "
+        )
+    else:
+        concept_id = f"d.{concept}"
+        join = ""
+    result = database.query(
+        connection,
+        f"SELECT {concept_id} AS concept_id, "
+        f"COUNT_BIG(DISTINCT c.subject_id) AS subjects "
+        f"FROM {results_schema}.{cohorts.table} c "
+        f"INNER JOIN {cdm_schema}.{table} d ON d.person_id = c.subject_id "
+        f"AND COALESCE(d.{end}, d.{start}) >= "
+        f"DATEADD(day, {start_day}, c.cohort_start_date) "
+        f"AND d.{start} <= DATEADD(day, {end_day}, c.cohort_start_date) "
+        f"{join}"
+        f"WHERE c.cohort_definition_id IN ({ids}) AND d.{concept} != 0 "
+        f"GROUP BY {concept_id} "
+        f"HAVING COUNT_BIG(DISTINCT c.subject_id) >= {min_cell_count};",
+    )
+    return result.sort_values(
+        ["subjects", "concept_id"], ascending=[False, True]
+    ).reset_index(drop=True)
+
+
+def _demographic_concepts(connection: RS4, cdm_schema: str) -> list[int]:
+    result = database.query(
+        connection,
+        f"SELECT DISTINCT gender_concept_id AS concept_id FROM {cdm_schema}.person "
+        f"UNION SELECT DISTINCT race_concept_id FROM {cdm_schema}.person "
+        f"UNION SELECT DISTINCT ethnicity_concept_id FROM {cdm_schema}.person;",
+    )
+    return [int(concept_id) for concept_id in result["concept_id"].dropna()]
+
+
+def apply_covariate_budget(
+    connection: RS4,
+    cdm_schema: str,
+    results_schema: str,
+    cohorts: "TaskCohorts",
+    temporal_covariate_settings: dict,
+    budget: int,
+    min_cell_count: int,
+) -> tuple[dict, dict]:
+    """
+    Caps every covariate domain to the ``budget`` most prevalent concepts.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    cdm_schema : str
+        Schema that contains the CDM tables.
+    results_schema : str
+        Schema that contains the cohort table.
+    cohorts : TaskCohorts
+        The generated cohorts.
+    temporal_covariate_settings : dict
+        Arguments for FeatureExtraction's temporal covariate settings.
+    budget : int
+        The maximum number of concepts per domain.
+    min_cell_count : int
+        Concepts with fewer subjects are left out of a capped characterization.
+
+    Returns
+    -------
+    tuple[dict, dict]
+        The temporal covariate settings to use, and a report with the number
+        of concepts and the number of kept concepts per domain.
+    """
+    if temporal_covariate_settings.get("included_covariate_concept_ids"):
+        info("Covariate budget not applied, the task includes its own concepts")
+        return temporal_covariate_settings, {}
+
+    start_day = min(
+        temporal_covariate_settings.get("temporal_start_days") or [DEFAULT_START_DAY]
+    )
+    end_day = max(
+        temporal_covariate_settings.get("temporal_end_days") or [DEFAULT_END_DAY]
+    )
+    report = {}
+    included = set()
+    for name, (table, group) in _domains(temporal_covariate_settings).items():
+        concepts = profile_domain(
+            connection,
+            cdm_schema,
+            results_schema,
+            cohorts,
+            table,
+            group,
+            start_day,
+            end_day,
+            min_cell_count,
+        )
+        kept = concepts["concept_id"].head(budget)
+        included.update(int(concept_id) for concept_id in kept)
+        report[name] = {"concepts": len(concepts), "kept": len(kept)}
+    info(f"Covariate concepts per domain: {report}")
+
+    if all(domain["kept"] == domain["concepts"] for domain in report.values()):
+        return temporal_covariate_settings, report
+
+    included.update(_demographic_concepts(connection, cdm_schema))
+    info(
+        f"Capped the covariates to {budget} concepts per domain, including "
+        f"{len(included)} concepts"
+    )
+    return {
+        **temporal_covariate_settings,
+        "included_covariate_concept_ids": sorted(included),
+    }, report
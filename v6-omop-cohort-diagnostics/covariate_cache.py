@@ -0,0 +1,339 @@
+"""
+On-node cache of the temporal characterization, per cohort and window.
+
+The temporal characterization computes every covariate for every cohort and
+every window on every task. Its results only depend on the cohort rows, the
+covariate settings, the window, the data and the minimum cell count. The
+cohort rows follow from the cohort SQL and the data, so a cohort is identified
+by a hash of its SQL, and the other inputs are part of the settings key.
+
+The characterization tables of a CohortDiagnostics export are split per cohort
+and window and stored as Parquet files, one folder per entry. The covariates
+that do not depend on a window (such as the demographics) are stored as the
+window ``None``. Entries are evicted least-recently-used when the cache
+exceeds its size, like the cohort SQL cache.
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+from pathlib import Path
+
+import pandas as pd
+from vantage6.algorithm.tools.util import info, warn
+
+from .cache import content_hash, normalize_json
+
+# Files of the temporal characterization in a CohortDiagnostics export
+VALUE_FILES = ("temporal_covariate_value.csv", "temporal_covariate_value_dist.csv")
+COVARIATE_REF_FILE = "temporal_covariate_ref.csv"
+ANALYSIS_REF_FILE = "temporal_analysis_ref.csv"
+TIME_REF_FILE = "temporal_time_ref.csv"
+CHARACTERIZATION_FILES = VALUE_FILES + (
+    COVARIATE_REF_FILE,
+    ANALYSIS_REF_FILE,
+    TIME_REF_FILE,
+)
+
+# FeatureExtraction's default windows are every day of the year before index
+DEFAULT_DAYS = list(range(-365, 0))
+
+Window = tuple[int, int] | None
+
+
+def covariate_windows(temporal_covariate_settings: dict) -> list[tuple[int, int]]:
+    """
+    Returns the windows of temporal covariate settings, in order.
+
+    FeatureExtraction numbers the windows from 1 in this order (the time id).
+    """
+    starts = temporal_covariate_settings.get("temporal_start_days") or DEFAULT_DAYS
+    ends = temporal_covariate_settings.get("temporal_end_days") or DEFAULT_DAYS
+    return [(int(start), int(end)) for start, end in zip(starts, ends)]
+
+
+def covariate_settings_key(temporal_covariate_settings: dict, *parts: str) -> str:
+    """
+    Computes the key of the covariate settings, without the windows.
+
+    Parameters
+    ----------
+    temporal_covariate_settings : dict
+        Arguments for FeatureExtraction's temporal covariate settings.
+    *parts : str
+        The other inputs of the characterization, such as the CDM data version.
+
+    Returns
+    -------
+    str
+        The hexadecimal key.
+    """
+    covariates = {
+        key: value
+        for key, value in temporal_covariate_settings.items()
+        if key not in ("temporal_start_days", "temporal_end_days")
+    }
+    return content_hash(normalize_json(covariates), *parts)
+
+
+class CovariateCache:
+    """
+    Size-bounded LRU cache of characterization results stored on disk.
+
+    Parameters
+    ----------
+    folder : Path
+        Directory in which the cache entries are stored. Created if missing.
+    max_bytes : int
+        Maximum total size of all entries, over all settings.
+    settings_key : str
+        Key of the covariate settings of the current task.
+    """
+
+    def __init__(self, folder: Path, max_bytes: int, settings_key: str):
+        self.root = Path(folder)
+        self.folder = self.root / settings_key[:16]
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, cohort_key: str, window: Window) -> Path:
+        name = "all" if window is None else f"{window[0]}_{window[1]}"
+        return self.folder / f"{cohort_key[:16]}_{name}"
+
+    def has(self, cohort_key: str, window: Window) -> bool:
+        """Whether the cache has an entry for the cohort and window."""
+        if self._path(cohort_key, window).is_dir():
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def get(self, cohort_key: str, window: Window) -> dict[str, pd.DataFrame] | None:
+        """Returns the tables of the cohort and window, or ``None`` if missing."""
+        path = self._path(cohort_key, window)
+        try:
+            tables = {
+                file_.stem + ".csv": pd.read_parquet(file_)
+                for file_ in path.glob("*.parquet")
+            }
+            # mark as recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return tables or None
+
+    def put(
+        self, cohort_key: str, window: Window, tables: dict[str, pd.DataFrame]
+    ) -> None:
+        """Stores the tables of the cohort and window."""
+        # write to a temporary folder first, so that concurrent tasks never
+        # read a partially written entry
+        tmp = Path(tempfile.mkdtemp(dir=self.folder, suffix=".tmp"))
+        for name, table in tables.items():
+            table.to_parquet(
+                tmp / f"{name[:-len('.csv')]}.parquet",
+                index=False,
+                compression="zstd",
+            )
+        try:
+            os.replace(tmp, self._path(cohort_key, window))
+        except OSError:
+            # stored by a concurrent task in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the cache fits."""
+        entries = []
+        for path in self.root.glob("*/*"):
+            if path.suffix == ".tmp":
+                # being written by a concurrent task
+                continue
+            try:
+                size = sum(file_.stat().st_size for file_ in path.iterdir())
+                entries.append((path.stat().st_mtime, size, path))
+            except (FileNotFoundError, NotADirectoryError):
+                # removed by a concurrent task
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def log_stats(self) -> None:
+        """Writes the hit and miss counts to the node log."""
+        info(f"Covariate cache: {self.hits} hit(s), {self.misses} miss(es)")
+
+
+def open_covariate_cache(
+    folder: Path, max_mb: int, settings_key: str
+) -> CovariateCache | None:
+    """
+    Opens the covariate cache, or returns ``None`` when it is disabled.
+
+    Parameters
+    ----------
+    folder : Path
+        The cache directory.
+    max_mb : int
+        The maximum cache size in megabytes. Zero disables the cache.
+    settings_key : str
+        Key of the covariate settings of the current task.
+
+    Returns
+    -------
+    CovariateCache | None
+        The cache, or ``None`` if caching is disabled or not possible.
+    """
+    if max_mb <= 0:
+        return None
+    try:
+        return CovariateCache(folder, max_mb * 1024 * 1024, settings_key)
+    except OSError as e:
+        warn(f"Covariate cache disabled, cannot use {folder}: {e}")
+        return None
+
+
+def _read_csv(zip_: zipfile.ZipFile, name: str) -> pd.DataFrame | None:
+    if name not in zip_.namelist():
+        return None
+    with zip_.open(name) as f:
+        # strings, so the values are stored exactly as exported
+        return pd.read_csv(f, dtype=str, keep_default_na=False)
+
+
+def _cohort_id(value: str) -> int:
+    return int(float(value))
+
+
+def split_characterization(
+    file_: Path, cohort_keys: dict[int, str]
+) -> dict[tuple[str, Window], dict[str, pd.DataFrame]]:
+    """
+    Splits the characterization of a results zip per cohort and window.
+
+    Parameters
+    ----------
+    file_ : Path
+        The results zip of a CohortDiagnostics run.
+    cohort_keys : dict[int, str]
+        The cache key of every cohort id in the run.
+
+    Returns
+    -------
+    dict[tuple[str, Window], dict[str, pd.DataFrame]]
+        The characterization tables per cohort key and window, with the
+        covariate and analysis references of their covariates.
+    """
+    with zipfile.ZipFile(file_) as zip_:
+        values = {name: _read_csv(zip_, name) for name in VALUE_FILES}
+        covariate_ref = _read_csv(zip_, COVARIATE_REF_FILE)
+        analysis_ref = _read_csv(zip_, ANALYSIS_REF_FILE)
+        time_ref = _read_csv(zip_, TIME_REF_FILE)
+    values = {name: table for name, table in values.items() if table is not None}
+    if not values:
+        warn(f"No characterization in {file_.name}, nothing to cache")
+        return {}
+    run_windows = {
+        row.time_id: (int(row.start_day), int(row.end_day))
+        for row in (time_ref if time_ref is not None else pd.DataFrame()).itertuples()
+    }
+
+    entries = {}
+    for cohort_id, cohort_key in cohort_keys.items():
+        for time_id, window in [("", None), *run_windows.items()]:
+            tables = {}
+            for name, table in values.items():
+                if window is None:
+                    in_window = table["time_id"].isin(("", "NA"))
+                else:
+                    in_window = table["time_id"] == time_id
+                # the ids are rewritten when the characterization of a task
+                # is assembled, the columns are kept for their order
+                tables[name] = table[
+                    (table["cohort_id"].map(_cohort_id) == cohort_id) & in_window
+                ]
+            covariates = pd.concat(
+                [table["covariate_id"] for table in tables.values()]
+            ).unique()
+            if covariate_ref is not None:
+                tables[COVARIATE_REF_FILE] = covariate_ref[
+                    covariate_ref["covariate_id"].isin(covariates)
+                ]
+                if analysis_ref is not None:
+                    tables[ANALYSIS_REF_FILE] = analysis_ref[
+                        analysis_ref["analysis_id"].isin(
+                            tables[COVARIATE_REF_FILE]["analysis_id"]
+                        )
+                    ]
+            entries[(cohort_key, window)] = tables
+    return entries
+
+
+def assemble_characterization(
+    entries: dict[tuple[int, Window], dict[str, pd.DataFrame]],
+    task_windows: list[tuple[int, int]],
+    database_id: str,
+) -> dict[str, str]:
+    """
+    Builds the characterization files of a results zip from cache entries.
+
+    Parameters
+    ----------
+    entries : dict[tuple[int, Window], dict[str, pd.DataFrame]]
+        The tables per cohort id and window.
+    task_windows : list[tuple[int, int]]
+        The windows of the task, in the order of the time ids.
+    database_id : str
+        The database id in the results.
+
+    Returns
+    -------
+    dict[str, str]
+        The contents of the CSV files, by file name.
+    """
+    time_ids = {}
+    for time_id, window in enumerate(task_windows, start=1):
+        time_ids.setdefault(window, []).append(str(time_id))
+
+    parts = {name: [] for name in CHARACTERIZATION_FILES}
+    for (cohort_id, window), tables in entries.items():
+        for name, table in tables.items():
+            if name not in VALUE_FILES:
+                parts[name].append(table)
+                continue
+            for time_id in [""] if window is None else time_ids[window]:
+                parts[name].append(
+                    table.assign(
+                        cohort_id=str(cohort_id),
+                        time_id=time_id,
+                        database_id=database_id,
+                    )
+                )
+    parts[TIME_REF_FILE].append(
+        pd.DataFrame(
+            {
+                "time_id": [str(i) for i in range(1, len(task_windows) + 1)],
+                "start_day": [str(start) for start, _ in task_windows],
+                "end_day": [str(end) for _, end in task_windows],
+            }
+        )
+    )
+
+    files = {}
+    for name, tables in parts.items():
+        if not tables:
+            continue
+        table = pd.concat(tables, ignore_index=True)
+        if name not in VALUE_FILES:
+            table = table.drop_duplicates()
+        out = io.StringIO()
+        table.to_csv(out, index=False)
+        files[name] = out.getvalue()
+    return files
@@ -0,0 +1,254 @@
+"""
+Small helpers to run OHDSI SQL against the OMOP database.
+
+The SQL is written in the OHDSI SQL dialect (SQL Server) and translated to the
+dialect of the connection by SqlRender. Schema and table names are interpolated
+in Python, as they come from the node configuration and not from the user.
+"""
+
+import pandas as pd
+
+from rpy2.robjects import RS4
+from rpy2.rinterface_lib.embedded import RRuntimeError
+from rpy2.robjects.packages import importr
+from ohdsi import common as ohdsi_common
+
+from .cache import content_hash, normalize_json
+
+# The python-ohdsi wrapper only exposes querySql and executeSql, which do not
+# translate the SQL to the dialect of the connection
+database_connector_r = importr("DatabaseConnector")
+
+# Parts of the messages with which the dialects report a duplicate key
+DUPLICATE_KEY_MESSAGES = (
+    "duplicate key",  # PostgreSQL, SQL Server unique indexes
+    "violation of primary key",  # SQL Server
+    "ora-00001",  # Oracle
+    "unique constraint",  # SQLite, Oracle
+    "duplicate entry",  # MySQL-based dialects
+)
+
+
+def query(connection: RS4, sql: str) -> pd.DataFrame:
+    """
+    Runs a query and returns the result with lower case column names.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    sql : str
+        The query, in OHDSI SQL.
+
+    Returns
+    -------
+    pd.DataFrame
+        The query result.
+    """
+    result = ohdsi_common.convert_from_r(
+        database_connector_r.renderTranslateQuerySql(connection, sql)
+    )
+    result.columns = [column.lower() for column in result.columns]
+    return result
+
+
+def execute(connection: RS4, sql: str) -> None:
+    """
+    Executes one or more SQL statements that do not return a result.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    sql : str
+        The statements, in OHDSI SQL.
+    """
+    database_connector_r.renderTranslateExecuteSql(
+        connection, sql, progressBar=False, reportOverallTime=False
+    )
+
+
+def insert_unique(connection: RS4, sql: str) -> bool:
+    """
+    Executes an insert that may violate a primary key.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    sql : str
+        The insert, in OHDSI SQL.
+
+    Returns
+    -------
+    bool
+        False if the insert violated a primary key (or unique constraint),
+        True otherwise. Other errors are raised.
+    """
+    try:
+        execute(connection, sql)
+    except RRuntimeError as e:
+        message = str(e).lower()
+        if not any(pattern in message for pattern in DUPLICATE_KEY_MESSAGES):
+            raise
+        return False
+    return True
+
+
+def cdm_data_version(connection: RS4, cdm_schema: str) -> str:
+    """
+    Describes the version of the data in the CDM.
+
+    The description is taken from the ``cdm_source`` table, which the ETL
+    updates on every data release. It changes when the data, the CDM version or
+    the vocabulary version changes.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    cdm_schema : str
+        Schema that contains the CDM tables.
+
+    Returns
+    -------
+    str
+        Canonical JSON description of the data version.
+    """
+    cdm_source = query(
+        connection,
+        f"SELECT cdm_source_name, cdm_release_date, source_release_date, "
+        f"cdm_version, vocabulary_version FROM {cdm_schema}.cdm_source;",
+    )
+    return normalize_json(cdm_source.astype(str).to_dict("records"))
+
+
+def cdm_release_dated(connection: RS4, cdm_schema: str) -> bool:
+    """
+    Whether the ``cdm_source`` table records a release date of the data.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    cdm_schema : str
+        Schema that contains the CDM tables.
+
+    Returns
+    -------
+    bool
+        ``True`` if a CDM or source release date is set.
+    """
+    result = query(
+        connection,
+        f"SELECT COUNT(*) AS dated FROM {cdm_schema}.cdm_source "
+        f"WHERE cdm_release_date IS NOT NULL OR source_release_date IS NOT NULL;",
+    )
+    return int(result["dated"].iloc[0]) > 0
+
+
+def index_cohort_table(connection: RS4, dbms: str, schema: str, table: str) -> None:
+    """
+    Optimizes a cohort table for the joins that CohortDiagnostics runs.
+
+    The diagnostics mostly select a cohort and join on subject and start date.
+    Dialects with indexes get an index for both access paths and fresh
+    statistics. Snowflake and Spark use clustering instead. Other dialects
+    without indexes are left alone.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    dbms : str
+        The database management system, as used by DatabaseConnector.
+    schema : str
+        Schema that contains the cohort table.
+    table : str
+        Name of the cohort table.
+    """
+    columns = "cohort_definition_id, subject_id, cohort_start_date"
+    if dbms == "snowflake":
+        sql = f"ALTER TABLE {schema}.{table} CLUSTER BY ({columns});"
+    elif dbms == "spark":
+        sql = f"OPTIMIZE {schema}.{table} ZORDER BY ({columns});"
+    elif dbms in ("redshift", "bigquery", "netezza", "pdw", "synapse", "impala"):
+        return
+    else:
+        # index names are limited to 30 characters on Oracle
+        name = f"idx_{content_hash(schema, table)[:16]}"
+        sql = (
+            f"CREATE INDEX {name}_c ON {schema}.{table} ({columns});\n"
+            f"CREATE INDEX {name}_s ON {schema}.{table} "
+            f"(subject_id, cohort_start_date);\n"
+            f"UPDATE STATISTICS {schema}.{table};"
+        )
+    execute(connection, sql)
+
+
+def sample_cohort_table(
+    connection: RS4,
+    schema: str,
+    source: str,
+    target: str,
+    sample_size: int,
+    seed: int,
+) -> pd.DataFrame:
+    """
+    Copies a random sample of the subjects of every cohort to another table.
+
+    The subjects are ordered by a pseudo-random hash of their id, the Lehmer
+    generator of Fishman and Moore, which all dialects can compute. The seed
+    offsets the ids, so every seed gives a different sample, and the same seed
+    the same sample. All entries of a sampled subject are copied.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    schema : str
+        Schema that contains the cohort tables.
+    source : str
+        Name of the cohort table to sample from.
+    target : str
+        Name of the (existing) cohort table to copy the sample to.
+    sample_size : int
+        The maximum number of subjects per cohort.
+    seed : int
+        The seed of the sample.
+
+    Returns
+    -------
+    pd.DataFrame
+        For every cohort, the ``subjects`` in the source table and the
+        ``sampled_subjects`` in the target table.
+    """
+    offset = int(content_hash(str(seed))[:8], 16) % 2147483647
+    random = f"((subject_id + {offset}) % 2147483647) * 950706376 % 2147483647"
+    execute(
+        connection,
+        f"INSERT INTO {schema}.{target} "
+        f"(cohort_definition_id, subject_id, cohort_start_date, cohort_end_date) "
+        f"SELECT c.cohort_definition_id, c.subject_id, c.cohort_start_date, "
+        f"c.cohort_end_date "
+        f"FROM {schema}.{source} c "
+        f"INNER JOIN ("
+        f"SELECT cohort_definition_id, subject_id, ROW_NUMBER() OVER ("
+        f"PARTITION BY cohort_definition_id ORDER BY {random}, subject_id"
+        f") AS rn FROM ("
+        f"SELECT DISTINCT cohort_definition_id, subject_id FROM {schema}.{source}"
+        f") subjects"
+        f") s ON c.cohort_definition_id = s.cohort_definition_id "
+        f"AND c.subject_id = s.subject_id "
+        f"WHERE s.rn <= {sample_size};",
+    )
+    return query(
+        connection,
+        f"SELECT a.cohort_definition_id, a.subjects, "
+        f"COALESCE(b.subjects, 0) AS sampled_subjects "
+        f"FROM (SELECT cohort_definition_id, COUNT(DISTINCT subject_id) AS subjects "
+        f"FROM {schema}.{source} GROUP BY cohort_definition_id) a "
+        f"LEFT JOIN (SELECT cohort_definition_id, COUNT(DISTINCT subject_id) AS subjects "
+        f"FROM {schema}.{target} GROUP BY cohort_definition_id) b "
+        f"ON a.cohort_definition_id = b.cohort_definition_id;",
+    )
@@ -0,0 +1,51 @@
+"""
+Decorators for the central step of the algorithm.
+
+The decorators module of vantage6 imports the OHDSI packages to offer the
+``database_connection`` decorator, which starts R and the JVM. The central step
+only needs an algorithm client, so it uses the equivalent decorator below.
+"""
+
+import os
+from functools import wraps
+
+from vantage6.algorithm.client import AlgorithmClient
+from vantage6.algorithm.tools.util import info
+
+
+def algorithm_client(func: callable) -> callable:
+    """
+    Decorator that adds an algorithm client object to a function.
+
+    This behaves like ``vantage6.algorithm.tools.decorators.algorithm_client``,
+    including the reserved ``mock_client`` argument.
+
+    Parameters
+    ----------
+    func : callable
+        Function to decorate
+
+    Returns
+    -------
+    callable
+        Decorated function
+    """
+
+    @wraps(func)
+    def decorator(*args, mock_client=None, **kwargs) -> callable:
+        if mock_client is not None:
+            return func(mock_client, *args, **kwargs)
+        info("Reading token")
+        with open(os.environ["TOKEN_FILE"]) as fp:
+            token = fp.read().strip()
+        client = AlgorithmClient(
+            token=token,
+            host=os.environ["HOST"],
+            port=os.environ["PORT"],
+            path=os.environ["API_PATH"],
+        )
+        return func(client, *args, **kwargs)
+
+    # the mock client checks this attribute
+    decorator.wrapped_in_algorithm_client_decorator = True
+    return decorator
@@ -1,21 +1,29 @@
-from vantage6.algorithm.tools.mock_client import MockAlgorithmClient
+"""
+Runs the central step of the algorithm locally with the vantage6 mock client.
 
+The node step needs R and an OMOP database, so the nodes are simulated by the
+stubbed node functions of ``benchmarks/mock_node.py``. See
+``benchmarks/federation_overhead.py`` to measure the central step and the
+client with many organizations.
+"""
+
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+from mock_node import MockClient  # noqa: E402
 
 ## Mock client
-client = MockAlgorithmClient(
+client = MockClient(
     datasets=[
-        {
-            "database": "local/data.csv",
-            "type": "csv",
-            "input_data": {}
-        },
-        {
-            "database": "local/data.csv",
-            "type": "csv",
-            "input_data": {}
-        }
+        [{"database": pd.DataFrame()}],
+        [{"database": pd.DataFrame()}],
     ],
-    module="v6-boilerplate-py"
+    module="mock_node",
 )
 
 # list mock organizations
@@ -23,27 +31,30 @@ organizations = client.organization.list()
 print(organizations)
 org_ids = [organization["id"] for organization in organizations]
 
-# Run a method in the algorithm for all nodes
-task = client.task.create(
+# Load the cohort definitions
+files = sorted((ROOT / "cohort_definitions").glob("*.json"))
+
+# Run the central method on 1 node, it creates the subtasks for all nodes
+central_task = client.task.create(
     input_={
-        "method":"some_example_method",
+        "method": "cohort_diagnostics_central",
         "kwargs": {
-            "example_arg": "example_value"
-        }
+            "cohort_definitions": [file_.read_text() for file_ in files],
+            "cohort_names": [file_.stem for file_ in files],
+            "meta_cohorts": [{"task_id": 1}],
+            "temporal_covariate_settings": {},
+            "diagnostics_settings": {},
+            "poll_interval": 0,
+        },
     },
-    organizations=org_ids)
-print(task)
-
-# Get the results from the task
-results = client.result.get(task.get("id"))
-# or, alternatively:
-# results = client.wait_for_results(task.get("id"))
-print(results)
-
-# Run the central method on 1 node and get the results
-central_task = client.task.create(
-    input_={"method":"some_central_method"},
-    organizations=[org_ids[0]]
+    organizations=[org_ids[0]],
 )
-results = client.result.from_task(task.get("id"))
-print(results)
+print(central_task)
+
+# Get the results from the task, one per node
+results = client.result.from_task(central_task.get("id"))
+for result in results[-1]:
+    print(
+        f"organization {result['organization_id']}: "
+        f"{sum(len(chunk) for chunk in result['zip_chunks'])} encoded bytes"
+    )
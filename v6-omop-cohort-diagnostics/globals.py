@@ -4,4 +4,102 @@
 # The minimum cell count for fields, contains person counts or fractions. To be
 # overwritten by setting the "CD_MIN_RECORDS" environment variable. It corresponds 
 # to OHDSI's CohortDiagnostics min_cell_count variable.
-DEFAULT_CD_MIN_RECORDS = "5"
\ No newline at end of file
+DEFAULT_CD_MIN_RECORDS = "5"
+
+# Compiled cohort SQL is cached on the node, keyed by the cohort definition, the
+# Circe version and the generate options. The cache is stored in the folder set
+# by "CD_SQL_CACHE_DIR" (by default a "cache" folder in the OHDSI export folder,
+# which only lives as long as the task, so point it to a mounted volume) and is
+# limited to "CD_SQL_CACHE_MAX_MB" megabytes. Setting the size to 0 disables the
+# cache.
+DEFAULT_CD_SQL_CACHE_MAX_MB = "64"
+
+# Generated cohorts can be kept in a persistent store in the results schema and
+# reused by later tasks, as long as the cohort SQL, the CDM schema and the CDM
+# data version (from the cdm_source table) are unchanged. Set "CD_COHORT_STORE"
+# to "true" to enable the store. It is only used when cdm_source has a release
+# date, so make sure the ETL updates cdm_source on every data release.
+DEFAULT_CD_COHORT_STORE = "false"
+
+# Cohorts in the store that were generated more than "CD_COHORT_STORE_MAX_AGE_DAYS"
+# days ago are removed from the store and generated again. This bounds both the
+# size of the store and the age of a reused cohort, also when cdm_source is not
+# updated after a data refresh. The value 0 keeps cohorts forever.
+DEFAULT_CD_COHORT_STORE_MAX_AGE_DAYS = "30"
+
+# In incremental mode, the results of earlier runs are kept in the folder set by
+# "CD_INCREMENTAL_DIR". The default is an "incremental" folder in the OHDSI
+# export folder, which only lives as long as the task, so incremental mode only
+# reuses results when this points to a mounted volume.
+DEFAULT_CD_INCREMENTAL_DIR = ""
+
+# The results zip is read and base64-encoded in chunks of "CD_RESULT_CHUNK_SIZE"
+# bytes, so the node never holds the raw zip in memory next to its encoding. All
+# encoded chunks are part of the node result, so the node still holds the
+# complete encoding and its memory is not bounded by the chunk size. The size is
+# rounded down to a multiple of 3.
+DEFAULT_CD_RESULT_CHUNK_SIZE = "3145728"
+
+# The diagnostics can be computed in parallel, by splitting the cohorts over
+# "CD_DIAGNOSTICS_SHARDS" groups. Every group runs in its own process, with its
+# own database connection. The default of 1 runs all cohorts in one process.
+DEFAULT_CD_DIAGNOSTICS_SHARDS = "1"
+
+# After the cohorts have been generated, the cohort table is indexed (or
+# clustered, depending on the database) for the joins of the diagnostics. Set
+# "CD_INDEX_COHORT_TABLES" to "false" to skip this step.
+DEFAULT_CD_INDEX_COHORT_TABLES = "true"
+
+# Concept sets that several cohorts of a task share are expanded through the
+# vocabulary once, into a shared table that the cohort queries read from. Set
+# "CD_SHARED_CODESETS" to "false" to let every cohort query expand its own
+# concept sets.
+DEFAULT_CD_SHARED_CODESETS = "true"
+
+# Memory limits of R and the JVM, in MB. "CD_JVM_MAX_HEAP_MB" sets the maximum
+# heap of the JVM that runs DatabaseConnector, Circe and FeatureExtraction, which
+# also bounds the batches in which query results are fetched. "CD_R_MAX_VSIZE_MB"
+# sets the maximum vector heap of R. The default of 0 keeps the defaults of the
+# base image. Both are checked against the memory limit of the container.
+DEFAULT_CD_JVM_MAX_HEAP_MB = "0"
+DEFAULT_CD_R_MAX_VSIZE_MB = "0"
+
+# The maximum number of database sessions that the algorithm opens at the same
+# time. Every diagnostics shard opens a session next to the one of the main
+# process, so this caps "CD_DIAGNOSTICS_SHARDS". The default of 0 sets no limit.
+DEFAULT_CD_MAX_DB_SESSIONS = "0"
+
+# Before the diagnostics run, the node estimates their cost from the sizes of
+# the cohorts and the CDM tables. "CD_PREFLIGHT_ROWS_PER_SECOND" is the number
+# of rows the database processes per second, which converts the estimate to
+# seconds. Measure it with the benchmark on the node's database for a better
+# estimate.
+DEFAULT_CD_PREFLIGHT_ROWS_PER_SECOND = "1000000"
+
+# Counting the rows of the CDM tables is slow on some databases, so the counts
+# are stored per CDM data version in the folder set by "CD_PREFLIGHT_CACHE_DIR".
+# The default is a "preflight" folder in the OHDSI export folder, which only
+# lives as long as the task, so point it to a mounted volume to count once.
+DEFAULT_CD_PREFLIGHT_CACHE_DIR = ""
+
+# The time budget of the diagnostics on this node, in seconds. When a task runs
+# with the "enforce" budget policy, the most expensive covariates and
+# diagnostics are skipped until the estimate fits the budget. The default of 0
+# sets no budget.
+DEFAULT_CD_TIME_BUDGET_SECONDS = "0"
+
+# The temporal characterization is cached on the node per cohort and window,
+# keyed by the cohort SQL, the covariate settings, the CDM data version and the
+# minimum cell count. Later tasks only characterize the cohorts and windows
+# that are not in the cache. The cache is stored as Parquet in the folder set
+# by "CD_COVARIATE_CACHE_DIR" (by default a "covariate_cache" folder in the
+# OHDSI export folder, which only lives as long as the task, so point it to a
+# mounted volume) and is limited to "CD_COVARIATE_CACHE_MAX_MB" megabytes. The
+# default of 0 disables the cache.
+DEFAULT_CD_COVARIATE_CACHE_MAX_MB = "0"
+
+# The concept sets of the cohorts are expanded through the vocabulary once per
+# vocabulary version, into the cd_concept_set_cache tables of the schema set by
+# "CD_VOCABULARY_CACHE_SCHEMA", and cohort generation reads them from there.
+# The default of an empty string expands them for every task.
+DEFAULT_CD_VOCABULARY_CACHE_SCHEMA = ""
@@ -0,0 +1,104 @@
+"""
+Instrumentation of the phases of a node run.
+
+Every phase records its wall time, its CPU time and the peak resident set size
+of the process at the end of the phase. R and the JVM run inside the Python
+process, so their CPU time and memory are included. The CPU time of child
+processes that finished during the phase is included as well.
+"""
+
+import time
+import resource
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def _cpu_seconds() -> float:
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Metrics:
+    """Collects the timing and memory usage of consecutive phases."""
+
+    def __init__(self):
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Measures the enclosed block as the phase ``name``.
+
+        Parameters
+        ----------
+        name : str
+            Name of the phase.
+        """
+        wall = time.perf_counter()
+        cpu = _cpu_seconds()
+        try:
+            yield
+        finally:
+            self.phases.append(
+                {
+                    "phase": name,
+                    "wall_seconds": round(time.perf_counter() - wall, 3),
+                    "cpu_seconds": round(_cpu_seconds() - cpu, 3),
+                    "peak_rss_mb": round(_peak_rss_mb(), 1),
+                }
+            )
+
+    def to_dict(self) -> dict:
+        """Returns the metrics in a JSON serializable form."""
+        return {
+            "phases": self.phases,
+            "wall_seconds": round(sum(p["wall_seconds"] for p in self.phases), 3),
+            "cpu_seconds": round(sum(p["cpu_seconds"] for p in self.phases), 3),
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+        }
+
+
+def metrics_table(results: list[dict]) -> "pd.DataFrame":
+    """
+    Combines the metrics of the node results in a single table.
+
+    Parameters
+    ----------
+    results : list[dict]
+        The node results. Results without metrics are ignored.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per organization and phase.
+    """
+    # pandas is slow to import and not needed by the rest of the central step
+    import pandas as pd
+
+    rows = [
+        {"organization_id": result.get("organization_id"), **phase}
+        for result in results
+        if isinstance(result, dict) and "metrics" in result
+        for phase in result["metrics"]["phases"]
+    ]
+    return pd.DataFrame(
+        rows,
+        columns=[
+            "organization_id",
+            "phase",
+            "wall_seconds",
+            "cpu_seconds",
+            "peak_rss_mb",
+        ],
+    )
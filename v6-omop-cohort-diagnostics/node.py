@@ -0,0 +1,1321 @@
+"""
+Node side of the algorithm.
+
+This module is only imported when a node runs the algorithm, because importing
+the OHDSI packages starts R and the JVM. The central step does not need them.
+"""
+
+import csv
+import io
+import multiprocessing
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+import pandas as pd
+
+from vantage6.algorithm.tools.util import info, warn, get_env_var
+
+# R and the JVM read their memory limits when they start, which is when the
+# OHDSI packages are imported (the vantage6 decorators import them as well)
+from .resources import apply_memory_settings, max_shards
+
+apply_memory_settings()
+
+from vantage6.algorithm.tools.decorators import (
+    database_connection,
+    metadata,
+    RunMetaData,
+    OHDSIMetaData,
+)
+
+from ohdsi import cohort_generator
+from ohdsi import common as ohdsi_common
+from ohdsi import feature_extraction
+from ohdsi import cohort_diagnostics as ohdsi_cohort_diagnostics
+from ohdsi import cohort_generator as ohdsi_cohort_generator
+
+from rpy2.robjects import RS4, FloatVector
+from . import database
+from . import _create_cohort_query, _read_cohort_sql_bundle
+from .cache import content_hash, normalize_json, open_cache
+from .codesets import shared_codesets
+from .covariate_budget import apply_covariate_budget
+from .covariate_cache import (
+    CHARACTERIZATION_FILES,
+    CovariateCache,
+    assemble_characterization,
+    covariate_settings_key,
+    covariate_windows,
+    open_covariate_cache,
+    split_characterization,
+)
+from .cohort_store import CohortStore
+from .metrics import Metrics
+from .preflight import DIAGNOSTICS_DEFAULTS, preflight
+from .results import (
+    csv_zip_to_parquet,
+    encode_chunks,
+    filter_result_zip,
+    merge_result_zips,
+)
+from .vocabulary_cache import ConceptSetCache
+from .globals import (
+    DEFAULT_CD_MIN_RECORDS,
+    DEFAULT_CD_SQL_CACHE_MAX_MB,
+    DEFAULT_CD_COHORT_STORE,
+    DEFAULT_CD_COHORT_STORE_MAX_AGE_DAYS,
+    DEFAULT_CD_INCREMENTAL_DIR,
+    DEFAULT_CD_RESULT_CHUNK_SIZE,
+    DEFAULT_CD_DIAGNOSTICS_SHARDS,
+    DEFAULT_CD_INDEX_COHORT_TABLES,
+    DEFAULT_CD_SHARED_CODESETS,
+    DEFAULT_CD_PREFLIGHT_ROWS_PER_SECOND,
+    DEFAULT_CD_PREFLIGHT_CACHE_DIR,
+    DEFAULT_CD_TIME_BUDGET_SECONDS,
+    DEFAULT_CD_COVARIATE_CACHE_MAX_MB,
+    DEFAULT_CD_VOCABULARY_CACHE_SCHEMA,
+)
+
+# Seed of the subject sample of the temporal characterization
+CHARACTERIZATION_SAMPLE_SEED = 0
+# File in the results zip that lists the sampled cohorts
+CHARACTERIZATION_SAMPLE_FILE = "characterization_sample.csv"
+
+
+@dataclass
+class TaskCohorts:
+    """The cohorts of a task, generated in the cohort tables of the task."""
+
+    # cohort definition set, as expected by CohortGenerator and CohortDiagnostics
+    definition_set: pd.DataFrame
+    # base name of the cohort tables
+    table: str
+    # the cohort ids that are shared with the user, equal on all nodes
+    shared_ids: list[str]
+    # for every cohort, whether it was "generated" or "reused"
+    generation: list[str]
+
+    def subset(self, indices: list[int]) -> "TaskCohorts":
+        """Returns the cohorts at ``indices``, in the same cohort tables."""
+        return TaskCohorts(
+            self.definition_set.iloc[indices].reset_index(drop=True),
+            self.table,
+            [self.shared_ids[i] for i in indices],
+            [self.generation[i] for i in indices],
+        )
+
+    def summary(self) -> list[dict]:
+        """Describes the cohorts for the result of the node."""
+        return [
+            {"cohort_id": shared_id, "cohort_name": name, "generation": status}
+            for shared_id, name, status in zip(
+                self.shared_ids, self.definition_set["cohortName"], self.generation
+            )
+        ]
+
+
+@metadata
+@database_connection(types=["OMOP"], include_metadata=True)
+def cohort_diagnostics(
+    connection: RS4,
+    meta_omop: OHDSIMetaData,
+    meta_run: RunMetaData,
+    meta_cohorts: list[dict],
+    cohort_definitions: dict,
+    cohort_names: list[str],
+    temporal_covariate_settings: dict,
+    diagnostics_settings: dict,
+    cohort_sql_bundle: list[dict] | None = None,
+    incremental: bool = False,
+    result_format: str = "csv",
+    dry_run: bool = False,
+    budget_policy: str = "none",
+    characterization_sample_size: int | None = None,
+    covariate_budget: int | None = None,
+) -> dict:
+    """
+    Computes the OHDSI cohort diagnostics.
+
+    With ``dry_run``, the cohorts are generated and the cost of the diagnostics
+    is estimated, but the diagnostics are not run. With
+    ``characterization_sample_size``, the temporal characterization runs on a
+    random sample of the subjects of every cohort. With ``covariate_budget``,
+    every covariate domain is capped to that many concepts.
+    """
+    metrics = Metrics()
+    cohorts = _prepare_cohorts(
+        connection,
+        meta_omop,
+        meta_run,
+        meta_cohorts[0]["task_id"],
+        cohort_definitions,
+        cohort_names,
+        cohort_sql_bundle,
+        incremental,
+        metrics,
+    )
+    result = {
+        "organization_id": meta_run.organization_id,
+        "cohorts": cohorts.summary(),
+    }
+    if dry_run or budget_policy == "enforce":
+        temporal_covariate_settings, diagnostics_settings, result["preflight"] = (
+            _preflight(
+                connection,
+                meta_omop,
+                cohorts,
+                temporal_covariate_settings,
+                diagnostics_settings,
+                budget_policy,
+                metrics,
+            )
+        )
+    if covariate_budget and not dry_run:
+        temporal_covariate_settings, result["covariate_budget"] = _covariate_budget(
+            connection,
+            meta_omop,
+            cohorts,
+            temporal_covariate_settings,
+            diagnostics_settings,
+            covariate_budget,
+            metrics,
+        )
+    if not dry_run:
+        result["zip_chunks"] = _run_diagnostics(
+            connection,
+            meta_omop,
+            meta_run,
+            cohorts,
+            temporal_covariate_settings,
+            diagnostics_settings,
+            incremental,
+            result_format,
+            metrics,
+            meta_omop.export_folder / "exports",
+            characterization_sample_size,
+        )
+        result["format"] = result_format
+    result["metrics"] = metrics.to_dict()
+    return result
+
+
+@metadata
+@database_connection(types=["OMOP"], include_metadata=True)
+def cohort_diagnostics_batch(
+    connection: RS4,
+    meta_omop: OHDSIMetaData,
+    meta_run: RunMetaData,
+    meta_cohorts: list[dict],
+    studies: list[dict],
+    incremental: bool = False,
+    result_format: str = "csv",
+    dry_run: bool = False,
+    budget_policy: str = "none",
+    characterization_sample_size: int | None = None,
+    covariate_budget: int | None = None,
+) -> dict:
+    """
+    Computes the OHDSI cohort diagnostics for several studies in one session.
+
+    The cohorts of all studies are generated once, in a single set of cohort
+    tables, so cohorts that studies share are only generated once. The
+    diagnostics are then run per study, on the cohorts of that study.
+    """
+    metrics = Metrics()
+
+    # identical cohort definitions of different studies are the same cohort
+    index = {}
+    cohort_definitions = []
+    cohort_names = []
+    cohort_sql_bundle = []
+    study_indices = []
+    for study in studies:
+        indices = []
+        bundle = study.get("cohort_sql_bundle") or [None] * len(
+            study["cohort_definitions"]
+        )
+        for cohort_definition, name, entry in zip(
+            study["cohort_definitions"], study["cohort_names"], bundle
+        ):
+            key = normalize_json(cohort_definition)
+            if key not in index:
+                index[key] = len(cohort_definitions)
+                cohort_definitions.append(cohort_definition)
+                cohort_names.append(name)
+                cohort_sql_bundle.append(entry)
+            indices.append(index[key])
+        study_indices.append(indices)
+    info(
+        f"Running {len(studies)} studies with {len(cohort_definitions)} distinct "
+        f"cohort definitions"
+    )
+
+    cohorts = _prepare_cohorts(
+        connection,
+        meta_omop,
+        meta_run,
+        meta_cohorts[0]["task_id"],
+        cohort_definitions,
+        cohort_names,
+        cohort_sql_bundle if all(cohort_sql_bundle) else None,
+        incremental,
+        metrics,
+    )
+
+    results = []
+    for i, (study, indices) in enumerate(zip(studies, study_indices)):
+        info(f"Running study {i}: {study.get('name', '')}")
+        study_cohorts = cohorts.subset(indices)
+        study_metrics = Metrics()
+        study_result = {
+            "name": study.get("name", f"study_{i}"),
+            "cohorts": study_cohorts.summary(),
+        }
+        temporal_covariate_settings = study["temporal_covariate_settings"]
+        diagnostics_settings = study["diagnostics_settings"]
+        if dry_run or budget_policy == "enforce":
+            temporal_covariate_settings, diagnostics_settings, preflight_report = (
+                _preflight(
+                    connection,
+                    meta_omop,
+                    study_cohorts,
+                    temporal_covariate_settings,
+                    diagnostics_settings,
+                    budget_policy,
+                    study_metrics,
+                )
+            )
+            study_result["preflight"] = preflight_report
+        if covariate_budget and not dry_run:
+            temporal_covariate_settings, study_result["covariate_budget"] = (
+                _covariate_budget(
+                    connection,
+                    meta_omop,
+                    study_cohorts,
+                    temporal_covariate_settings,
+                    diagnostics_settings,
+                    covariate_budget,
+                    study_metrics,
+                )
+            )
+        if not dry_run:
+            study_result["zip_chunks"] = _run_diagnostics(
+                connection,
+                meta_omop,
+                meta_run,
+                study_cohorts,
+                temporal_covariate_settings,
+                diagnostics_settings,
+                incremental,
+                result_format,
+                study_metrics,
+                meta_omop.export_folder / "exports" / f"study_{i}",
+                characterization_sample_size,
+            )
+            study_result["format"] = result_format
+        metrics.phases.extend(
+            {**phase, "phase": f"study_{i}_{phase['phase']}"}
+            for phase in study_metrics.phases
+        )
+        study_result["metrics"] = study_metrics.to_dict()
+        results.append(study_result)
+
+    return {
+        "organization_id": meta_run.organization_id,
+        "studies": results,
+        "metrics": metrics.to_dict(),
+    }
+
+
+def _prepare_cohorts(
+    connection: RS4,
+    meta_omop: OHDSIMetaData,
+    meta_run: RunMetaData,
+    task_id: int,
+    cohort_definitions: list,
+    cohort_names: list[str],
+    cohort_sql_bundle: list[dict] | None,
+    incremental: bool,
+    metrics: Metrics,
+) -> TaskCohorts:
+    """
+    Compiles the cohort definitions and generates the cohorts of a task.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    meta_omop : OHDSIMetaData
+        The OMOP metadata of the node.
+    meta_run : RunMetaData
+        The metadata of the run.
+    task_id : int
+        The task id that is used in the cohort ids.
+    cohort_definitions : list
+        The cohort definitions in JSON format.
+    cohort_names : list[str]
+        The cohort names.
+    cohort_sql_bundle : list[dict], optional
+        The cohort SQL that was compiled in the central step.
+    incremental : bool
+        Whether the diagnostics run in incremental mode.
+    metrics : Metrics
+        Collects the metrics of the phases.
+
+    Returns
+    -------
+    TaskCohorts
+        The generated cohorts.
+    """
+    # Generate unique cohort ids, based on the task id and the number of files.
+    # The first six digits are the task id, the last three digits are the index
+    # of the file.
+    n = len(cohort_definitions)
+    shared_ids = []
+    cohort_ids = []
+    for i in range(0, n):
+        # These are the IDs to be shared with the user and should be identical for all
+        # nodes that participate
+        if incremental:
+            # Incremental results are tracked by cohort id, so the id has to
+            # follow the cohort content rather than the task
+            cohort_hash = content_hash(normalize_json(cohort_definitions[i]))
+            temp_id = f"{int(cohort_hash[:8], 16) % 10**9:09d}"
+        else:
+            temp_id = f"{task_id:04d}{i:03d}"
+        shared_ids.append(temp_id)
+        # The node id is appended at runtim by the node itself
+        cohort_ids.append(float(f"{meta_run.node_id}{temp_id}"))
+
+    info(f"Full local cohort ids: {cohort_ids}")
+    info(f"Shared cohort ids: {shared_ids}")
+
+    with metrics.phase("compile_cohorts"):
+        if cohort_sql_bundle:
+            cohort_sql = _read_cohort_sql_bundle(cohort_sql_bundle, cohort_definitions)
+            info("Using cohort SQL that was compiled in the central step")
+        else:
+            max_mb = get_env_var(
+                "CD_SQL_CACHE_MAX_MB", DEFAULT_CD_SQL_CACHE_MAX_MB, as_type="int"
+            )
+            cache = (
+                open_cache(_node_folder(meta_omop, "CD_SQL_CACHE_DIR", "cache"), max_mb)
+                if max_mb > 0
+                else None
+            )
+            cohort_sql = [
+                _create_cohort_query(cohort, cache) for cohort in cohort_definitions
+            ]
+            if cache:
+                cache.log_stats()
+
+    cohort_definition_set = pd.DataFrame(
+        {
+            "cohortId": cohort_ids,
+            "cohortName": cohort_names,
+            "json": cohort_definitions,
+            "sql": cohort_sql,
+            "logicDescription": [None] * n,
+            "generateStats": [True] * n,
+        }
+    )
+    info(f"Generated {n} cohort definitions")
+
+    # Generate the table names for the cohort tables
+    cohort_table = f"cohort_{task_id}_{meta_run.node_id}"
+    cohort_table_names = cohort_generator.get_cohort_table_names(cohort_table)
+    info(f"Cohort table name: {cohort_table}")
+    info(f"Tables: {cohort_table_names}")
+
+    info("(re-)creating cohort tables")
+    with metrics.phase("create_cohort_tables"):
+        ohdsi_cohort_generator.create_cohort_tables(
+            cohort_database_schema=meta_omop.results_schema,
+            connection=connection,
+            cohort_table_names=cohort_table_names)
+
+    with metrics.phase("generate_cohort_set"):
+        generation = None
+        if get_env_var("CD_COHORT_STORE", DEFAULT_CD_COHORT_STORE, as_type="bool"):
+            generation = _generate_from_store(
+                connection,
+                meta_omop,
+                cohort_table,
+                cohort_ids,
+                cohort_names,
+                cohort_definitions,
+                cohort_sql,
+            )
+        if generation is None:
+            info("generating cohort set")
+            with _shared_codesets(
+                connection,
+                meta_omop,
+                f"{cohort_table}_codesets",
+                cohort_definitions,
+                cohort_sql,
+            ) as generation_sql:
+                ohdsi_cohort_generator.generate_cohort_set(
+                    cdm_database_schema=meta_omop.cdm_schema,
+                    cohort_definition_set=ohdsi_common.convert_to_r(
+                        cohort_definition_set.assign(sql=generation_sql)
+                    ),
+                    connection=connection,
+                    cohort_database_schema=meta_omop.results_schema,
+                    cohort_table_names=cohort_table_names)
+            generation = ["generated"] * n
+
+    if get_env_var(
+        "CD_INDEX_COHORT_TABLES", DEFAULT_CD_INDEX_COHORT_TABLES, as_type="bool"
+    ):
+        info("indexing cohort table")
+        with metrics.phase("index_cohort_tables"):
+            database.index_cohort_table(
+                connection, meta_omop.dbms, meta_omop.results_schema, cohort_table
+            )
+
+    return TaskCohorts(cohort_definition_set, cohort_table, shared_ids, generation)
+
+
+def _preflight(
+    connection: RS4,
+    meta_omop: OHDSIMetaData,
+    cohorts: TaskCohorts,
+    temporal_covariate_settings: dict,
+    diagnostics_settings: dict,
+    budget_policy: str,
+    metrics: Metrics,
+) -> tuple[dict, dict, dict]:
+    """
+    Estimates the cost of the diagnostics of generated cohorts.
+
+    With the 'enforce' budget policy, the settings are reduced to fit within
+    the time budget of the node (``CD_TIME_BUDGET_SECONDS``), if it has one.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    meta_omop : OHDSIMetaData
+        The OMOP metadata of the node.
+    cohorts : TaskCohorts
+        The generated cohorts.
+    temporal_covariate_settings : dict
+        Arguments for FeatureExtraction's temporal covariate settings.
+    diagnostics_settings : dict
+        Flags of the diagnostics to run.
+    budget_policy : str
+        Either 'none' or 'enforce'.
+    metrics : Metrics
+        Collects the metrics of the phases.
+
+    Returns
+    -------
+    tuple[dict, dict, dict]
+        The temporal covariate settings and diagnostics settings to run with,
+        and the pre-flight report.
+    """
+    budget_seconds = get_env_var(
+        "CD_TIME_BUDGET_SECONDS", DEFAULT_CD_TIME_BUDGET_SECONDS, as_type="int"
+    )
+    with metrics.phase("preflight"):
+        return preflight(
+            connection,
+            meta_omop.cdm_schema,
+            meta_omop.results_schema,
+            _node_folder(
+                meta_omop,
+                "CD_PREFLIGHT_CACHE_DIR",
+                "preflight",
+                DEFAULT_CD_PREFLIGHT_CACHE_DIR,
+            ),
+            cohorts,
+            temporal_covariate_settings,
+            diagnostics_settings,
+            get_env_var("CD_MIN_RECORDS", DEFAULT_CD_MIN_RECORDS, as_type="int"),
+            get_env_var(
+                "CD_PREFLIGHT_ROWS_PER_SECOND",
+                DEFAULT_CD_PREFLIGHT_ROWS_PER_SECOND,
+                as_type="int",
+            ),
+            budget_seconds if budget_policy == "enforce" and budget_seconds else None,
+        )
+
+
+def _covariate_budget(
+    connection: RS4,
+    meta_omop: OHDSIMetaData,
+    cohorts: TaskCohorts,
+    temporal_covariate_settings: dict,
+    diagnostics_settings: dict,
+    budget: int,
+    metrics: Metrics,
+) -> tuple[dict, dict]:
+    """
+    Caps every covariate domain of the temporal characterization to ``budget``
+    concepts, when the characterization runs.
+
+    Returns the temporal covariate settings to use and the number of concepts
+    and kept concepts per domain.
+    """
+    if not {**DIAGNOSTICS_DEFAULTS, **diagnostics_settings}[
+        "run_temporal_cohort_characterization"
+    ]:
+        return temporal_covariate_settings, {}
+    with metrics.phase("covariate_budget"):
+        return apply_covariate_budget(
+            connection,
+            meta_omop.cdm_schema,
+            meta_omop.results_schema,
+            cohorts,
+            temporal_covariate_settings,
+            budget,
+            get_env_var("CD_MIN_RECORDS", DEFAULT_CD_MIN_RECORDS, as_type="int"),
+        )
+
+
+def _run_diagnostics(
+    connection: RS4,
+    meta_omop: OHDSIMetaData,
+    meta_run: RunMetaData,
+    cohorts: TaskCohorts,
+    temporal_covariate_settings: dict,
+    diagnostics_settings: dict,
+    incremental: bool,
+    result_format: str,
+    metrics: Metrics,
+    export_folder: Path,
+    characterization_sample_size: int | None = None,
+) -> list[str]:
+    """
+    Runs CohortDiagnostics on generated cohorts and encodes the results zip.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    meta_omop : OHDSIMetaData
+        The OMOP metadata of the node.
+    meta_run : RunMetaData
+        The metadata of the run.
+    cohorts : TaskCohorts
+        The cohorts to run the diagnostics for.
+    temporal_covariate_settings : dict
+        Arguments for FeatureExtraction's temporal covariate settings.
+    diagnostics_settings : dict
+        Flags of the diagnostics to run.
+    incremental : bool
+        Whether to run in incremental mode.
+    result_format : str
+        Format of the files in the results zip, 'csv' or 'parquet'.
+    metrics : Metrics
+        Collects the metrics of the phases.
+    export_folder : Path
+        Folder for the results zip of this task. In incremental mode, the
+        diagnostics export to a folder that is shared with earlier tasks.
+    characterization_sample_size : int, optional
+        The maximum number of subjects per cohort in the temporal
+        characterization. Characterizes all subjects if not set.
+
+    Returns
+    -------
+    list[str]
+        The base64-encoded chunks of the results zip.
+    """
+    # Privacy guards
+    min_cell_count = get_env_var(
+        "CD_MIN_RECORDS", DEFAULT_CD_MIN_RECORDS, as_type="int"
+    )
+
+    database_name = f"Node_{meta_run.organization_id}"
+    task_folder = export_folder
+    if incremental:
+        # Results of earlier runs are only valid for identical settings and
+        # data, so every combination gets its own folder
+        settings_key = content_hash(
+            normalize_json(diagnostics_settings),
+            normalize_json(temporal_covariate_settings),
+            database.cdm_data_version(connection, meta_omop.cdm_schema),
+            str(min_cell_count),
+            str(characterization_sample_size or ""),
+        )
+        run_folder = (
+            _node_folder(
+                meta_omop,
+                "CD_INCREMENTAL_DIR",
+                "incremental",
+                DEFAULT_CD_INCREMENTAL_DIR,
+            )
+            / settings_key[:16]
+        )
+        export_folder = run_folder / "exports"
+        incremental_folder = run_folder / "incremental"
+        # the database id is part of the stored results, so it has to be
+        # stable over tasks
+        database_id = f"{meta_run.organization_id}_{meta_run.node_id}"
+        info(f"Incremental mode, using {run_folder}")
+    else:
+        database_id = f"{meta_run.task_id:06d}__{meta_run.organization_id}_{meta_run.node_id}"
+        incremental_folder = None
+
+    diagnostics_args = {
+        "cohort_definition_set": cohorts.definition_set,
+        "export_folder": export_folder,
+        "database_id": database_id,
+        "database_name": database_name,
+        "cohort_table": cohorts.table,
+        "temporal_covariate_settings": temporal_covariate_settings,
+        "diagnostics_settings": diagnostics_settings,
+        "min_cell_count": min_cell_count,
+        "incremental_folder": incremental_folder,
+    }
+    shards = max_shards(
+        min(
+            get_env_var(
+                "CD_DIAGNOSTICS_SHARDS", DEFAULT_CD_DIAGNOSTICS_SHARDS, as_type="int"
+            ),
+            len(cohorts.definition_set),
+        )
+    )
+    characterization = {**DIAGNOSTICS_DEFAULTS, **diagnostics_settings}[
+        "run_temporal_cohort_characterization"
+    ]
+    covariate_cache = None
+    max_mb = get_env_var(
+        "CD_COVARIATE_CACHE_MAX_MB", DEFAULT_CD_COVARIATE_CACHE_MAX_MB, as_type="int"
+    )
+    # incremental mode keeps the results of earlier runs itself
+    if characterization and not incremental and max_mb > 0:
+        covariate_cache = open_covariate_cache(
+            _node_folder(meta_omop, "CD_COVARIATE_CACHE_DIR", "covariate_cache"),
+            max_mb,
+            covariate_settings_key(
+                temporal_covariate_settings,
+                meta_omop.cdm_schema,
+                database.cdm_data_version(connection, meta_omop.cdm_schema),
+                str(min_cell_count),
+                str(characterization_sample_size or ""),
+            ),
+        )
+    with metrics.phase("execute_diagnostics"):
+        if characterization and (characterization_sample_size or covariate_cache):
+            _execute_diagnostics_split(
+                connection,
+                meta_omop,
+                shards,
+                characterization_sample_size,
+                covariate_cache,
+                **diagnostics_args,
+            )
+        else:
+            _execute(connection, meta_omop, shards, **diagnostics_args)
+    info("Executed diagnostics")
+
+    # Read back the zip file with results. The zip is encoded in chunks, which
+    # the client decodes one by one. The node result is serialized as a whole,
+    # so all encoded chunks are kept and the peak memory is about the size of
+    # the encoded zip; only the raw zip is never in memory.
+    file_ = export_folder / f"Results_{database_id}.zip"
+    if incremental:
+        # the incremental export also holds the cohorts of earlier tasks,
+        # which can belong to other studies
+        task_folder.mkdir(parents=True, exist_ok=True)
+        task_file = task_folder / file_.name
+        with metrics.phase("filter_results"):
+            filter_result_zip(
+                file_, task_file, set(cohorts.definition_set["cohortId"])
+            )
+        file_ = task_file
+    if result_format == "parquet":
+        parquet_file = task_folder / f"Results_{database_id}_parquet.zip"
+        with metrics.phase("convert_parquet"):
+            csv_zip_to_parquet(file_, parquet_file)
+        info(
+            f"Converted results to Parquet, {file_.stat().st_size} bytes to "
+            f"{parquet_file.stat().st_size} bytes"
+        )
+        file_ = parquet_file
+    chunk_size = get_env_var(
+        "CD_RESULT_CHUNK_SIZE", DEFAULT_CD_RESULT_CHUNK_SIZE, as_type="int"
+    )
+    with metrics.phase("encode_results"):
+        chunks = list(encode_chunks(file_, chunk_size))
+    info(f"Encoded {file_.stat().st_size} bytes of results in {len(chunks)} chunks")
+    return chunks
+
+
+def _execute_diagnostics(
+    connection: RS4,
+    meta_omop: OHDSIMetaData,
+    cohort_definition_set: pd.DataFrame,
+    export_folder: Path,
+    database_id: str,
+    database_name: str,
+    cohort_table: str,
+    temporal_covariate_settings: dict,
+    diagnostics_settings: dict,
+    min_cell_count: int,
+    incremental_folder: Path | None = None,
+    cohort_ids: list[float] | None = None,
+) -> None:
+    """
+    Runs CohortDiagnostics on cohorts that have been generated already.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    meta_omop : OHDSIMetaData
+        The OMOP metadata of the node.
+    cohort_definition_set : pd.DataFrame
+        The cohort definition set of the task.
+    export_folder : Path
+        Folder in which CohortDiagnostics writes its results zip.
+    database_id : str
+        The database id in the results.
+    database_name : str
+        The database name in the results.
+    cohort_table : str
+        Base name of the cohort tables that contain the generated cohorts.
+    temporal_covariate_settings : dict
+        Arguments for FeatureExtraction's temporal covariate settings.
+    diagnostics_settings : dict
+        Flags of the diagnostics to run.
+    min_cell_count : int
+        Counts below this value are censored.
+    incremental_folder : Path, optional
+        Folder with the incremental results. Runs in incremental mode when set.
+    cohort_ids : list[float], optional
+        The cohorts to run the diagnostics for, all cohorts if not set.
+    """
+    covariate_settings = feature_extraction.create_temporal_covariate_settings(
+        **temporal_covariate_settings
+    )
+    info("Created temporal covariate settings")
+
+    if incremental_folder:
+        incremental_args = {
+            "incremental": True,
+            "incremental_folder": str(incremental_folder),
+        }
+    else:
+        incremental_args = {"incremental": False}
+
+    ohdsi_cohort_diagnostics.execute_diagnostics(
+        cohort_definition_set=ohdsi_common.convert_to_r(cohort_definition_set),
+        export_folder=str(export_folder),
+        database_id=database_id,
+        database_name=database_name,
+        database_description="Results generated by federated infrastructure.",
+        cohort_database_schema=meta_omop.results_schema,
+        connection=connection,
+        cdm_database_schema=meta_omop.cdm_schema,
+        cohort_table=cohort_table,
+        cohort_table_names=cohort_generator.get_cohort_table_names(cohort_table),
+        vocabulary_database_schema=meta_omop.cdm_schema,
+        cohort_ids=FloatVector(cohort_ids) if cohort_ids else None,
+        cdm_version=5,
+        temporal_covariate_settings=covariate_settings,
+        **diagnostics_settings,
+        min_cell_count=min_cell_count,
+        **incremental_args,
+    )
+
+
+def _execute(connection: RS4, meta_omop: OHDSIMetaData, shards: int, **kwargs) -> None:
+    """Runs ``_execute_diagnostics``, in ``shards`` parallel processes if more than 1."""
+    if shards > 1:
+        _execute_diagnostics_sharded(shards, **kwargs)
+    else:
+        _execute_diagnostics(connection, meta_omop, **kwargs)
+
+
+def _execute_diagnostics_split(
+    connection: RS4,
+    meta_omop: OHDSIMetaData,
+    shards: int,
+    sample_size: int | None,
+    covariate_cache: CovariateCache | None,
+    cohort_definition_set: pd.DataFrame,
+    export_folder: Path,
+    database_id: str,
+    cohort_table: str,
+    temporal_covariate_settings: dict,
+    diagnostics_settings: dict,
+    min_cell_count: int,
+    incremental_folder: Path | None = None,
+    **kwargs,
+) -> None:
+    """
+    Runs CohortDiagnostics with the temporal characterization in its own run.
+
+    All diagnostics but the temporal characterization run on the full cohorts
+    first. The temporal characterization then runs on a random sample of at
+    most ``sample_size`` subjects per cohort, in a copy of the cohort tables, if
+    set. With a covariate cache, it only runs for the cohorts and windows that
+    are not in the cache yet, and the characterization of the task is assembled
+    from the cache. The results of the runs are merged. When sampled, the
+    results zip gets a ``characterization_sample.csv`` with the subjects and
+    the sampled subjects of every cohort.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    meta_omop : OHDSIMetaData
+        The OMOP metadata of the node.
+    shards : int
+        The number of parallel processes per run.
+    sample_size : int, optional
+        The maximum number of subjects per cohort in the characterization.
+        Characterizes all subjects if not set.
+    covariate_cache : CovariateCache, optional
+        The cache of the characterization per cohort and window.
+    cohort_definition_set : pd.DataFrame
+        The cohort definition set of the task.
+    export_folder : Path
+        Folder in which the merged results zip is written.
+    database_id : str
+        The database id in the results.
+    cohort_table : str
+        Base name of the cohort tables that contain the generated cohorts.
+    temporal_covariate_settings : dict
+        Arguments for FeatureExtraction's temporal covariate settings.
+    diagnostics_settings : dict
+        Flags of the diagnostics to run.
+    min_cell_count : int
+        Counts below this value are censored.
+    incremental_folder : Path, optional
+        Folder with the incremental results. Runs in incremental mode when set.
+    **kwargs
+        The other arguments of ``_execute_diagnostics``.
+    """
+    _execute(
+        connection,
+        meta_omop,
+        shards,
+        cohort_definition_set=cohort_definition_set,
+        export_folder=export_folder / "full",
+        database_id=database_id,
+        cohort_table=cohort_table,
+        temporal_covariate_settings=temporal_covariate_settings,
+        diagnostics_settings={
+            **diagnostics_settings,
+            "run_temporal_cohort_characterization": False,
+        },
+        min_cell_count=min_cell_count,
+        incremental_folder=incremental_folder / "full" if incremental_folder else None,
+        **kwargs,
+    )
+
+    if sample_size:
+        characterization_table = f"{cohort_table}_sample"
+        ohdsi_cohort_generator.create_cohort_tables(
+            cohort_database_schema=meta_omop.results_schema,
+            connection=connection,
+            cohort_table_names=cohort_generator.get_cohort_table_names(
+                characterization_table
+            ),
+        )
+        counts = database.sample_cohort_table(
+            connection,
+            meta_omop.results_schema,
+            cohort_table,
+            characterization_table,
+            sample_size,
+            CHARACTERIZATION_SAMPLE_SEED,
+        )
+        # in a batch, the cohort table also holds the cohorts of other studies
+        ids = {int(cohort_id) for cohort_id in cohort_definition_set["cohortId"]}
+        counts = counts[counts["cohort_definition_id"].astype(int).isin(ids)]
+        info(
+            f"Characterizing at most {sample_size} subjects per cohort, "
+            f"{int((counts['subjects'] > sample_size).sum())} cohort(s) sampled"
+        )
+    else:
+        characterization_table = cohort_table
+
+    task_windows = covariate_windows(temporal_covariate_settings)
+    characterization_set = cohort_definition_set
+    characterization_settings = temporal_covariate_settings
+    if covariate_cache:
+        # the characterization of a cohort follows from its SQL, the other
+        # inputs are part of the settings key of the cache
+        cohort_keys = {
+            int(row.cohortId): content_hash(row.sql)
+            for row in cohort_definition_set.itertuples()
+        }
+        missing = {
+            cohort_id: [
+                window
+                for window in [None, *task_windows]
+                if not covariate_cache.has(cohort_key, window)
+            ]
+            for cohort_id, cohort_key in cohort_keys.items()
+        }
+        characterization_set = cohort_definition_set[
+            [
+                bool(missing[int(cohort_id)])
+                for cohort_id in cohort_definition_set["cohortId"]
+            ]
+        ]
+        # the covariates without a window are computed in any run, so a run
+        # for those alone takes the first window
+        run_windows = [
+            window
+            for window in task_windows
+            if any(window in cohort_windows for cohort_windows in missing.values())
+        ] or task_windows[:1]
+        characterization_settings = {
+            **temporal_covariate_settings,
+            "temporal_start_days": [start for start, _ in run_windows],
+            "temporal_end_days": [end for _, end in run_windows],
+        }
+        info(
+            f"Characterizing {len(characterization_set)} of "
+            f"{len(cohort_definition_set)} cohort(s) in {len(run_windows)} of "
+            f"{len(task_windows)} window(s), the rest is cached"
+        )
+
+    characterization_file = (
+        export_folder / "characterization" / f"Results_{database_id}.zip"
+    )
+    if len(characterization_set):
+        _execute(
+            connection,
+            meta_omop,
+            shards,
+            cohort_definition_set=characterization_set,
+            export_folder=characterization_file.parent,
+            database_id=database_id,
+            cohort_table=characterization_table,
+            temporal_covariate_settings=characterization_settings,
+            diagnostics_settings={
+                flag: flag == "run_temporal_cohort_characterization"
+                for flag in DIAGNOSTICS_DEFAULTS
+            },
+            min_cell_count=min_cell_count,
+            incremental_folder=(
+                incremental_folder / "characterization" if incremental_folder else None
+            ),
+            **kwargs,
+        )
+
+    # the cohort counts of the characterization run are those of the sample
+    file_ = export_folder / f"Results_{database_id}.zip"
+    if covariate_cache:
+        if len(characterization_set):
+            # only the cohorts and windows that were missing are stored, the
+            # run also covers windows that other cohorts were missing
+            characterized = {
+                int(cohort_id): cohort_keys[int(cohort_id)]
+                for cohort_id in characterization_set["cohortId"]
+            }
+            keys_missing = {
+                (cohort_keys[cohort_id], window)
+                for cohort_id, windows in missing.items()
+                for window in windows
+            }
+            for (cohort_key, window), tables in split_characterization(
+                characterization_file, characterized
+            ).items():
+                if (cohort_key, window) in keys_missing:
+                    covariate_cache.put(cohort_key, window, tables)
+        entries = {}
+        for cohort_id, cohort_key in cohort_keys.items():
+            for window in [None, *task_windows]:
+                tables = covariate_cache.get(cohort_key, window)
+                if tables is not None:
+                    entries[(cohort_id, window)] = tables
+        characterization = assemble_characterization(
+            entries, task_windows, database_id
+        )
+        covariate_cache.evict()
+        covariate_cache.log_stats()
+        sources = [export_folder / "full" / f"Results_{database_id}.zip"]
+        exclude = [set(CHARACTERIZATION_FILES)]
+        if characterization_file.exists():
+            sources.append(characterization_file)
+            exclude.append({"cohort_count.csv", *CHARACTERIZATION_FILES})
+        merge_result_zips(sources, file_, exclude=exclude)
+    else:
+        characterization = {}
+        merge_result_zips(
+            [
+                export_folder / "full" / f"Results_{database_id}.zip",
+                characterization_file,
+            ],
+            file_,
+            exclude=[set(), {"cohort_count.csv"}],
+        )
+    if sample_size:
+        characterization[CHARACTERIZATION_SAMPLE_FILE] = _sample_csv(
+            counts, database_id, sample_size, min_cell_count
+        )
+    with zipfile.ZipFile(file_, "a", zipfile.ZIP_DEFLATED) as zip_:
+        for name, content in characterization.items():
+            zip_.writestr(name, content)
+
+
+def _sample_csv(
+    counts: pd.DataFrame, database_id: str, sample_size: int, min_cell_count: int
+) -> str:
+    """Describes the sample of every cohort, with censored subject counts."""
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(
+        [
+            "cohort_id",
+            "database_id",
+            "subjects",
+            "sampled_subjects",
+            "sample_size",
+            "sampled",
+        ]
+    )
+    for row in counts.itertuples(index=False):
+        subjects, sampled = int(row.subjects), int(row.sampled_subjects)
+        writer.writerow(
+            [
+                int(row.cohort_definition_id),
+                database_id,
+                -min_cell_count if subjects < min_cell_count else subjects,
+                -min_cell_count if sampled < min_cell_count else sampled,
+                sample_size,
+                int(subjects > sample_size),
+            ]
+        )
+    return out.getvalue()
+
+
+@database_connection(types=["OMOP"], include_metadata=True)
+def _execute_diagnostics_shard(
+    connection: RS4, meta_omop: OHDSIMetaData, **kwargs
+) -> None:
+    """
+    Runs ``_execute_diagnostics`` in a shard process.
+
+    Every shard has its own R session and its own database connection, which
+    the decorator creates from the node environment.
+    """
+    _execute_diagnostics(connection, meta_omop, **kwargs)
+
+
+def _execute_diagnostics_sharded(
+    shards: int,
+    cohort_definition_set: pd.DataFrame,
+    export_folder: Path,
+    database_id: str,
+    incremental_folder: Path | None = None,
+    **kwargs,
+) -> None:
+    """
+    Runs CohortDiagnostics on groups of cohorts in parallel processes.
+
+    Every group gets its own export (and incremental) folder. The results zips
+    of the groups are merged into a single results zip in ``export_folder``.
+
+    Parameters
+    ----------
+    shards : int
+        The number of groups, and of parallel processes.
+    cohort_definition_set : pd.DataFrame
+        The cohort definition set of the task.
+    export_folder : Path
+        Folder in which the merged results zip is written.
+    database_id : str
+        The database id in the results.
+    incremental_folder : Path, optional
+        Folder with the incremental results. Runs in incremental mode when set.
+    **kwargs
+        The other arguments of ``_execute_diagnostics``.
+    """
+    # Cohorts are assigned by id, so in incremental mode (where the id follows
+    # the cohort definition) a cohort always ends up in the same shard
+    groups = [[] for _ in range(shards)]
+    for cohort_id in cohort_definition_set["cohortId"]:
+        groups[int(cohort_id) % shards].append(cohort_id)
+    groups = [(i, group) for i, group in enumerate(groups) if group]
+    info(f"Running diagnostics in {len(groups)} parallel shards")
+
+    # R and the JVM do not survive a fork, so the workers are started fresh
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=len(groups), mp_context=context) as pool:
+        futures = [
+            pool.submit(
+                _execute_diagnostics_shard,
+                cohort_definition_set=cohort_definition_set,
+                export_folder=export_folder / f"shard_{i}",
+                database_id=database_id,
+                incremental_folder=(
+                    incremental_folder / f"shard_{i}" if incremental_folder else None
+                ),
+                cohort_ids=group,
+                **kwargs,
+            )
+            for i, group in groups
+        ]
+        for future in futures:
+            future.result()
+
+    merge_result_zips(
+        [export_folder / f"shard_{i}" / f"Results_{database_id}.zip" for i, _ in groups],
+        export_folder / f"Results_{database_id}.zip",
+    )
+    info(f"Merged the results of {len(groups)} shards")
+
+
+def _generate_from_store(
+    connection: RS4,
+    meta_omop: OHDSIMetaData,
+    cohort_table: str,
+    cohort_ids: list[float],
+    cohort_names: list[str],
+    cohort_definitions: list,
+    cohort_sql: list[str],
+) -> list[str] | None:
+    """
+    Fills the cohort tables of this task from the persistent cohort store.
+
+    Cohorts that are not in the store yet, or that are older than the maximum
+    age, are generated into the store first. The store is not used when the
+    ``cdm_source`` table has no release date, as stored cohorts could then
+    silently stem from an earlier data release.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    meta_omop : OHDSIMetaData
+        The OMOP metadata of the node.
+    cohort_table : str
+        Base name of the (already created) cohort tables of this task.
+    cohort_ids : list[float]
+        The cohort ids within this task.
+    cohort_names : list[str]
+        The cohort names.
+    cohort_definitions : list
+        The cohort definitions in JSON format.
+    cohort_sql : list[str]
+        The queries that generate the cohorts.
+
+    Returns
+    -------
+    list[str] | None
+        For every cohort either "reused" or "generated", or ``None`` if the
+        store cannot be used.
+    """
+    if not database.cdm_release_dated(connection, meta_omop.cdm_schema):
+        warn(
+            f"Cohort store not used, {meta_omop.cdm_schema}.cdm_source has no "
+            f"release date to detect new data"
+        )
+        return None
+    store = CohortStore(connection, meta_omop.results_schema, meta_omop.cdm_schema)
+    store.create_tables()
+    store.evict(
+        get_env_var(
+            "CD_COHORT_STORE_MAX_AGE_DAYS",
+            DEFAULT_CD_COHORT_STORE_MAX_AGE_DAYS,
+            as_type="int",
+        )
+    )
+    keys = [
+        store.key(definition, sql)
+        for definition, sql in zip(cohort_definitions, cohort_sql)
+    ]
+    available = store.available(keys)
+
+    # identical definitions within one task only need to be generated once
+    new = {}
+    for key, name, definition, sql in zip(
+        keys, cohort_names, cohort_definitions, cohort_sql
+    ):
+        if key not in available and key not in new:
+            new[key] = (name, definition, sql)
+    info(
+        f"Cohort store: reusing {len(set(keys) & available)} cohort(s), "
+        f"generating {len(new)} cohort(s)"
+    )
+
+    # the store keys follow the queries as compiled, only the generation
+    # reads the shared concept sets
+    with _shared_codesets(
+        connection,
+        meta_omop,
+        f"{cohort_table}_codesets",
+        [definition for _, definition, _ in new.values()],
+        [sql for _, _, sql in new.values()],
+    ) as generation_sql:
+        store.generate(
+            list(new),
+            [name for name, _, _ in new.values()],
+            [definition for _, definition, _ in new.values()],
+            generation_sql,
+        )
+    store.copy_to(cohort_table, [(key, int(id_)) for key, id_ in zip(keys, cohort_ids)])
+    return ["generated" if key in new else "reused" for key in keys]
+
+
+@contextmanager
+def _shared_codesets(
+    connection: RS4,
+    meta_omop: OHDSIMetaData,
+    table: str,
+    cohort_definitions: list,
+    cohort_sql: list[str],
+) -> Iterator[list[str]]:
+    """
+    Expands the concept sets of cohorts once, if enabled.
+
+    The concept sets are read from the concept set cache when a cache schema is
+    configured, and the concept sets that cohorts share are expanded once when
+    shared codesets are enabled. Yields the queries to generate the cohorts
+    with.
+    """
+    cache_schema = get_env_var(
+        "CD_VOCABULARY_CACHE_SCHEMA", DEFAULT_CD_VOCABULARY_CACHE_SCHEMA
+    )
+    shared = get_env_var(
+        "CD_SHARED_CODESETS", DEFAULT_CD_SHARED_CODESETS, as_type="bool"
+    )
+    cache = None
+    if cache_schema:
+        cache = ConceptSetCache(connection, cache_schema, meta_omop.cdm_schema)
+        if not cache.version:
+            warn("Vocabulary version unknown, not using the concept set cache")
+            cache = None
+    if cache is None and not shared:
+        yield cohort_sql
+        return
+
+    with cache or nullcontext(), shared_codesets(
+        connection,
+        meta_omop.results_schema,
+        meta_omop.cdm_schema,
+        table,
+        cohort_definitions,
+        cohort_sql,
+        cache=cache,
+    ) as generation_sql:
+        yield generation_sql
+
+
+def _node_folder(
+    meta_omop: OHDSIMetaData, variable: str, name: str, default: str = ""
+) -> Path:
+    """
+    Returns the folder set by the environment variable ``variable``.
+
+    Falls back to the folder ``name`` in the export folder, which is part of
+    the temporary folder of the run and does not outlive the task.
+    """
+    folder = get_env_var(variable, default)
+    if folder:
+        return Path(folder)
+    warn(f"{variable} is not set, the {name} folder is kept for this task only")
+    return meta_omop.export_folder / name
@@ -0,0 +1,458 @@
+"""
+Pre-flight estimate of the cost of the diagnostics.
+
+Before CohortDiagnostics runs, the node counts the entries and subjects of the
+generated cohorts and the rows of the CDM tables that the diagnostics read.
+From these counts it estimates how many rows every enabled diagnostic and
+covariate reads, and converts that to seconds with the throughput of the
+database (``CD_PREFLIGHT_ROWS_PER_SECOND``).
+
+The estimate is rough: it assumes that the subjects of a cohort have as many
+records as an average person, and it does not model indexes or the
+parallelism of the database. It is meant to find the diagnostics that dominate
+a run, not to predict its duration to the minute.
+
+When a time budget is enforced, the most expensive covariates are dropped
+from the temporal characterization, and the most expensive diagnostics are
+skipped, until the estimate fits within ``CD_TIME_BUDGET_SECONDS``. The cohort
+counts and the inclusion statistics are always computed.
+"""
+
+import copy
+import json
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from rpy2.robjects import RS4
+from vantage6.algorithm.tools.util import info, warn
+
+from . import database
+from .cache import content_hash
+
+if TYPE_CHECKING:
+    from .node import TaskCohorts
+
+# Flags of CohortDiagnostics with their default in ``executeDiagnostics``
+DIAGNOSTICS_DEFAULTS = {
+    "run_inclusion_statistics": True,
+    "run_included_source_concepts": True,
+    "run_orphan_concepts": True,
+    "run_time_series": False,
+    "run_visit_context": True,
+    "run_breakdown_index_events": True,
+    "run_incidence_rate": True,
+    "run_cohort_relationship": True,
+    "run_temporal_cohort_characterization": True,
+}
+
+# Diagnostics that are never skipped to fit the budget
+PROTECTED_DIAGNOSTICS = ("run_inclusion_statistics",)
+
+# FeatureExtraction's default windows are every day of the year before index
+DEFAULT_WINDOWS = 365
+
+# CDM tables of which the rows are counted
+CDM_TABLES = (
+    "person",
+    "observation_period",
+    "visit_occurrence",
+    "condition_occurrence",
+    "condition_era",
+    "drug_exposure",
+    "drug_era",
+    "procedure_occurrence",
+    "device_exposure",
+    "measurement",
+    "observation",
+)
+CLINICAL_TABLES = CDM_TABLES[3:]
+
+# Table that a covariate flag reads, by prefix of the flag, and how many rows
+# it produces per row of that table. The group covariates roll every record
+# up its concept ancestors. The first matching prefix is used.
+COVARIATE_TABLES = (
+    ("use_condition_era_group", "condition_era", 5),
+    ("use_drug_era_group", "drug_era", 5),
+    ("use_condition_occurrence", "condition_occurrence", 1),
+    ("use_condition_era", "condition_era", 1),
+    ("use_drug_exposure", "drug_exposure", 1),
+    ("use_drug_era", "drug_era", 1),
+    ("use_procedure_occurrence", "procedure_occurrence", 1),
+    ("use_device_exposure", "device_exposure", 1),
+    ("use_measurement", "measurement", 1),
+    ("use_observation", "observation", 1),
+    ("use_visit", "visit_occurrence", 1),
+    ("use_distinct", "condition_occurrence", 1),
+    ("use_charlson_index", "condition_era", 1),
+    ("use_dcsi", "condition_era", 1),
+    ("use_chads2", "condition_era", 1),
+    ("use_hfrs", "condition_era", 1),
+)
+
+
+def cdm_table_counts(
+    connection: RS4, cdm_schema: str, cache_folder: Path
+) -> dict[str, int]:
+    """
+    Counts the rows of the CDM tables that the diagnostics read.
+
+    Counting large tables is slow on some databases, so the counts are stored
+    in ``cache_folder`` per CDM data version.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    cdm_schema : str
+        Schema that contains the CDM tables.
+    cache_folder : Path
+        Folder in which the counts are stored.
+
+    Returns
+    -------
+    dict[str, int]
+        The number of rows per table.
+    """
+    version = database.cdm_data_version(connection, cdm_schema)
+    file_ = cache_folder / f"{content_hash(cdm_schema, version)[:16]}.json"
+    if file_.exists():
+        return json.loads(file_.read_text())
+
+    sql = "\nUNION ALL\n".join(
+        f"SELECT '{table}' AS table_name, COUNT_BIG(*) AS row_count "
+        f"FROM {cdm_schema}.{table}"
+        for table in CDM_TABLES
+    )
+    result = database.query(connection, f"{sql};")
+    counts = {
+        row.table_name: int(row.row_count) for row in result.itertuples(index=False)
+    }
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    file_.write_text(json.dumps(counts))
+    return counts
+
+
+def cohort_counts(
+    connection: RS4, results_schema: str, cohorts: "TaskCohorts"
+) -> list[dict]:
+    """
+    Counts the entries and subjects of generated cohorts.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    results_schema : str
+        Schema that contains the cohort table.
+    cohorts : TaskCohorts
+        The cohorts to count.
+
+    Returns
+    -------
+    list[dict]
+        The shared cohort id, the number of entries and the number of subjects
+        of every cohort.
+    """
+    ids = [int(cohort_id) for cohort_id in cohorts.definition_set["cohortId"]]
+    result = database.query(
+        connection,
+        f"SELECT cohort_definition_id, COUNT_BIG(*) AS entries, "
+        f"COUNT_BIG(DISTINCT subject_id) AS subjects "
+        f"FROM {results_schema}.{cohorts.table} "
+        f"WHERE cohort_definition_id IN ({', '.join(map(str, ids))}) "
+        f"GROUP BY cohort_definition_id;",
+    )
+    counts = {
+        int(row.cohort_definition_id): (int(row.entries), int(row.subjects))
+        for row in result.itertuples(index=False)
+    }
+    return [
+        {
+            "cohort_id": shared_id,
+            "entries": counts.get(cohort_id, (0, 0))[0],
+            "subjects": counts.get(cohort_id, (0, 0))[1],
+        }
+        for shared_id, cohort_id in zip(cohorts.shared_ids, ids)
+    ]
+
+
+def _covariate_rows(
+    temporal_covariate_settings: dict,
+    tables: dict[str, int],
+    entries: int,
+    subjects: int,
+) -> dict[str, float]:
+    persons = max(tables.get("person", 0), 1)
+    windows = len(
+        temporal_covariate_settings.get("temporal_start_days") or range(DEFAULT_WINDOWS)
+    )
+    rows = {}
+    for flag, enabled in temporal_covariate_settings.items():
+        if not flag.startswith("use_") or enabled is not True:
+            continue
+        for prefix, table, factor in COVARIATE_TABLES:
+            if flag.startswith(prefix):
+                per_person = tables.get(table, 0) / persons
+                rows[flag] = subjects * per_person * factor * windows
+                break
+        else:
+            # demographics, one row per cohort entry
+            rows[flag] = entries
+    return rows
+
+
+def _diagnostic_rows(
+    flag: str,
+    tables: dict[str, int],
+    cohorts: list[dict],
+    covariate_rows: float,
+) -> float:
+    entries = sum(cohort["entries"] for cohort in cohorts)
+    subjects = sum(cohort["subjects"] for cohort in cohorts)
+    persons = max(tables.get("person", 0), 1)
+    clinical = sum(tables.get(table, 0) for table in CLINICAL_TABLES)
+    if flag == "run_inclusion_statistics":
+        return entries
+    if flag in ("run_included_source_concepts", "run_orphan_concepts"):
+        # the concept counts come from all clinical tables
+        return clinical
+    if flag == "run_time_series":
+        return tables.get("observation_period", 0) * 12 + entries
+    if flag == "run_visit_context":
+        return subjects * tables.get("visit_occurrence", 0) / persons
+    if flag == "run_breakdown_index_events":
+        return subjects * clinical / persons
+    if flag == "run_incidence_rate":
+        return tables.get("observation_period", 0) + entries
+    if flag == "run_cohort_relationship":
+        return entries * len(cohorts)
+    if flag == "run_temporal_cohort_characterization":
+        return covariate_rows
+    return entries
+
+
+def estimate(
+    tables: dict[str, int],
+    cohorts: list[dict],
+    temporal_covariate_settings: dict,
+    diagnostics_settings: dict,
+    rows_per_second: float,
+) -> dict:
+    """
+    Estimates the time of every enabled diagnostic and covariate.
+
+    Parameters
+    ----------
+    tables : dict[str, int]
+        The number of rows per CDM table.
+    cohorts : list[dict]
+        The entries and subjects per cohort.
+    temporal_covariate_settings : dict
+        Arguments for FeatureExtraction's temporal covariate settings.
+    diagnostics_settings : dict
+        Flags of the diagnostics to run.
+    rows_per_second : float
+        The number of rows that the database processes per second.
+
+    Returns
+    -------
+    dict
+        The estimated seconds per diagnostic (``diagnostics``), per covariate
+        of the temporal characterization (``covariates``) and in total
+        (``total_seconds``).
+    """
+    entries = sum(cohort["entries"] for cohort in cohorts)
+    subjects = sum(cohort["subjects"] for cohort in cohorts)
+    covariates = {
+        flag: rows / rows_per_second
+        for flag, rows in _covariate_rows(
+            temporal_covariate_settings, tables, entries, subjects
+        ).items()
+    }
+    settings = {**DIAGNOSTICS_DEFAULTS, **diagnostics_settings}
+    diagnostics = {
+        flag: _diagnostic_rows(
+            flag, tables, cohorts, sum(covariates.values()) * rows_per_second
+        )
+        / rows_per_second
+        for flag, enabled in settings.items()
+        if enabled is True
+    }
+    return {
+        "diagnostics": {flag: round(s, 1) for flag, s in diagnostics.items()},
+        "covariates": {flag: round(s, 1) for flag, s in covariates.items()},
+        "total_seconds": round(sum(diagnostics.values()), 1),
+    }
+
+
+def fit_budget(
+    costs: dict,
+    temporal_covariate_settings: dict,
+    diagnostics_settings: dict,
+    budget_seconds: float,
+) -> tuple[dict, dict, dict]:
+    """
+    Reduces the diagnostics until their estimate fits within a budget.
+
+    The most expensive step is taken first, until the estimate fits: either
+    dropping a covariate from the temporal characterization or skipping a
+    diagnostic. The temporal characterization itself is only skipped when it
+    does not fit with its demographics alone. The cohort counts and the
+    inclusion statistics are always kept.
+
+    Parameters
+    ----------
+    costs : dict
+        The estimate, as returned by ``estimate``.
+    temporal_covariate_settings : dict
+        Arguments for FeatureExtraction's temporal covariate settings.
+    diagnostics_settings : dict
+        Flags of the diagnostics to run.
+    budget_seconds : float
+        The time budget of the node.
+
+    Returns
+    -------
+    tuple[dict, dict, dict]
+        The temporal covariate settings and the diagnostics settings to use,
+        and the plan, with the ``dropped_covariates``, the
+        ``skipped_diagnostics`` and the estimate after the reduction
+        (``planned_seconds``).
+    """
+    temporal = copy.deepcopy(temporal_covariate_settings)
+    diagnostics = dict(diagnostics_settings)
+    characterization = "run_temporal_cohort_characterization"
+
+    steps = [
+        ("covariate", flag, seconds)
+        for flag, seconds in costs["covariates"].items()
+        if not flag.startswith("use_demographics")
+        and costs["diagnostics"].get(characterization)
+    ]
+    steps += [
+        ("diagnostic", flag, seconds)
+        for flag, seconds in costs["diagnostics"].items()
+        if flag not in PROTECTED_DIAGNOSTICS and flag != characterization
+    ]
+    steps.sort(key=lambda step: step[2], reverse=True)
+
+    total = costs["total_seconds"]
+    plan = {"dropped_covariates": [], "skipped_diagnostics": []}
+    for kind, flag, seconds in steps:
+        if total <= budget_seconds:
+            break
+        if kind == "covariate":
+            temporal[flag] = False
+            plan["dropped_covariates"].append(flag)
+        else:
+            diagnostics[flag] = False
+            plan["skipped_diagnostics"].append(flag)
+        total -= seconds
+
+    if total > budget_seconds and costs["diagnostics"].get(characterization):
+        # only the demographics are left
+        total -= sum(
+            seconds
+            for flag, seconds in costs["covariates"].items()
+            if flag.startswith("use_demographics")
+        )
+        diagnostics[characterization] = False
+        plan["skipped_diagnostics"].append(characterization)
+
+    plan["planned_seconds"] = round(max(total, 0), 1)
+    return temporal, diagnostics, plan
+
+
+def preflight(
+    connection: RS4,
+    cdm_schema: str,
+    results_schema: str,
+    cache_folder: Path,
+    cohorts: "TaskCohorts",
+    temporal_covariate_settings: dict,
+    diagnostics_settings: dict,
+    min_cell_count: int,
+    rows_per_second: float,
+    budget_seconds: float | None,
+) -> tuple[dict, dict, dict]:
+    """
+    Estimates the cost of the diagnostics and fits them within a budget.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    cdm_schema : str
+        Schema that contains the CDM tables.
+    results_schema : str
+        Schema that contains the cohort table.
+    cache_folder : Path
+        Folder in which the CDM table counts are stored.
+    cohorts : TaskCohorts
+        The generated cohorts.
+    temporal_covariate_settings : dict
+        Arguments for FeatureExtraction's temporal covariate settings.
+    diagnostics_settings : dict
+        Flags of the diagnostics to run.
+    min_cell_count : int
+        Cohort counts below this value are censored in the report.
+    rows_per_second : float
+        The number of rows that the database processes per second.
+    budget_seconds : float, optional
+        The time budget. The settings are returned unchanged if not set.
+
+    Returns
+    -------
+    tuple[dict, dict, dict]
+        The temporal covariate settings and diagnostics settings to run with,
+        and the report of the pre-flight, which can be shared with the user.
+    """
+    tables = cdm_table_counts(connection, cdm_schema, cache_folder)
+    counts = cohort_counts(connection, results_schema, cohorts)
+    costs = estimate(
+        tables,
+        counts,
+        temporal_covariate_settings,
+        diagnostics_settings,
+        rows_per_second,
+    )
+    info(f"Pre-flight estimate: {costs['total_seconds']:.0f}s, {costs['diagnostics']}")
+
+    # like CohortDiagnostics, censored counts are reported as -min_cell_count.
+    # The CDM table counts describe the whole database and stay on the node.
+    report = {
+        "cohorts": [
+            {
+                "cohort_id": cohort["cohort_id"],
+                **{
+                    key: (
+                        -min_cell_count
+                        if 0 < cohort[key] < min_cell_count
+                        else cohort[key]
+                    )
+                    for key in ("entries", "subjects")
+                },
+            }
+            for cohort in counts
+        ],
+        "estimate": costs,
+        "budget_seconds": budget_seconds,
+    }
+    if budget_seconds is None or costs["total_seconds"] <= budget_seconds:
+        return temporal_covariate_settings, diagnostics_settings, report
+
+    temporal_covariate_settings, diagnostics_settings, plan = fit_budget(
+        costs, temporal_covariate_settings, diagnostics_settings, budget_seconds
+    )
+    warn(
+        f"Estimate of {costs['total_seconds']:.0f}s exceeds the budget of "
+        f"{budget_seconds:.0f}s, dropped covariates {plan['dropped_covariates']} "
+        f"and skipped {plan['skipped_diagnostics']}"
+    )
+    if plan["planned_seconds"] > budget_seconds:
+        warn(
+            f"The cohort counts and inclusion statistics alone are estimated "
+            f"at {plan['planned_seconds']:.0f}s"
+        )
+    report["plan"] = plan
+    return temporal_covariate_settings, diagnostics_settings, report
@@ -0,0 +1,141 @@
+"""
+Memory and database session limits of the node.
+
+R and the JVM read their memory limits when they start, which happens when the
+OHDSI packages are imported. ``apply_memory_settings`` therefore has to run
+before that import. It passes the limits that the node admin configured to R
+and the JVM through their environment variables, and validates them against
+the memory limit of the container.
+
+DatabaseConnector sizes the batches in which it fetches query results from the
+free JVM heap, so the heap setting also governs the batch sizes.
+"""
+
+import os
+import re
+from pathlib import Path
+
+from vantage6.algorithm.tools.util import info, warn, get_env_var
+
+from .globals import (
+    DEFAULT_CD_JVM_MAX_HEAP_MB,
+    DEFAULT_CD_R_MAX_VSIZE_MB,
+    DEFAULT_CD_MAX_DB_SESSIONS,
+)
+
+# Memory limit of the container, for cgroup v2 and v1. Without a limit, v2
+# reports "max" and v1 reports a very large number.
+CGROUP_MEMORY_FILES = (
+    Path("/sys/fs/cgroup/memory.max"),
+    Path("/sys/fs/cgroup/memory/memory.limit_in_bytes"),
+)
+UNLIMITED_BYTES = 2**60
+
+XMX = re.compile(r"(^|\s)-Xmx\S+")
+
+
+def cgroup_memory_limit_mb() -> int | None:
+    """
+    Returns the memory limit of the container.
+
+    Returns
+    -------
+    int | None
+        The limit in MB, or None when the container has no memory limit.
+    """
+    for file_ in CGROUP_MEMORY_FILES:
+        try:
+            value = file_.read_text().strip()
+        except OSError:
+            continue
+        if value == "max" or int(value) >= UNLIMITED_BYTES:
+            return None
+        return int(value) // 2**20
+    return None
+
+
+def _mb(value: int | None, unset: str) -> str:
+    return f"{value} MB" if value else unset
+
+
+def _process_memory_mb() -> int:
+    """The memory that the settings allow a single R session to use."""
+    return get_env_var(
+        "CD_JVM_MAX_HEAP_MB", DEFAULT_CD_JVM_MAX_HEAP_MB, as_type="int"
+    ) + get_env_var("CD_R_MAX_VSIZE_MB", DEFAULT_CD_R_MAX_VSIZE_MB, as_type="int")
+
+
+def apply_memory_settings() -> None:
+    """
+    Passes the configured memory limits to R and the JVM.
+
+    Must be called before R is started. The JVM max heap is added to
+    ``_JAVA_OPTIONS``, which the JVM applies after all other options, so it
+    overrides a heap size that the base image sets. The R vector heap limit is
+    set in ``R_MAX_VSIZE``.
+
+    Raises
+    ------
+    ValueError
+        If the memory of a single R session exceeds the memory limit of the
+        container.
+    """
+    heap_mb = get_env_var("CD_JVM_MAX_HEAP_MB", DEFAULT_CD_JVM_MAX_HEAP_MB, as_type="int")
+    vsize_mb = get_env_var("CD_R_MAX_VSIZE_MB", DEFAULT_CD_R_MAX_VSIZE_MB, as_type="int")
+    limit_mb = cgroup_memory_limit_mb()
+    if limit_mb is not None and heap_mb + vsize_mb > limit_mb:
+        raise ValueError(
+            f"The JVM heap ({heap_mb} MB) and R vector heap ({vsize_mb} MB) "
+            f"exceed the memory limit of the container ({limit_mb} MB), lower "
+            f"CD_JVM_MAX_HEAP_MB or CD_R_MAX_VSIZE_MB"
+        )
+
+    if heap_mb:
+        # shard processes inherit the environment, so replace rather than add
+        java_options = XMX.sub("", os.environ.get("_JAVA_OPTIONS", "")).strip()
+        os.environ["_JAVA_OPTIONS"] = f"{java_options} -Xmx{heap_mb}m".strip()
+    if vsize_mb:
+        os.environ["R_MAX_VSIZE"] = f"{vsize_mb}M"
+    info(
+        f"Memory settings: JVM heap {_mb(heap_mb, 'default')}, R vector heap "
+        f"{_mb(vsize_mb, 'default')}, container limit {_mb(limit_mb, 'none')}"
+    )
+
+
+def max_shards(shards: int) -> int:
+    """
+    Limits the number of diagnostics shards to the node resources.
+
+    Every shard is a process with its own R session and database connection,
+    next to the session of the main process. The number of shards is reduced
+    so that all sessions stay within ``CD_MAX_DB_SESSIONS`` and, when the JVM
+    and R limits are set, within the memory limit of the container.
+
+    Parameters
+    ----------
+    shards : int
+        The requested number of shards.
+
+    Returns
+    -------
+    int
+        The number of shards to use, at least 1.
+    """
+    allowed = shards
+    sessions = get_env_var("CD_MAX_DB_SESSIONS", DEFAULT_CD_MAX_DB_SESSIONS, as_type="int")
+    if sessions:
+        allowed = min(allowed, sessions - 1)
+
+    process_mb = _process_memory_mb()
+    limit_mb = cgroup_memory_limit_mb()
+    if process_mb and limit_mb is not None:
+        allowed = min(allowed, limit_mb // process_mb - 1)
+
+    allowed = max(allowed, 1)
+    if allowed < shards:
+        warn(
+            f"Reduced the diagnostics shards from {shards} to {allowed} to stay "
+            f"within {sessions or 'unlimited'} database sessions and "
+            f"{_mb(limit_mb, 'unlimited')} of memory"
+        )
+    return allowed
@@ -0,0 +1,226 @@
+"""
+Helpers to package the CohortDiagnostics export for the central server.
+"""
+
+import io
+import csv
+import base64
+import hashlib
+import zipfile
+from pathlib import Path
+from typing import IO, Iterator
+
+# Tables with a cohort id that every run of CohortDiagnostics exports for all
+# cohorts of the cohort definition set
+SHARED_COHORT_FILES = {"cohort.csv"}
+# Columns that refer to a cohort of the cohort definition set
+COHORT_ID_COLUMNS = ("cohort_id", "target_cohort_id", "comparator_cohort_id")
+
+
+def encode_chunks(file_: Path, chunk_size: int) -> Iterator[str]:
+    """
+    Reads a file in chunks and base64-encodes each chunk.
+
+    Only a single chunk of the raw file is read at a time. Callers that keep all
+    encoded chunks still hold the complete encoding. The chunk size is rounded
+    down to a multiple of three bytes, so every encoded chunk is valid base64 on
+    its own and the concatenation of the chunks equals the encoding of the whole
+    file.
+
+    Parameters
+    ----------
+    file_ : Path
+        The file to encode.
+    chunk_size : int
+        The (maximum) number of bytes per chunk.
+
+    Yields
+    ------
+    str
+        The base64-encoded chunks, in order.
+    """
+    chunk_size = max(3, chunk_size - chunk_size % 3)
+    with open(file_, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield base64.b64encode(chunk).decode("UTF-8")
+
+
+def csv_zip_to_parquet(source: Path, target: Path) -> None:
+    """
+    Converts every CSV file in a zip to Parquet.
+
+    All columns are stored as strings, so the conversion is lossless and the
+    CSV files can be restored exactly as CohortDiagnostics wrote them. The
+    Parquet files use dictionary encoding and zstd compression, which suits the
+    repetitive covariate tables much better than deflate. Other files are
+    copied as-is.
+
+    Parameters
+    ----------
+    source : Path
+        The zip with CSV files, as exported by CohortDiagnostics.
+    target : Path
+        The zip to create.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    with zipfile.ZipFile(source) as zip_in, zipfile.ZipFile(target, "w") as zip_out:
+        for item in zip_in.infolist():
+            header = ""
+            if item.filename.endswith(".csv"):
+                with zip_in.open(item) as f:
+                    header = f.readline().decode("utf-8-sig").strip()
+            if not header:
+                zip_out.writestr(item, zip_in.read(item))
+                continue
+
+            columns = next(csv.reader([header]))
+            with zip_in.open(item) as f:
+                table = pa_csv.read_csv(
+                    f,
+                    convert_options=pa_csv.ConvertOptions(
+                        column_types={column: pa.string() for column in columns},
+                        strings_can_be_null=False,
+                    ),
+                )
+            buffer = io.BytesIO()
+            pq.write_table(table, buffer, compression="zstd", use_dictionary=True)
+            # already compressed, deflating again would only cost time
+            zip_out.writestr(
+                f"{item.filename[:-len('.csv')]}.parquet",
+                buffer.getvalue(),
+                compress_type=zipfile.ZIP_STORED,
+            )
+
+
+def filter_result_zip(source: Path, target: Path, cohort_ids: set[float]) -> None:
+    """
+    Copies a results zip with only the rows of the given cohorts.
+
+    In incremental mode, CohortDiagnostics adds the results of every run to the
+    same export files, so the zip also holds the cohorts of earlier tasks. Rows
+    of tables with a cohort id column are only kept when all their cohort ids
+    are in ``cohort_ids``. Tables without one (the database, vocabulary and
+    covariate reference tables) and other files are copied as-is.
+
+    Parameters
+    ----------
+    source : Path
+        The results zip, as exported by CohortDiagnostics.
+    target : Path
+        The zip to create.
+    cohort_ids : set[float]
+        The cohort ids to keep.
+    """
+    with zipfile.ZipFile(source) as zip_in, zipfile.ZipFile(
+        target, "w", zipfile.ZIP_DEFLATED
+    ) as zip_out:
+        for item in zip_in.infolist():
+            if not item.filename.endswith(".csv"):
+                zip_out.writestr(item, zip_in.read(item))
+                continue
+            with zip_in.open(item) as raw_in:
+                with zip_out.open(item.filename, "w") as raw_out:
+                    out = io.TextIOWrapper(raw_out, encoding="UTF-8", newline="")
+                    _filter_csv(raw_in, out, cohort_ids)
+                    out.flush()
+                    out.detach()
+
+
+def merge_result_zips(
+    sources: list[Path], target: Path, exclude: list[set[str]] | None = None
+) -> None:
+    """
+    Merges results zips of CohortDiagnostics runs on the same database.
+
+    CSV files with the same name are concatenated. Every run exports the shared
+    tables (such as the concept and reference tables), so rows of those tables
+    that an earlier zip already contains are only written once. Tables with a
+    ``cohort_id`` column are concatenated as they are, as every run exports its
+    own cohorts. For other files, the first occurrence is kept.
+
+    Parameters
+    ----------
+    sources : list[Path]
+        The zips to merge.
+    target : Path
+        The merged zip to create.
+    exclude : list[set[str]], optional
+        For every source, the names of the files that are not taken from it.
+    """
+    zips = [zipfile.ZipFile(source) for source in sources]
+    exclude = exclude or [set() for _ in zips]
+    try:
+        names = list(dict.fromkeys(name for zip_ in zips for name in zip_.namelist()))
+        with zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED) as zip_out:
+            for name in names:
+                containing = [
+                    zip_
+                    for zip_, excluded in zip(zips, exclude)
+                    if name in zip_.namelist() and name not in excluded
+                ]
+                if not containing:
+                    continue
+                if not name.endswith(".csv"):
+                    zip_out.writestr(name, containing[0].read(name))
+                    continue
+                with zip_out.open(name, "w") as raw_out:
+                    out = io.TextIOWrapper(raw_out, encoding="UTF-8", newline="")
+                    _merge_csv(containing, name, out)
+                    out.flush()
+                    out.detach()
+    finally:
+        for zip_ in zips:
+            zip_.close()
+
+
+def _merge_csv(zips: list[zipfile.ZipFile], name: str, out: io.TextIOBase) -> None:
+    writer = csv.writer(out, lineterminator="\n")
+    header = None
+    shared = False
+    # only digests are kept, so memory does not grow with the row size
+    seen = set()
+    for zip_ in zips:
+        with zip_.open(name) as raw_in:
+            reader = csv.reader(io.TextIOWrapper(raw_in, encoding="UTF-8", newline=""))
+            file_header = next(reader, None)
+            if file_header is None:
+                continue
+            if header is None:
+                header = file_header
+                writer.writerow(header)
+                shared = "cohort_id" not in header or name in SHARED_COHORT_FILES
+            elif file_header != header:
+                raise ValueError(f"Cannot merge {name}, the columns differ")
+            if not shared:
+                writer.writerows(reader)
+                continue
+            # identical rows within one zip are kept, only rows that an
+            # earlier zip contains are left out
+            digests = set()
+            for row in reader:
+                digest = hashlib.blake2b(
+                    "\x1f".join(row).encode("UTF-8"), digest_size=16
+                ).digest()
+                if digest not in seen:
+                    digests.add(digest)
+                    writer.writerow(row)
+            seen |= digests
+
+
+def _filter_csv(raw_in: IO[bytes], out: io.TextIOBase, cohort_ids: set[float]) -> None:
+    reader = csv.reader(io.TextIOWrapper(raw_in, encoding="UTF-8", newline=""))
+    writer = csv.writer(out, lineterminator="\n")
+    header = next(reader, None)
+    if header is None:
+        return
+    writer.writerow(header)
+    columns = [i for i, column in enumerate(header) if column in COHORT_ID_COLUMNS]
+    # R may write the ids in scientific notation, so they are compared as numbers
+    writer.writerows(
+        row
+        for row in reader
+        if all(row[i] and float(row[i]) in cohort_ids for i in columns)
+    )
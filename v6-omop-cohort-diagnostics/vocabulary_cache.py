@@ -0,0 +1,284 @@
+"""
+Cache of resolved concept sets, scoped to the vocabulary version.
+
+Resolving a concept set walks the concept_ancestor table for its descendants
+and the concept_relationship table for the source concepts that map to it.
+Studies keep submitting the same concept sets, while the vocabulary only
+changes a few times a year. The node therefore keeps the resolved concepts of
+every concept set in a table of its own, and the cohort queries read the
+concepts from that table instead of walking the vocabulary again.
+
+A resolved concept set is identified by a hash of the source schema and the
+vocabulary version (from the ``vocabulary`` table), and a hash of the concept
+set expression. A new vocabulary release therefore results in fresh concept
+sets, while the rows of the previous release are kept until no task uses them
+anymore. Rows are only added and removed, never replaced, so a task always
+reads complete concept sets.
+
+Tasks claim a concept set in a checksum table before they resolve it, so every
+concept set is resolved once. A concept set that another task is resolving is
+resolved from the vocabulary for this task only.
+"""
+
+import json
+import secrets
+
+from rpy2.robjects import RS4
+from vantage6.algorithm.tools.util import info, warn
+from ohdsi import circe
+
+from . import database
+from .cache import content_hash
+
+# Claims and uses are dated to the day, so a task that stopped without
+# releasing them is ignored after one to two days
+MAX_AGE_DAYS = 2
+
+
+def vocabulary_version(connection: RS4, vocabulary_schema: str) -> str:
+    """
+    Returns the vocabulary version of a schema, or an empty string if unknown.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    vocabulary_schema : str
+        Schema that contains the vocabulary tables.
+
+    Returns
+    -------
+    str
+        The version, as recorded for the vocabulary id ``None``.
+    """
+    result = database.query(
+        connection,
+        f"SELECT vocabulary_version FROM {vocabulary_schema}.vocabulary "
+        f"WHERE vocabulary_id = 'None';",
+    )
+    versions = result["vocabulary_version"].dropna()
+    return str(versions.iloc[0]) if len(versions) else ""
+
+
+class ConceptSetCache:
+    """
+    Vocabulary-version-scoped cache of resolved concept sets.
+
+    Use the cache as a context manager: while it is open, the rows of its
+    vocabulary version are not evicted by other tasks.
+
+    Parameters
+    ----------
+    connection : RS4
+        Connection to the OMOP database.
+    cache_schema : str
+        Schema in which the cache tables are kept.
+    vocabulary_schema : str
+        Schema that contains the vocabulary tables.
+    table : str, optional
+        Base name of the cache tables.
+    """
+
+    def __init__(
+        self,
+        connection: RS4,
+        cache_schema: str,
+        vocabulary_schema: str,
+        table: str = "cd_concept_set_cache",
+    ):
+        self.connection = connection
+        self.cache_schema = cache_schema
+        self.vocabulary_schema = vocabulary_schema
+        self.table = f"{cache_schema}.{table}"
+        self.checksum_table = f"{cache_schema}.{table}_checksum"
+        self.usage_table = f"{cache_schema}.{table}_usage"
+        self.version = vocabulary_version(connection, vocabulary_schema)
+        self.key = content_hash(vocabulary_schema, self.version)
+        self.task_key = secrets.token_hex(8)
+
+    def __enter__(self) -> "ConceptSetCache":
+        self.create_tables()
+        database.execute(
+            self.connection,
+            f"INSERT INTO {self.usage_table} (task_key, vocabulary_hash, used_date) "
+            f"SELECT '{self.task_key}' AS task_key, '{self.key}' AS vocabulary_hash, "
+            f"GETDATE() AS used_date;",
+        )
+        self.evict()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        database.execute(
+            self.connection,
+            f"DELETE FROM {self.usage_table} WHERE task_key = '{self.task_key}';",
+        )
+
+    def create_tables(self) -> None:
+        """Creates the cache tables, if they do not exist yet."""
+        database.execute(
+            self.connection,
+            f"IF OBJECT_ID('{self.table}', 'U') IS NULL "
+            f"CREATE TABLE {self.table} "
+            f"(vocabulary_hash VARCHAR(64) NOT NULL, "
+            f"concept_set_hash VARCHAR(64) NOT NULL, concept_id BIGINT NOT NULL, "
+            f"PRIMARY KEY (vocabulary_hash, concept_set_hash, concept_id));\n"
+            f"IF OBJECT_ID('{self.checksum_table}', 'U') IS NULL "
+            f"CREATE TABLE {self.checksum_table} "
+            f"(vocabulary_hash VARCHAR(64) NOT NULL, "
+            f"concept_set_hash VARCHAR(64) NOT NULL, task_key VARCHAR(16) NOT NULL, "
+            f"complete INT NOT NULL, claimed_date DATE NOT NULL, "
+            f"PRIMARY KEY (vocabulary_hash, concept_set_hash));\n"
+            f"IF OBJECT_ID('{self.usage_table}', 'U') IS NULL "
+            f"CREATE TABLE {self.usage_table} "
+            f"(task_key VARCHAR(16) NOT NULL, vocabulary_hash VARCHAR(64) NOT NULL, "
+            f"used_date DATE NOT NULL);",
+        )
+
+    def evict(self) -> None:
+        """Removes the concept sets of vocabulary versions that no task uses."""
+        stale = f"DATEADD(day, -{MAX_AGE_DAYS}, GETDATE())"
+        unused = (
+            f"vocabulary_hash <> '{self.key}' AND vocabulary_hash NOT IN ("
+            f"SELECT vocabulary_hash FROM {self.usage_table} "
+            f"WHERE used_date >= {stale})"
+        )
+        database.execute(
+            self.connection,
+            f"DELETE FROM {self.usage_table} WHERE used_date < {stale};\n"
+            f"DELETE FROM {self.checksum_table} WHERE {unused};\n"
+            f"DELETE FROM {self.table} WHERE {unused};",
+        )
+
+    def resolve(self, expressions: dict[str, dict]) -> dict[str, str]:
+        """
+        Resolves the concept sets that are not in the cache yet.
+
+        Parameters
+        ----------
+        expressions : dict[str, dict]
+            The concept set expressions, by their key.
+
+        Returns
+        -------
+        dict[str, str]
+            For every concept set that is in the cache, a query that selects
+            its ``concept_id``. Concept sets that another task is resolving
+            are left out.
+        """
+        hashes = {key: content_hash(key) for key in expressions}
+        claims = self._claims(list(hashes.values()))
+        resolved = 0
+        for key, expression in expressions.items():
+            concept_set_hash = hashes[key]
+            claim = claims.get(concept_set_hash)
+            if claim is not None and claim["stale"]:
+                self._release(concept_set_hash, claim["task_key"])
+                claim = None
+            if claim is None and self._claim(concept_set_hash):
+                self._resolve(concept_set_hash, expression)
+                claims[concept_set_hash] = {"complete": True}
+                resolved += 1
+        queries = {
+            # tasks that race on a dialect without primary keys can both
+            # resolve a concept set
+            key: (
+                f"SELECT DISTINCT concept_id FROM {self.table} "
+                f"WHERE vocabulary_hash = '{self.key}' "
+                f"AND concept_set_hash = '{concept_set_hash}'"
+            )
+            for key, concept_set_hash in hashes.items()
+            if claims.get(concept_set_hash, {}).get("complete")
+        }
+        info(
+            f"Concept set cache: reusing {len(queries) - resolved}, resolved "
+            f"{resolved}, {len(expressions) - len(queries)} being resolved by "
+            f"another task"
+        )
+        return queries
+
+    def _claims(self, concept_set_hashes: list[str]) -> dict[str, dict]:
+        if not concept_set_hashes:
+            return {}
+        in_list = ", ".join(f"'{h}'" for h in concept_set_hashes)
+        result = database.query(
+            self.connection,
+            f"SELECT concept_set_hash, task_key, complete, "
+            f"CASE WHEN complete = 0 AND claimed_date < "
+            f"DATEADD(day, -{MAX_AGE_DAYS}, GETDATE()) THEN 1 ELSE 0 END AS stale "
+            f"FROM {self.checksum_table} "
+            f"WHERE vocabulary_hash = '{self.key}' "
+            f"AND concept_set_hash IN ({in_list});",
+        )
+        return {
+            row.concept_set_hash: {
+                "task_key": row.task_key,
+                "complete": bool(row.complete),
+                "stale": bool(row.stale),
+            }
+            for row in result.itertuples()
+        }
+
+    def _claim(self, concept_set_hash: str) -> bool:
+        """Claims a concept set, returns whether this task got the claim."""
+        claimed = database.insert_unique(
+            self.connection,
+            f"INSERT INTO {self.checksum_table} "
+            f"(vocabulary_hash, concept_set_hash, task_key, complete, claimed_date) "
+            f"SELECT '{self.key}' AS vocabulary_hash, "
+            f"'{concept_set_hash}' AS concept_set_hash, "
+            f"'{self.task_key}' AS task_key, 0 AS complete, "
+            f"GETDATE() AS claimed_date;",
+        )
+        if not claimed:
+            return False
+        # dialects that do not enforce primary keys accept every claim, the
+        # task with the lowest key wins
+        result = database.query(
+            self.connection,
+            f"SELECT MIN(task_key) AS task_key FROM {self.checksum_table} "
+            f"WHERE vocabulary_hash = '{self.key}' "
+            f"AND concept_set_hash = '{concept_set_hash}';",
+        )
+        if result["task_key"].iloc[0] == self.task_key:
+            return True
+        self._release(concept_set_hash, self.task_key)
+        return False
+
+    def _resolve(self, concept_set_hash: str, expression: dict) -> None:
+        query = circe.build_concept_set_query(json.dumps(expression))[0]
+        try:
+            database.execute(
+                self.connection,
+                (
+                    f"INSERT INTO {self.table} "
+                    f"(vocabulary_hash, concept_set_hash, concept_id) "
+                    f"SELECT DISTINCT '{self.key}' AS vocabulary_hash, "
+                    f"'{concept_set_hash}' AS concept_set_hash, concept_id "
+                    f"FROM ({query}) codeset;\n"
+                    f"UPDATE {self.checksum_table} SET complete = 1 "
+                    f"WHERE vocabulary_hash = '{self.key}' "
+                    f"AND concept_set_hash = '{concept_set_hash}' "
+                    f"AND task_key = '{self.task_key}';"
+                ).replace("@vocabulary_database_schema", self.vocabulary_schema),
+            )
+        except Exception:
+            self._release(concept_set_hash, self.task_key)
+            raise
+
+    def _release(self, concept_set_hash: str, task_key: str) -> None:
+        """Removes a claim that did not complete, with the rows of its task."""
+        if task_key != self.task_key:
+            warn(f"Taking over concept set {concept_set_hash[:16]} of task {task_key}")
+        database.execute(
+            self.connection,
+            f"DELETE FROM {self.checksum_table} "
+            f"WHERE vocabulary_hash = '{self.key}' "
+            f"AND concept_set_hash = '{concept_set_hash}' "
+            f"AND task_key = '{task_key}' AND complete = 0;\n"
+            f"DELETE FROM {self.table} "
+            f"WHERE vocabulary_hash = '{self.key}' "
+            f"AND concept_set_hash = '{concept_set_hash}' "
+            f"AND NOT EXISTS (SELECT 1 FROM {self.checksum_table} c "
+            f"WHERE c.vocabulary_hash = '{self.key}' "
+            f"AND c.concept_set_hash = '{concept_set_hash}');",
+        )